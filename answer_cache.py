@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# === 設定 ===
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_PER_CONTEXT = 8
+
+# これらのファイルが更新されたら回答キャッシュを破棄する
+# （system_prompt.txt は app.py が読み直すときに clear() で破棄する）
+ANSWER_CACHE_WATCH_PATHS = ["data/CURRENT", "data/faq.json", "data/knowledge.json"]
+# 更新の確認（os.stat）はリクエストごとではなく、この間隔（秒）に1回だけ行う
+ANSWER_CACHE_CHECK_INTERVAL = float(os.getenv("ANSWER_CACHE_CHECK_INTERVAL", "1.0"))
+
+
+def _file_fingerprint(paths):
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprint.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+class SemanticAnswerCache:
+    """
+    質問 Embedding の類似度で gpt-4o の回答を再利用するキャッシュ。
+
+    検索で得た FAQ/knowledge の id・ProductFilmMatcher の結果・回答モードを
+    まとめた context_key が完全に一致し、かつ過去の質問とのコサイン類似度が
+    threshold 以上の場合にだけヒットとする。
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_contexts=ANSWER_CACHE_SIZE,
+                 watch_paths=ANSWER_CACHE_WATCH_PATHS, check_interval=ANSWER_CACHE_CHECK_INTERVAL):
+        self.threshold = threshold
+        self.max_contexts = max_contexts
+        self.watch_paths = list(watch_paths)
+        self._groups = OrderedDict()
+        self._lock = threading.Lock()
+        self.check_interval = check_interval
+        self._fingerprint = _file_fingerprint(self.watch_paths)
+        self._checked_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def _check_fingerprint(self):
+        # ロック内で呼ぶこと
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        fingerprint = _file_fingerprint(self.watch_paths)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self._groups.clear()
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._groups.clear()
+            self.invalidations += 1
+
+    def get(self, q_vector, context_key):
+        if q_vector is None:
+            return None
+        q = self._normalize(q_vector)
+        with self._lock:
+            self._check_fingerprint()
+            entries = self._groups.get(context_key)
+            if entries:
+                self._groups.move_to_end(context_key)
+                for vector, answer in entries:
+                    if float(np.dot(vector, q)) >= self.threshold:
+                        self.hits += 1
+                        return answer
+            self.misses += 1
+            return None
+
+    def put(self, q_vector, context_key, answer):
+        # 質問ベクトルが無い（語彙検索だけで答えた）回答は保存しない
+        if q_vector is None:
+            return
+        q = self._normalize(q_vector)
+        with self._lock:
+            self._check_fingerprint()
+            entries = self._groups.setdefault(context_key, [])
+            entries.append((q, answer))
+            if len(entries) > ANSWER_CACHE_PER_CONTEXT:
+                del entries[0]
+            self._groups.move_to_end(context_key)
+            while len(self._groups) > self.max_contexts:
+                self._groups.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "contexts": len(self._groups),
+                "max_contexts": self.max_contexts,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
@@ -3,6 +3,9 @@ import os
 import json
 import time
 import base64
+import hmac
+import logging
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -10,52 +13,42 @@ from dotenv import load_dotenv
 for var in ["HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"]:
     os.environ.pop(var, None)
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from openai import OpenAI
-import faiss
 import numpy as np
 from product_film_matcher import ProductFilmMatcher
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+import retrieval
+from answer_cache import SemanticAnswerCache
+from sheet_logger import SheetLogWriter
+from session_store import create_session_store
+from intent_router import IntentRouter
+from prompt_builder import Passage, assemble_context, observe_prompt
+from observability import (
+    REGISTRY, configure_logging, current_trace, observe_request, record_usage, span, start_trace,
+)
 
 load_dotenv()
+configure_logging()
+logger = logging.getLogger("chatbot")
 
 app = Flask(__name__)
 CORS(app)
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# セッション履歴
-session_histories = {}
-HISTORY_TTL = 1800
+# セッション履歴（容量・TTL 付き。SESSION_BACKEND=sqlite でワーカー間共有）
+session_store = create_session_store()
 
 def get_session_history(session_id):
-    now = time.time()
-    session = session_histories.get(session_id)
-    if not session or now - session["last_active"] > HISTORY_TTL:
-        session_histories[session_id] = {"last_active": now, "history": []}
-    else:
-        session_histories[session_id]["last_active"] = now
-    return session_histories[session_id]["history"]
+    return session_store.get_history(session_id)
 
 def add_to_session_history(session_id, role, content):
-    history = get_session_history(session_id)
-    history.append({"role": role, "content": content})
-    if len(history) > 10:
-        history[:] = history[-10:]
-
-# FAQ & knowledge データの読み込み
-with open("data/faq.json", encoding="utf-8") as f:
-    faq_items = json.load(f)
-faq_questions = [item["question"] for item in faq_items]
-faq_answers = [item["answer"] for item in faq_items]
-
-with open("data/knowledge.json", encoding="utf-8") as f:
-    knowledge_dict = json.load(f)
-knowledge_contents = [
-    f"{category}：{text}" for category, texts in knowledge_dict.items() for text in texts
-]
+    session_store.append(session_id, role, content)
 
 metadata_note = ""
 metadata_path = "data/metadata.json"
@@ -64,37 +57,126 @@ if os.path.exists(metadata_path):
         metadata = json.load(f)
         metadata_note = f"{metadata.get('title', '')} (種類: {metadata.get('type', '')}, 優先度: {metadata.get('priority', '')})"
 
-search_corpus = faq_questions + knowledge_contents
-source_flags = ["faq"] * len(faq_questions) + ["knowledge"] * len(knowledge_contents)
-
-EMBED_MODEL = "text-embedding-3-small"
-VECTOR_PATH = "data/vector_data.npy"
-INDEX_PATH = "data/index.faiss"
+EMBED_MODEL = retrieval.EMBED_MODEL
+# 質問の Embedding を待つ上限（秒）。超えた場合は語彙検索だけで回答する
+QUERY_EMBED_TIMEOUT = float(os.getenv("QUERY_EMBED_TIMEOUT", "5"))
+# 既定の再試行（2回）があると待ち時間が QUERY_EMBED_TIMEOUT の約3倍になるため、質問の Embedding では再試行しない
+query_embed_client = client.with_options(max_retries=0, timeout=QUERY_EMBED_TIMEOUT)
 
 def get_embedding(text):
     if not text or not text.strip():
         raise ValueError("空のテキストには埋め込みを生成できません")
     try:
-        response = client.embeddings.create(
+        response = query_embed_client.embeddings.create(
             model=EMBED_MODEL,
-            input=[text]
+            input=[text],
         )
         if not response.data or not response.data[0].embedding:
             raise ValueError("埋め込みデータが空です")
+        record_usage(EMBED_MODEL, response.usage)
         return np.array(response.data[0].embedding, dtype="float32")
     except Exception as e:
-        print("❌ Embedding error:", e)
+        logger.warning("Embedding error: %s", e)
         raise
 
-if os.path.exists(VECTOR_PATH) and os.path.exists(INDEX_PATH):
-    vector_data = np.load(VECTOR_PATH)
-    index = faiss.read_index(INDEX_PATH)
-else:
-    vector_data = np.array([get_embedding(text) for text in search_corpus], dtype="float32")
-    index = faiss.IndexFlatL2(vector_data.shape[1])
-    index.add(vector_data)
-    np.save(VECTOR_PATH, vector_data)
-    faiss.write_index(index, INDEX_PATH)
+def get_embeddings_batch(texts):
+    response = client.embeddings.create(model=EMBED_MODEL, input=texts)
+    return [np.array(item.embedding, dtype="float32") for item in response.data]
+
+embedding_cache = EmbeddingCache()
+
+# FAQ & knowledge とインデックスの読み込み（コーパス定義は retrieval.py に集約）
+# マニフェストがコーパスと一致しない場合は再構築（INDEX_AUTO_REBUILD=0 なら起動を中止）
+# INDEX_MMAP=1（既定）ではインデックスをメモリマップで開き、ワーカー間でページを共有する
+INDEX_MMAP = os.getenv("INDEX_MMAP", "1") == "1"
+snapshot = retrieval.load_snapshot(
+    model=EMBED_MODEL,
+    mmap=INDEX_MMAP,
+    embed_batch=get_embeddings_batch if os.getenv("INDEX_AUTO_REBUILD", "1") == "1" else None,
+    cache=embedding_cache,
+)
+
+# === ホットリロード ===
+# 新しいスナップショットを裏で読み込み、完成してから参照を差し替える。
+# 処理中のリクエストは開始時に取得した古いスナップショットをそのまま使い続ける。
+INDEX_WATCH_INTERVAL = int(os.getenv("INDEX_WATCH_INTERVAL", "60"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# /stats・/metrics 用（未設定なら ADMIN_TOKEN。どちらも無ければ 403）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or ADMIN_TOKEN
+reload_lock = threading.Lock()
+
+def has_token(headers, token):
+    """X-Admin-Token か Authorization: Bearer（Prometheus の bearer_token 用）が token と一致するか"""
+    if not token:
+        return False
+    given = headers.get("X-Admin-Token") or ""
+    auth = headers.get("Authorization") or ""
+    if auth.startswith("Bearer "):
+        given = given or auth[len("Bearer "):]
+    return hmac.compare_digest(given.encode(), token.encode())
+
+def reload_snapshot(force=False):
+    global snapshot
+    if not reload_lock.acquire(blocking=False):
+        return False
+    try:
+        fingerprint = retrieval.file_fingerprint(retrieval.snapshot_paths())
+        if not force and fingerprint == snapshot.fingerprint:
+            return False
+        # ワーカーごとの再構築を避けるため、リロード時は再構築せず検証のみ行う
+        new_snapshot = retrieval.load_snapshot(model=EMBED_MODEL, mmap=INDEX_MMAP)
+        snapshot = new_snapshot
+        logger.info("インデックスを再読み込みしました: %s", new_snapshot.info())
+        return True
+    except Exception:
+        logger.exception("インデックスの再読み込みに失敗しました（旧インデックスで継続します）")
+        return False
+    finally:
+        reload_lock.release()
+
+def watch_index_files():
+    while True:
+        time.sleep(INDEX_WATCH_INTERVAL)
+        reload_snapshot()
+
+# スレッドは fork 後に引き継がれないため、プロセスごとに最初のリクエストで起動する
+watcher_pid = None
+watcher_lock = threading.Lock()
+
+@app.before_request
+def begin_request_trace():
+    g.request_started = time.perf_counter()
+    start_trace()
+
+@app.after_request
+def end_request_trace(response):
+    # 段階別の所要時間を Server-Timing ヘッダーで返す（ストリーミングは応答開始までの段階のみ）
+    endpoint = request.url_rule.rule if request.url_rule else "other"
+    observe_request(endpoint, response.status_code, time.perf_counter() - g.get("request_started", time.perf_counter()))
+    trace = current_trace()
+    if trace and trace.stages:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+@app.before_request
+def start_index_watcher():
+    global watcher_pid
+    if INDEX_WATCH_INTERVAL <= 0 or watcher_pid == os.getpid():
+        return
+    with watcher_lock:
+        if watcher_pid != os.getpid():
+            threading.Thread(target=watch_index_files, name="index-watcher", daemon=True).start()
+            watcher_pid = os.getpid()
+
+# 質問 Embedding のキャッシュ（QUERY_CACHE_SHARED=1 でワーカー間共有の SQLite も参照）
+query_embedding_cache = QueryEmbeddingCache(
+    get_embedding,
+    EMBED_MODEL,
+    shared=embedding_cache if os.getenv("QUERY_CACHE_SHARED") == "1" else None,
+)
+
+# 言い換え質問への回答キャッシュ（世代の切り替え・faq.json / knowledge.json・system_prompt.txt の更新で自動破棄）
+answer_cache = SemanticAnswerCache()
 
 # Google Sheets
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
@@ -103,14 +185,57 @@ FEEDBACK_SHEET = "feedback_log"
 CHAT_LOGS_SHEET = os.getenv("CHAT_LOGS_SHEET", "chat_logs")
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
-credentials_info = json.loads(base64.b64decode(os.environ["GOOGLE_CREDENTIALS"]).decode("utf-8"))
-credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-sheet_service = build("sheets", "v4", credentials=credentials).spreadsheets()
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT")
+if SHEETS_API_ENDPOINT:
+    # 負荷試験用のローカル代替サーバー（scripts/mock_services.py）へ認証なしで送る
+    sheet_service = build(
+        "sheets", "v4",
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": SHEETS_API_ENDPOINT},
+    ).spreadsheets()
+else:
+    credentials_info = json.loads(base64.b64decode(os.environ["GOOGLE_CREDENTIALS"]).decode("utf-8"))
+    credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
+    sheet_service = build("sheets", "v4", credentials=credentials).spreadsheets()
+
+# シートへの追記はバックグラウンドでまとめて行い、レスポンスを待たせない
+sheet_logger = SheetLogWriter(sheet_service, SPREADSHEET_ID)
 
 pf_matcher = ProductFilmMatcher("data/product_film_color_matrix.json")
 
-with open("system_prompt.txt", encoding="utf-8") as f:
-    base_prompt = f.read()
+# FAQ 完全一致・高類似度、マトリクスだけで答えられる質問は gpt-4o を呼ばずに返す
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER", "1") == "1"
+intent_router = IntentRouter()
+
+# system_prompt.txt は更新されたら読み直し、古いプロンプトで作った回答キャッシュを破棄する
+SYSTEM_PROMPT_PATH = "system_prompt.txt"
+PROMPT_CHECK_INTERVAL = float(os.getenv("PROMPT_CHECK_INTERVAL", "1.0"))
+_prompt_lock = threading.Lock()
+_prompt_state = {"fingerprint": None, "text": "", "checked_at": 0.0}
+
+def get_base_prompt():
+    with _prompt_lock:
+        now = time.monotonic()
+        if _prompt_state["fingerprint"] is not None and now - _prompt_state["checked_at"] < PROMPT_CHECK_INTERVAL:
+            return _prompt_state["text"]
+        _prompt_state["checked_at"] = now
+        fingerprint = retrieval.file_fingerprint([SYSTEM_PROMPT_PATH])
+        if fingerprint != _prompt_state["fingerprint"]:
+            try:
+                with open(SYSTEM_PROMPT_PATH, encoding="utf-8") as f:
+                    text = f.read()
+            except OSError as e:
+                if _prompt_state["fingerprint"] is None:
+                    raise
+                logger.warning("system_prompt.txt を読み込めないため、前回の内容を使います: %s", e)
+                return _prompt_state["text"]
+            if _prompt_state["fingerprint"] is not None:
+                answer_cache.clear()
+                logger.info("system_prompt.txt を読み直しました（回答キャッシュを破棄）")
+            _prompt_state.update(fingerprint=fingerprint, text=text)
+        return _prompt_state["text"]
+
+get_base_prompt()
 
 def infer_response_mode(question):
     q_len = len(question)
@@ -123,115 +248,113 @@ def infer_response_mode(question):
 
 GREETING_PATTERNS = ["こんにちは", "こんばんは", "おはよう", "はじめまして", "宜しくお願いします", "よろしくお願いします"]
 
-@app.route("/chat", methods=["POST"])
-def chat():
-    try:
-        data = request.get_json()
-        user_q = data.get("question", "").strip()
-        session_id = data.get("session_id", "default")
-
-        if not user_q:
-            return jsonify({"error": "質問がありません"}), 400
-
-        # 挨拶パターンへの即時返答
-        if any(greet in user_q for greet in GREETING_PATTERNS):
-            reply = "こんにちは！ご質問があればお気軽にどうぞ。"
-
-            # ここでログ
-            sheet_service.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{CHAT_LOGS_SHEET}!A2:G",
-                valueInputOption="RAW",
-                body={"values":[[
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    user_q,
-                    reply,
-                    "None",
-                    0,
-                    session_id,
-                    "short"
-                ]]}
-            ).execute()
-
-            add_to_session_history(session_id, "assistant", reply)
-            return jsonify({
-                "response": reply,
-                "original_question": user_q,
-                "expanded_question": user_q
-            })
-
+GREETING_REPLY = "こんにちは！ご質問があればお気軽にどうぞ。"
+NO_CONTEXT_REPLY = (
+    "当社はコーヒー製品の委託加工を専門とする会社です。"
+    "恐れ入りますが、ご質問内容が当社業務と直接関連のある内容かどうかをご確認のうえ、"
+    "改めてお尋ねいただけますと幸いです。\n\n"
+    "ご不明な点がございましたら、当社の【お問い合わせフォーム】よりご連絡ください。"
+)
+
+def is_unanswered_answer(answer):
+    return "申し訳" in answer or "恐れ入りますが" in answer or "エラー" in answer
+
+def append_chat_log(user_q, answer, source_label, is_unanswered, session_id, mode):
+    sheet_logger.append(f"{CHAT_LOGS_SHEET}!A2:G", [
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # timestamp
+        user_q,                                       # question
+        answer,                                       # answer
+        source_label,                                 # source (FAQ/Knowledge/ProductFilm/複合、ローカル回答は FAQ-Exact 等)
+        is_unanswered,                                # 未回答フラグ
+        session_id,                                   # セッションID
+        mode                                          # short/default/long
+    ])
+
+def answer_greeting(user_q, session_id):
+    """挨拶パターンへの即時返答（該当しなければ None）"""
+    if any(greet in user_q for greet in GREETING_PATTERNS):
+        append_chat_log(user_q, GREETING_REPLY, "None", 0, session_id, "short")
+        add_to_session_history(session_id, "assistant", GREETING_REPLY)
+        return {"answer": GREETING_REPLY}
+    return None
+
+def prepare_chat(user_q, session_id):
+    """
+    /chat と /chat/stream 共通の前処理。
+
+    LLM を呼ばずに返せる場合は {"answer": ...} を、そうでなければ
+    プロンプトと回答キャッシュのキーを含む dict を返す。
+    """
+    greeting = answer_greeting(user_q, session_id)
+    if greeting:
+        return greeting
+
+    with span("session"):
         add_to_session_history(session_id, "user", user_q)
         session_history = get_session_history(session_id)
 
-        q_vector = get_embedding(user_q)
+    try:
+        with span("embedding"):
+            q_vector = query_embedding_cache.get(user_q)
+    except Exception as e:
+        # Embedding API が遅い・落ちている場合は語彙検索だけで続ける
+        logger.warning("質問の Embedding を取得できないため、語彙検索のみで検索します: %s", e)
+        q_vector = None
 
-        D, I = index.search(np.array([q_vector]), k=7)
-        if I.shape[1] == 0:
-            raise ValueError("検索結果が見つかりませんでした")
+    # コサイン類似度の下限を満たすヒットを、BM25 の語彙検索と RRF で統合して使う
+    snap = snapshot
+    with span("search"):
+        hits = snap.search(q_vector, query=user_q)
 
-        faq_context = []
-        reference_context = []
+    with span("matcher"):
+        film_match_data = pf_matcher.match(user_q, session_history)
+    with span("prompt"):
+        return build_chat_plan(user_q, session_id, snap, hits, film_match_data, q_vector)
+
+def build_chat_plan(user_q, session_id, snap, hits, film_match_data, q_vector):
+    """検索結果と製品マッチ結果からプロンプトを組み立てる（同期版・非同期版で共通）"""
+    if INTENT_ROUTER_ENABLED:
+        routed = intent_router.route(user_q, snap, hits, film_match_data)
+        if routed:
+            route_name, answer = routed
+            append_chat_log(user_q, answer, route_name, 0, session_id, infer_response_mode(user_q))
+            add_to_session_history(session_id, "assistant", answer)
+            return {"answer": answer}
 
-        for idx in I[0]:
-            if idx >= len(source_flags):
-                continue
-            src = source_flags[idx]
-            if src == "faq":
-                q = faq_questions[idx]
-                a = faq_answers[idx]
-                faq_context.append(f"Q: {q}\nA: {a}")
-            elif src == "knowledge":
-                ref_idx = idx - len(faq_questions)
-                if ref_idx < len(knowledge_contents):
-                    reference_context.append(f"【参考知識】{knowledge_contents[ref_idx]}")
+    # hits は統合スコアの高い順。この順にトークン予算内へ詰める
+    faq_context = []
+    reference_context = []
 
-        film_match_data = pf_matcher.match(user_q, session_history)
-        film_info_text = pf_matcher.format_match_info(film_match_data)
-        if film_info_text:
-            reference_context.insert(0, film_info_text)
-
-        if metadata_note:
-            reference_context.append(f"【参考ファイル情報】{metadata_note}")
-
-        if not faq_context and not reference_context and not film_info_text.strip():
-            answer = (
-                "当社はコーヒー製品の委託加工を専門とする会社です。"
-                "恐れ入りますが、ご質問内容が当社業務と直接関連のある内容かどうかをご確認のうえ、"
-                "改めてお尋ねいただけますと幸いです。\n\n"
-                "ご不明な点がございましたら、当社の【お問い合わせフォーム】よりご連絡ください。"
-            )
-
-            # ★ ここを追加：全件ログ（sourceは None、未回答フラグは0 or 判定に合わせて）
-            sheet_service.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{CHAT_LOGS_SHEET}!A2:G",
-                valueInputOption="RAW",
-                body={"values":[[
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    user_q,
-                    answer,
-                    "None",
-                    0,
-                    session_id,
-                    "short"
-                ]]}
-            ).execute()
+    for doc, score in hits:
+        if doc["source"] == "faq":
+            q = snap.corpus.faq_questions[doc["offset"]]
+            a = snap.corpus.faq_answers[doc["offset"]]
+            faq_context.append(Passage(f"Q: {q}\nA: {a}", body=a))
+        elif doc["source"] == "knowledge":
+            content = snap.corpus.knowledge_contents[doc["offset"]]
+            reference_context.append(Passage(f"【参考知識】{content}", body=content))
 
-            add_to_session_history(session_id, "assistant", answer)
-            return jsonify({
-                "response": answer,
-                "original_question": user_q,
-                "expanded_question": user_q
-            })
+    film_info_text = pf_matcher.format_match_info(film_match_data)
 
-        faq_part = "\n\n".join(faq_context[:3]) if faq_context else "該当するFAQは見つかりませんでした。"
-        ref_texts = [text for text in reference_context if "製品フィルム・カラー情報" in text]
-        other_refs = [text for text in reference_context if "製品フィルム・カラー情報" not in text][:2]
-        ref_part = "\n".join(ref_texts + other_refs)
+    if metadata_note:
+        reference_context.append(Passage(f"【参考ファイル情報】{metadata_note}"))
 
-        mode = infer_response_mode(user_q)
+    if not faq_context and not reference_context and not film_info_text.strip():
+        # 全件ログ（sourceは None）
+        append_chat_log(user_q, NO_CONTEXT_REPLY, "None", 0, session_id, "short")
+        add_to_session_history(session_id, "assistant", NO_CONTEXT_REPLY)
+        return {"answer": NO_CONTEXT_REPLY}
 
-        prompt = f"""以下は当社のFAQおよび参考情報です。これらを参考に、ユーザーの質問に製造元の立場でご回答ください。
+    # 製品フィルム・カラー情報は参考情報の先頭に必ず入れ、重複する FAQ・参考知識は除く
+    faq_texts, ref_texts = assemble_context(
+        faq_context, reference_context, [film_info_text] if film_info_text.strip() else []
+    )
+    faq_part = "\n\n".join(faq_texts) if faq_texts else "該当するFAQは見つかりませんでした。"
+    ref_part = "\n".join(ref_texts)
+
+    mode = infer_response_mode(user_q)
+
+    prompt = f"""以下は当社のFAQおよび参考情報です。これらを参考に、ユーザーの質問に製造元の立場でご回答ください。
 
 【FAQ】
 {faq_part}
@@ -242,56 +365,95 @@ def chat():
 ユーザーの質問: {user_q}
 回答："""
 
-        system_prompt = base_prompt
-        if mode == "short":
-            system_prompt += "\n\n可能な限り簡潔かつ要点のみで回答してください。"
-        elif mode == "long":
-            system_prompt += "\n\n詳細な説明や具体例を含めて丁寧に回答してください。"
-
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
+    system_prompt = get_base_prompt()
+    if mode == "short":
+        system_prompt += "\n\n可能な限り簡潔かつ要点のみで回答してください。"
+    elif mode == "long":
+        system_prompt += "\n\n詳細な説明や具体例を含めて丁寧に回答してください。"
+
+    src_tags = []
+    if faq_context:            src_tags.append("FAQ")
+    if reference_context:      src_tags.append("Knowledge")
+    if film_info_text.strip(): src_tags.append("ProductFilm")
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+    return {
+        "messages": messages,
+        "prompt_tokens": observe_prompt("gpt-4o", messages),
+        "mode": mode,
+        "q_vector": q_vector,
+        # 検索結果・製品マッチ結果・回答モードが同一で、質問が十分に近ければ過去の回答を再利用
+        "answer_context_key": (
+            tuple(doc["id"] for doc, _ in hits),
+            json.dumps(film_match_data, ensure_ascii=False, sort_keys=True),
+            mode,
+        ),
+        "src_tags": src_tags,
+    }
+
+def finish_chat(user_q, session_id, plan, answer, from_cache):
+    """LLM の回答確定後の共通処理（未回答検出・chat_logs 保存・履歴追加）"""
+    is_unanswered = 1 if is_unanswered_answer(answer) else 0
+    if is_unanswered:
+        sheet_logger.append(
+            f"{UNANSWERED_SHEET}!A2:D",
+            [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_q, "未回答", 1]
         )
-        answer = completion.choices[0].message.content.strip()
-
-        if "申し訳" in answer or "恐れ入りますが" in answer or "エラー" in answer:
-            sheet_service.values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{UNANSWERED_SHEET}!A2:D",
-                valueInputOption="RAW",
-                body={"values": [[datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_q, "未回答", 1]]}
-            ).execute()
-
-        # --- 全件ログを chat_logs に保存 ---
-        is_unanswered = 1 if ("申し訳" in answer or "恐れ入りますが" in answer or "エラー" in answer) else 0
-
-        src_tags = []
-        if faq_context:            src_tags.append("FAQ")
-        if reference_context:      src_tags.append("Knowledge")
-        if film_info_text.strip(): src_tags.append("ProductFilm")
-        source_label = "+".join(src_tags) if src_tags else "None"
-
-        sheet_service.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{CHAT_LOGS_SHEET}!A2:G",
-            valueInputOption="RAW",
-            body={"values": [[
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # timestamp
-                user_q,                                       # question
-                answer,                                       # answer
-                source_label,                                 # source (FAQ/Knowledge/ProductFilm/複合)
-                is_unanswered,                                # 未回答フラグ
-                session_id,                                   # セッションID
-                mode                                          # short/default/long
-            ]]}
-        ).execute()
 
+    # --- 全件ログを chat_logs に保存 ---
+    src_tags = plan["src_tags"] + (["Cache"] if from_cache else [])
+    source_label = "+".join(src_tags) if src_tags else "None"
+    with span("log"):
+        append_chat_log(user_q, answer, source_label, is_unanswered, session_id, plan["mode"])
         add_to_session_history(session_id, "assistant", answer)
 
+    stages_ms = current_trace().stages_ms() if current_trace() else {}
+    logger.info(
+        "chat answered source=%s mode=%s unanswered=%d stages_ms=%s",
+        source_label, plan["mode"], is_unanswered, stages_ms,
+        extra={"session_id": session_id, "source": source_label, "stages_ms": stages_ms},
+    )
+
+def parse_chat_request():
+    data = request.get_json()
+    return data.get("question", "").strip(), data.get("session_id", "default")
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    try:
+        user_q, session_id = parse_chat_request()
+
+        if not user_q:
+            return jsonify({"error": "質問がありません"}), 400
+
+        plan = prepare_chat(user_q, session_id)
+        if "answer" in plan:
+            return jsonify({
+                "response": plan["answer"],
+                "original_question": user_q,
+                "expanded_question": user_q
+            })
+
+        with span("answer_cache"):
+            answer = answer_cache.get(plan["q_vector"], plan["answer_context_key"])
+        from_cache = answer is not None
+
+        if not from_cache:
+            with span("llm"):
+                completion = client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=plan["messages"],
+                    temperature=0.2,
+                )
+            record_usage("gpt-4o", completion.usage)
+            answer = completion.choices[0].message.content.strip()
+            answer_cache.put(plan["q_vector"], plan["answer_context_key"], answer)
+
+        finish_chat(user_q, session_id, plan, answer, from_cache)
+
         return jsonify({
             "response": answer,
             "original_question": user_q,
@@ -299,12 +461,84 @@ def chat():
         })
 
     except Exception as e:
-        print("[ERROR in /chat]:", e)
+        logger.exception("/chat でエラーが発生しました")
         return jsonify({
             "response": "エラーが発生しました。",
             "error": str(e)
         }), 500
 
+def sse_event(data, event=None):
+    payload = json.dumps(data, ensure_ascii=False)
+    return (f"event: {event}\n" if event else "") + f"data: {payload}\n\n"
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    /chat のストリーミング版（Server-Sent Events）。
+
+    回答を "delta" イベントで逐次送り、完了時に "done" イベントで全文を送る。
+    未回答検出と chat_logs の保存はストリーム完了後にまとめて行う。
+    """
+    try:
+        user_q, session_id = parse_chat_request()
+        if not user_q:
+            return jsonify({"error": "質問がありません"}), 400
+        plan = prepare_chat(user_q, session_id)
+    except Exception as e:
+        logger.exception("/chat/stream でエラーが発生しました")
+        return jsonify({
+            "response": "エラーが発生しました。",
+            "error": str(e)
+        }), 500
+
+    def generate():
+        if "answer" in plan:
+            yield sse_event({"delta": plan["answer"]}, "delta")
+            yield sse_event({"response": plan["answer"], "original_question": user_q, "expanded_question": user_q}, "done")
+            return
+
+        try:
+            with span("answer_cache"):
+                answer = answer_cache.get(plan["q_vector"], plan["answer_context_key"])
+            from_cache = answer is not None
+
+            if from_cache:
+                yield sse_event({"delta": answer}, "delta")
+            else:
+                chunks = []
+                with span("llm"):
+                    stream = client.chat.completions.create(
+                        model="gpt-4o",
+                        messages=plan["messages"],
+                        temperature=0.2,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+                    for chunk in stream:
+                        # usage は choices が空の最後のチャンクで届く
+                        record_usage("gpt-4o", getattr(chunk, "usage", None))
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            chunks.append(delta)
+                            yield sse_event({"delta": delta}, "delta")
+                answer = "".join(chunks).strip()
+                answer_cache.put(plan["q_vector"], plan["answer_context_key"], answer)
+
+            finish_chat(user_q, session_id, plan, answer, from_cache)
+            yield sse_event({"response": answer, "original_question": user_q, "expanded_question": user_q}, "done")
+
+        except Exception as e:
+            logger.exception("/chat/stream の生成中にエラーが発生しました")
+            yield sse_event({"response": "エラーが発生しました。", "error": str(e)}, "error")
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.route("/feedback", methods=["POST"])
 def feedback():
     data = request.get_json()
@@ -316,15 +550,48 @@ def feedback():
     if not all([question, answer, feedback_value]):
         return jsonify({"error": "不完全なフィードバックデータです"}), 400
 
-    sheet_service.values().append(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"{FEEDBACK_SHEET}!A2:E",
-        valueInputOption="RAW",
-        body={"values": [[datetime.now().strftime("%Y-%m-%d %H:%M:%S"), question, answer, feedback_value, reason]]}
-    ).execute()
+    append_feedback_log(question, answer, feedback_value, reason)
 
     return jsonify({"status": "success"})
 
+def append_feedback_log(question, answer, feedback_value, reason):
+    sheet_logger.append(
+        f"{FEEDBACK_SHEET}!A2:E",
+        [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), question, answer, feedback_value, reason]
+    )
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    if not has_token(request.headers, ADMIN_TOKEN):
+        return jsonify({"error": "forbidden"}), 403
+    # 読み込みはバックグラウンドで行い、完了したら次のリクエストから切り替わる
+    threading.Thread(target=reload_snapshot, kwargs={"force": True}, daemon=True).start()
+    return jsonify({"status": "reloading", "current": snapshot.info()}), 202
+
+def collect_stats():
+    return {
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "index": snapshot.info(),
+        "sheet_logger": sheet_logger.stats(),
+        "sessions": session_store.stats(),
+        "intent_router": intent_router.stats()
+    }
+
+REGISTRY.register_collector(collect_stats)
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    if not has_token(request.headers, METRICS_TOKEN):
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(collect_stats())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not has_token(request.headers, METRICS_TOKEN):
+        return jsonify({"error": "forbidden"}), 403
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/", methods=["GET"])
 def home():
     return "Chatbot API is running."
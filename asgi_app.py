@@ -0,0 +1,306 @@
+# asgi_app.py
+# 非同期（ASGI）版のチャット API。データ・キャッシュ・プロンプト組み立ては app.py と共通。
+#
+# 起動例: uvicorn asgi_app:app --host 0.0.0.0 --port 8000 --workers 2
+#
+# SQLite のセッションストア・埋め込みキャッシュなどブロックする処理は asyncio.to_thread で
+# スレッドに逃がし、イベントループを塞がない。
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as core
+from observability import REGISTRY, observe_request, record_usage, span, start_trace
+
+logger = logging.getLogger("chatbot.asgi")
+
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 質問の Embedding は再試行せず QUERY_EMBED_TIMEOUT で諦め、語彙検索だけで続ける
+query_embed_client = async_client.with_options(max_retries=0, timeout=core.QUERY_EMBED_TIMEOUT)
+
+# 1プロセスで同時に待ち合わせる OpenAI 呼び出しの上限
+MAX_INFLIGHT_LLM = int(os.getenv("MAX_INFLIGHT_LLM", "64"))
+llm_semaphore = asyncio.Semaphore(MAX_INFLIGHT_LLM)
+
+
+async def get_embedding_async(text):
+    vector = await asyncio.to_thread(core.query_embedding_cache.lookup, text)
+    if vector is not None:
+        return vector
+    response = await query_embed_client.embeddings.create(model=core.EMBED_MODEL, input=[text])
+    if not response.data or not response.data[0].embedding:
+        raise ValueError("埋め込みデータが空です")
+    record_usage(core.EMBED_MODEL, response.usage)
+    vector = np.array(response.data[0].embedding, dtype="float32")
+    await asyncio.to_thread(core.query_embedding_cache.store, text, vector)
+    return vector
+
+
+async def prepare_chat_async(user_q, session_id):
+    """
+    app.prepare_chat の非同期版。
+
+    質問の Embedding 取得（ネットワーク待ち）と ProductFilmMatcher.match（CPU 処理）を
+    並行して実行し、揃ったところで共通のプロンプト組み立てを行う。
+    """
+    greeting = await asyncio.to_thread(core.answer_greeting, user_q, session_id)
+    if greeting:
+        return greeting
+
+    def load_session():
+        with span("session"):
+            core.add_to_session_history(session_id, "user", user_q)
+            return core.get_session_history(session_id)
+
+    session_history = await asyncio.to_thread(load_session)
+
+    async def embedding():
+        with span("embedding"):
+            return await get_embedding_async(user_q)
+
+    def match():
+        with span("matcher"):
+            return core.pf_matcher.match(user_q, session_history)
+
+    q_vector, film_match_data = await asyncio.gather(
+        embedding(),
+        asyncio.to_thread(match),
+        return_exceptions=True,
+    )
+    if isinstance(film_match_data, BaseException):
+        raise film_match_data
+    if isinstance(q_vector, BaseException):
+        # Embedding API が遅い・落ちている場合は語彙検索だけで続ける
+        logger.warning("質問の Embedding を取得できないため、語彙検索のみで検索します: %s", q_vector)
+        q_vector = None
+
+    snap = core.snapshot
+    with span("search"):
+        hits = snap.search(q_vector, query=user_q)
+
+    def plan():
+        # 定型回答ではセッション履歴への追記（SQLite）、プロンプトの読み込みでファイル I/O があるため
+        with span("prompt"):
+            return core.build_chat_plan(user_q, session_id, snap, hits, film_match_data, q_vector)
+
+    return await asyncio.to_thread(plan)
+
+
+async def read_question(request):
+    data = await request.json()
+    return data.get("question", "").strip(), data.get("session_id", "default")
+
+
+def chat_response(answer, user_q):
+    return JSONResponse({
+        "response": answer,
+        "original_question": user_q,
+        "expanded_question": user_q
+    })
+
+
+async def chat(request):
+    try:
+        user_q, session_id = await read_question(request)
+        if not user_q:
+            return JSONResponse({"error": "質問がありません"}, status_code=400)
+
+        plan = await prepare_chat_async(user_q, session_id)
+        if "answer" in plan:
+            return chat_response(plan["answer"], user_q)
+
+        with span("answer_cache"):
+            answer = core.answer_cache.get(plan["q_vector"], plan["answer_context_key"])
+        from_cache = answer is not None
+
+        if not from_cache:
+            async with llm_semaphore:
+                with span("llm"):
+                    completion = await async_client.chat.completions.create(
+                        model="gpt-4o",
+                        messages=plan["messages"],
+                        temperature=0.2,
+                    )
+            record_usage("gpt-4o", completion.usage)
+            answer = completion.choices[0].message.content.strip()
+            core.answer_cache.put(plan["q_vector"], plan["answer_context_key"], answer)
+
+        # Sheets への書き込みはバックグラウンドの SheetLogWriter に積むだけだが、履歴の保存は SQLite の場合がある
+        await asyncio.to_thread(core.finish_chat, user_q, session_id, plan, answer, from_cache)
+        return chat_response(answer, user_q)
+
+    except Exception as e:
+        logger.exception("/chat (asgi) でエラーが発生しました")
+        return JSONResponse({"response": "エラーが発生しました。", "error": str(e)}, status_code=500)
+
+
+async def chat_stream(request):
+    try:
+        user_q, session_id = await read_question(request)
+        if not user_q:
+            return JSONResponse({"error": "質問がありません"}, status_code=400)
+        plan = await prepare_chat_async(user_q, session_id)
+    except Exception as e:
+        logger.exception("/chat/stream (asgi) でエラーが発生しました")
+        return JSONResponse({"response": "エラーが発生しました。", "error": str(e)}, status_code=500)
+
+    async def generate():
+        done = {"response": None, "original_question": user_q, "expanded_question": user_q}
+        if "answer" in plan:
+            done["response"] = plan["answer"]
+            yield core.sse_event({"delta": plan["answer"]}, "delta")
+            yield core.sse_event(done, "done")
+            return
+
+        try:
+            with span("answer_cache"):
+                answer = core.answer_cache.get(plan["q_vector"], plan["answer_context_key"])
+            from_cache = answer is not None
+
+            if from_cache:
+                yield core.sse_event({"delta": answer}, "delta")
+            else:
+                chunks = []
+                async with llm_semaphore:
+                    with span("llm"):
+                        stream = await async_client.chat.completions.create(
+                            model="gpt-4o",
+                            messages=plan["messages"],
+                            temperature=0.2,
+                            stream=True,
+                            stream_options={"include_usage": True},
+                        )
+                        async for chunk in stream:
+                            # usage は choices が空の最後のチャンクで届く
+                            record_usage("gpt-4o", getattr(chunk, "usage", None))
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                chunks.append(delta)
+                                yield core.sse_event({"delta": delta}, "delta")
+                answer = "".join(chunks).strip()
+                core.answer_cache.put(plan["q_vector"], plan["answer_context_key"], answer)
+
+            await asyncio.to_thread(core.finish_chat, user_q, session_id, plan, answer, from_cache)
+            done["response"] = answer
+            yield core.sse_event(done, "done")
+
+        except Exception as e:
+            logger.exception("/chat/stream (asgi) の生成中にエラーが発生しました")
+            yield core.sse_event({"response": "エラーが発生しました。", "error": str(e)}, "error")
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def feedback(request):
+    data = await request.json()
+    question = data.get("question")
+    answer = data.get("answer")
+    feedback_value = data.get("feedback")
+    reason = data.get("reason", "")
+
+    if not all([question, answer, feedback_value]):
+        return JSONResponse({"error": "不完全なフィードバックデータです"}, status_code=400)
+
+    core.append_feedback_log(question, answer, feedback_value, reason)
+    return JSONResponse({"status": "success"})
+
+
+async def admin_reload(request):
+    if not core.has_token(request.headers, core.ADMIN_TOKEN):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    # app.py と同じく、読み込みはバックグラウンドで行い、完了したら次のリクエストから切り替わる
+    # （uvicorn の --workers では受け付けたワーカーだけが即時に切り替わり、他は監視で追随する）
+    threading.Thread(target=core.reload_snapshot, kwargs={"force": True}, daemon=True).start()
+    return JSONResponse({"status": "reloading", "current": core.snapshot.info()}, status_code=202)
+
+
+async def stats(request):
+    if not core.has_token(request.headers, core.METRICS_TOKEN):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return JSONResponse(core.collect_stats())
+
+
+async def metrics(request):
+    if not core.has_token(request.headers, core.METRICS_TOKEN):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+async def home(request):
+    return PlainTextResponse("Chatbot API (ASGI) is running.")
+
+
+class RequestMetricsMiddleware:
+    """
+    リクエストごとに RequestTrace を用意し、応答ヘッダー送信時に所要時間を記録して
+    Server-Timing ヘッダーを付ける（ストリーミングは応答開始までの段階のみ）。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = start_trace()
+        started = time.perf_counter()
+        endpoint = scope["path"] if scope["path"] in ROUTE_PATHS else "other"
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                observe_request(endpoint, message["status"], time.perf_counter() - started)
+                if trace.stages:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # インデックスのホットリロード監視を各ワーカープロセスで開始する
+    core.start_index_watcher()
+    yield
+    core.sheet_logger.close()
+
+
+routes = [
+    Route("/chat", chat, methods=["POST"]),
+    Route("/chat/stream", chat_stream, methods=["POST"]),
+    Route("/feedback", feedback, methods=["POST"]),
+    Route("/admin/reload", admin_reload, methods=["POST"]),
+    Route("/stats", stats, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/", home, methods=["GET"]),
+]
+ROUTE_PATHS = {route.path for route in routes}
+
+app = Starlette(
+    lifespan=lifespan,
+    routes=routes,
+    middleware=[
+        Middleware(RequestMetricsMiddleware),
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    ],
+)
@@ -0,0 +1,268 @@
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# === 設定 ===
+DOCSTORE_PATH = "data/docstore.bin"
+DOCSTORE_VERSION = 2
+DOCSTORE_MAGIC = b"FAQDOCS1"
+
+SOURCES = ("faq", "knowledge")
+_ALIGN = 8
+
+
+# =========================================================
+# 書き出し
+# =========================================================
+#
+# ファイル形式:
+#   MAGIC(8) + ヘッダー長(uint32) + ヘッダー JSON + 配列（8 バイト境界）
+#   ヘッダーには件数・コーパスのハッシュ（回答を含む content_hash も）・カテゴリ名の一覧・各配列の位置を入れる。
+#   配列:
+#     ids         int64[n]    文書 id（コーパスの文書順 = FAQ → knowledge）
+#     sorted_ids  int64[n]    id の昇順（FAISS の id から二分探索で引く）
+#     sorted_pos  int32[n]    sorted_ids の各 id の文書位置
+#     source      uint8[n]    0 = FAQ, 1 = knowledge
+#     category    int32[n]    カテゴリ名の番号（無ければ -1）
+#     offsets     int64[2n+1] blob 内の位置（文書ごとに FAQ は質問・回答、knowledge は本文・空）
+#     blob        uint8[]     UTF-8 の本文
+
+def _encode_fields(corpus):
+    categories = {}
+
+    def category_id(name):
+        if not name:
+            return -1
+        return categories.setdefault(name, len(categories))
+
+    fields, source, category = [], [], []
+    for item in corpus.faq_items:
+        fields += [item["question"], item["answer"]]
+        source.append(0)
+        category.append(category_id(item.get("category")))
+    for name, text in corpus.knowledge_entries:
+        fields += [text, ""]
+        source.append(1)
+        category.append(category_id(name))
+    return fields, source, category, list(categories)
+
+
+def write_doc_store(corpus, path=DOCSTORE_PATH):
+    """コーパスを文書ストアとして書き出す（文書の並びと id は corpus.docs と同じ）"""
+    fields, source, category, categories = _encode_fields(corpus)
+    encoded = [field.encode("utf-8") for field in fields]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    ids = np.array([doc["id"] for doc in corpus.docs], dtype=np.int64)
+    order = np.argsort(ids, kind="stable")
+    arrays = {
+        "ids": ids,
+        "sorted_ids": ids[order],
+        "sorted_pos": order.astype(np.int32),
+        "source": np.array(source, dtype=np.uint8),
+        "category": np.array(category, dtype=np.int32),
+        "offsets": offsets,
+        "blob": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+    }
+
+    # ヘッダー長が決まらないと配列の位置が決まらないため、位置は配列の先頭からの相対値で持つ
+    layout, position = {}, 0
+    for name, array in arrays.items():
+        layout[name] = [position, array.dtype.str, int(array.shape[0])]
+        position += -(-array.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({
+        "version": DOCSTORE_VERSION,
+        "corpus_hash": corpus.hash,
+        "content_hash": corpus.content_hash,
+        "count": len(corpus),
+        "faq_count": len(corpus.faq_items),
+        "categories": categories,
+        "arrays": layout,
+    }, ensure_ascii=False).encode("utf-8")
+    header += b" " * (-(len(DOCSTORE_MAGIC) + 4 + len(header)) % _ALIGN)
+
+    with open(path, "wb") as f:
+        f.write(DOCSTORE_MAGIC + struct.pack("<I", len(header)) + header)
+        for array in arrays.values():
+            data = array.tobytes()
+            f.write(data + b"\0" * (-len(data) % _ALIGN))
+
+
+# =========================================================
+# 読み込み（メモリマップ）
+# =========================================================
+
+class DocStore:
+    """
+    文書ストアの読み取り専用ビュー。
+
+    開いた時点ではヘッダーだけを読み、本体は最初の参照時にメモリマップする。
+    配列はマップ上のビューのため、gunicorn の各ワーカーはページキャッシュを共有し、
+    文字列は参照された文書の分だけデコードする。
+    """
+
+    def __init__(self, path=DOCSTORE_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(DOCSTORE_MAGIC)) != DOCSTORE_MAGIC:
+                raise ValueError(f"文書ストアの形式が不正です: {path}")
+            (header_len,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+        if self.header.get("version") != DOCSTORE_VERSION:
+            raise ValueError(f"文書ストアのバージョンが異なります: {self.header.get('version')}")
+        self._data_start = len(DOCSTORE_MAGIC) + 4 + header_len
+        self.corpus_hash = self.header["corpus_hash"]
+        self.content_hash = self.header.get("content_hash")
+        self.count = self.header["count"]
+        self.faq_count = self.header["faq_count"]
+        self.categories = self.header["categories"]
+        self._arrays = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            mm = np.memmap(self.path, dtype=np.uint8, mode="r")
+            arrays = {}
+            for name, (offset, dtype, length) in self.header["arrays"].items():
+                start = self._data_start + offset
+                dtype = np.dtype(dtype)
+                arrays[name] = mm[start:start + dtype.itemsize * length].view(dtype)
+            self._arrays = arrays
+        return self._arrays
+
+    def position(self, doc_id):
+        """文書 id の位置（無ければ None）"""
+        sorted_ids = self.arrays["sorted_ids"]
+        i = int(np.searchsorted(sorted_ids, doc_id))
+        if i < self.count and sorted_ids[i] == doc_id:
+            return int(self.arrays["sorted_pos"][i])
+        return None
+
+    def field(self, pos, n):
+        offsets = self.arrays["offsets"]
+        start, end = int(offsets[2 * pos + n]), int(offsets[2 * pos + n + 1])
+        return self.arrays["blob"][start:end].tobytes().decode("utf-8")
+
+    def category(self, pos):
+        index = int(self.arrays["category"][pos])
+        return self.categories[index] if index >= 0 else ""
+
+    def doc(self, pos):
+        source = SOURCES[int(self.arrays["source"][pos])]
+        offset = pos if source == "faq" else pos - self.faq_count
+        return {"id": int(self.arrays["ids"][pos]), "source": source, "offset": offset}
+
+
+class _DocsById:
+    """doc_by_id 互換（id → 文書の dict を参照のたびに作る）"""
+
+    def __init__(self, store):
+        self._store = store
+
+    def get(self, doc_id, default=None):
+        pos = self._store.position(doc_id)
+        return default if pos is None else self._store.doc(pos)
+
+    def __getitem__(self, doc_id):
+        doc = self.get(doc_id)
+        if doc is None:
+            raise KeyError(doc_id)
+        return doc
+
+    def __contains__(self, doc_id):
+        return self._store.position(doc_id) is not None
+
+    def __len__(self):
+        return len(self._store)
+
+
+class _FieldView:
+    """faq_questions などのリスト互換（出典内の offset で引く）"""
+
+    def __init__(self, store, start, length, read):
+        self._store = store
+        self._start = start
+        self._length = length
+        self._read = read
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, offset):
+        if isinstance(offset, slice):
+            return [self[i] for i in range(*offset.indices(self._length))]
+        if offset < 0:
+            offset += self._length
+        if not 0 <= offset < self._length:
+            raise IndexError(offset)
+        return self._read(self._start + offset)
+
+    def __iter__(self):
+        return (self[i] for i in range(self._length))
+
+
+class StoredCorpus:
+    """
+    文書ストアを retrieval.Corpus と同じ属性で参照するコーパス（検索・回答生成で使う分のみ）。
+
+    インデックスの再構築には使えない（本文のハッシュなどを持たないため）。
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.hash = store.corpus_hash
+        self.content_hash = store.content_hash
+        self.doc_by_id = _DocsById(store)
+        faq_count = store.faq_count
+        knowledge_count = len(store) - faq_count
+        self.faq_questions = _FieldView(store, 0, faq_count, lambda pos: store.field(pos, 0))
+        self.faq_answers = _FieldView(store, 0, faq_count, lambda pos: store.field(pos, 1))
+        self.knowledge_contents = _FieldView(
+            store, faq_count, knowledge_count, lambda pos: f"{store.category(pos)}：{store.field(pos, 0)}"
+        )
+        self._docs = None
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def docs(self):
+        # 語彙インデックスを作り直す場合などにだけ全件を展開する
+        if self._docs is None:
+            docs = []
+            for pos in range(len(self.store)):
+                doc = self.store.doc(pos)
+                if doc["source"] == "faq":
+                    doc["text"] = self.faq_questions[doc["offset"]]
+                else:
+                    doc["text"] = self.knowledge_contents[doc["offset"]]
+                docs.append(doc)
+            self._docs = docs
+        return self._docs
+
+
+def open_doc_store(path, content_hash):
+    """
+    文書ストアを開く（無い・壊れている・内容のハッシュが異なる場合は None）。
+
+    content_hash は回答・カテゴリを含むコーパス全体のハッシュ（Corpus.content_hash）。
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        store = DocStore(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("⚠️ 文書ストアを読み込めません（JSON から読み込みます）: %s", e)
+        return None
+    if content_hash is None or store.content_hash != content_hash:
+        return None
+    return StoredCorpus(store)
@@ -0,0 +1,293 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_pipeline import EMBED_BATCH_SIZE, embed_in_batches
+
+# === 設定 ===
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "data/embedding_cache.sqlite3")
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))
+# ワーカー間で共有する SQLite 側の質問 Embedding の上限件数（TTL は QUERY_CACHE_TTL と共通）
+QUERY_SHARED_CACHE_SIZE = int(os.getenv("QUERY_SHARED_CACHE_SIZE", "100000"))
+# 共有キャッシュの期限切れ・上限超えの行を削除する間隔（秒）
+QUERY_SHARED_PRUNE_INTERVAL = float(os.getenv("QUERY_SHARED_PRUNE_INTERVAL", "300"))
+
+# 質問末尾の記号は意味を変えないため、クエリキャッシュのキーからは除く
+QUERY_TRAILING_CHARS = "?？!！。．.、 "
+
+
+def normalize_text(text):
+    """
+    キャッシュキー用にテキストを正規化する。
+
+    NFKC で全角・半角の揺れを吸収し、連続する空白を1つにまとめる。
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    return " ".join(text.split())
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def normalize_query(text):
+    """ユーザー質問用の正規化（大文字小文字・末尾の記号の揺れも吸収する）"""
+    return normalize_text(text).lower().rstrip(QUERY_TRAILING_CHARS)
+
+
+class EmbeddingCache:
+    """
+    (モデル名, 正規化テキストのハッシュ) をキーにした永続 Embedding ストア。
+
+    SQLite(WAL) に float32 のバイト列として保存するため、
+    複数プロセス（gunicorn ワーカーや再構築スクリプト）から同時に参照できる。
+    各行には保存時刻（created_at）を持ち、質問用の名前空間は prune で期限・件数を制限する。
+    """
+
+    def __init__(self, path=EMBED_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn_pid = None
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._connect()
+
+    def _connect(self):
+        # fork 後の子プロセスでは親の接続を使わず開き直す
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn_pid = os.getpid()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        # created_at が無い以前のファイルは列を足す（既存の行は 0 = 最も古い扱い）
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")}
+        if "created_at" not in columns:
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (model, created_at)")
+        self._conn.commit()
+
+    def get_many(self, model, texts, max_age=None):
+        """ヒットしたテキストのみ {text_hash: ベクトル} で返す。max_age 秒より古い行は外れ扱い"""
+        keys = list({text_key(t) for t in texts})
+        cutoff = time.time() - max_age if max_age else 0
+        found = {}
+        with self._lock:
+            if self._conn_pid != os.getpid():
+                self._connect()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, dim, vector FROM embeddings"
+                    f" WHERE model = ? AND created_at >= ? AND text_hash IN ({placeholders})",
+                    [model, cutoff, *chunk],
+                ).fetchall()
+                for key, dim, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    if vector.shape[0] == dim:
+                        found[key] = vector
+        return found
+
+    def put_many(self, model, items):
+        """items: (text, ベクトル) のイテラブル"""
+        rows = []
+        now = time.time()
+        for text, vector in items:
+            vector = np.asarray(vector, dtype=np.float32)
+            rows.append((model, text_key(text), int(vector.shape[0]), vector.tobytes(), now))
+        if not rows:
+            return
+        with self._lock:
+            if self._conn_pid != os.getpid():
+                self._connect()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def prune(self, model, max_rows=None, max_age=None):
+        """model の行のうち max_age 秒より古いもの・新しい順に max_rows 件を超えるものを削除し、件数を返す"""
+        with self._lock:
+            if self._conn_pid != os.getpid():
+                self._connect()
+            removed = 0
+            if max_age:
+                removed += self._conn.execute(
+                    "DELETE FROM embeddings WHERE model = ? AND created_at < ?",
+                    (model, time.time() - max_age),
+                ).rowcount
+            if max_rows is not None:
+                removed += self._conn.execute(
+                    "DELETE FROM embeddings WHERE model = ? AND text_hash IN ("
+                    " SELECT text_hash FROM embeddings WHERE model = ?"
+                    " ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (model, model, max_rows),
+                ).rowcount
+            self._conn.commit()
+            return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cached_embed(texts, embed_batch, model, cache=None, batch_size=EMBED_BATCH_SIZE):
+    """
+    キャッシュを優先して texts の Embedding を返す（入力順の float32 行列）。
+
+    キャッシュに無いテキストだけを embed_batch(list[str]) -> list[ベクトル]
+    で並列に取得し、バッチごとにキャッシュへ書き込む（キャッシュが再開用の
+    チェックポイントを兼ねる）。batch_size は 1 リクエストあたりの最大件数。
+    """
+    if cache is None:
+        cache = EmbeddingCache()
+
+    keys = [text_key(t) for t in texts]
+    vectors = cache.get_many(model, texts)
+
+    missing = []
+    seen = set()
+    for text, key in zip(texts, keys):
+        if key not in vectors and key not in seen:
+            seen.add(key)
+            missing.append(text)
+
+    print(f"🗂️ Embeddingキャッシュ: ヒット {len(texts) - len(missing)}件 / 新規取得 {len(missing)}件")
+
+    def store(batch, batch_vectors):
+        cache.put_many(model, zip(batch, batch_vectors))
+        for text, vector in zip(batch, batch_vectors):
+            vectors[text_key(text)] = np.asarray(vector, dtype=np.float32)
+
+    embed_in_batches(missing, embed_batch, store, max_items=batch_size)
+
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.asarray([vectors[key] for key in keys], dtype=np.float32)
+
+
+class QueryEmbeddingCache:
+    """
+    /chat の質問 Embedding 用のプロセス内 LRU + TTL キャッシュ。
+
+    shared に EmbeddingCache を渡すと、プロセス内で外れた場合に SQLite を
+    参照するため、gunicorn の別ワーカーが取得した Embedding も再利用できる。
+    SQLite 側も ttl を過ぎた行は外れとし、store のついでに prune_interval ごとに
+    期限切れの行と shared_max_size を超えた古い行を削除する。
+    """
+
+    def __init__(self, embed_fn, model, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, shared=None,
+                 shared_max_size=QUERY_SHARED_CACHE_SIZE, prune_interval=QUERY_SHARED_PRUNE_INTERVAL):
+        self.embed_fn = embed_fn
+        self.model = model
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared = shared
+        # 正規化で記号を落としたキーのため、文書用の Embedding とは名前空間を分ける
+        self.shared_model = f"{model}#query"
+        self.shared_max_size = shared_max_size
+        self.prune_interval = prune_interval
+        self._pruned_at = None
+        self.shared_pruned = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _get_local(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            vector, stored_at = entry
+            if now - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def _put_local(self, key, vector):
+        with self._lock:
+            self._items[key] = (vector, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def lookup(self, text):
+        """キャッシュだけを参照する（外れたら None。非同期版の呼び出し元が API を自前で呼ぶ用）"""
+        key = normalize_query(text)
+        vector = self._get_local(key)
+        if vector is not None:
+            return vector
+
+        if self.shared is not None:
+            found = self.shared.get_many(self.shared_model, [key], max_age=self.ttl).get(text_key(key))
+            if found is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self._put_local(key, found)
+                return found
+        return None
+
+    def store(self, text, vector):
+        key = normalize_query(text)
+        with self._lock:
+            self.misses += 1
+        self._put_local(key, vector)
+        if self.shared is not None:
+            self.shared.put_many(self.shared_model, [(key, vector)])
+            self._prune_shared()
+
+    def _prune_shared(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._pruned_at is not None and now - self._pruned_at < self.prune_interval:
+                return
+            self._pruned_at = now
+        removed = self.shared.prune(self.shared_model, max_rows=self.shared_max_size, max_age=self.ttl)
+        with self._lock:
+            self.shared_pruned += removed
+
+    def get(self, text):
+        vector = self.lookup(text)
+        if vector is None:
+            vector = self.embed_fn(text)
+            self.store(text, vector)
+        return vector
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.shared_hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "shared_pruned": self.shared_pruned,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.shared_hits) / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,182 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from openai import APIConnectionError, APIStatusError, RateLimitError
+
+from prompt_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# === 設定 ===
+# 1リクエストあたりの上限（トークン数は tiktoken が無い場合は概算のため余裕を持たせる）
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "20000"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# 組織のレート制限（1分あたりのリクエスト数・トークン数）に合わせる
+EMBED_RPM = int(os.getenv("EMBED_RPM", "3000"))
+EMBED_TPM = int(os.getenv("EMBED_TPM", "1000000"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "1.0"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "60.0"))
+
+
+# =========================================================
+# レート制限
+# =========================================================
+
+class RateLimiter:
+    """
+    1分あたりのリクエスト数・トークン数のトークンバケット。
+
+    acquire() は両方の残量が足りるまで待つ。1回分が1分の上限を超える場合は
+    上限まで待てば通す（そのリクエストが API 側で拒否されるかは API に任せる）。
+    """
+
+    def __init__(self, rpm=EMBED_RPM, tpm=EMBED_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait_s = max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+            time.sleep(max(wait_s, 0.01))
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def default_limiter():
+    """プロセス内で共有するリミッター（並行する再構築処理もまとめて制限する）"""
+    global _default_limiter
+    with _default_limiter_lock:
+        if _default_limiter is None:
+            _default_limiter = RateLimiter()
+        return _default_limiter
+
+
+# =========================================================
+# 再試行
+# =========================================================
+
+def _retry_after(error):
+    """429 / 5xx の Retry-After（retry-after-ms を優先）を秒で返す"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers.get(name)) * scale
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def is_retryable(error):
+    if isinstance(error, RateLimitError):
+        # 残高不足・利用上限は待っても解消しない
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+
+def call_with_retry(fn, *args, max_retries=EMBED_MAX_RETRIES, base=EMBED_BACKOFF_BASE, cap=EMBED_BACKOFF_MAX):
+    """
+    一時的なエラーを指数バックオフ（full jitter）で再試行する。
+
+    Retry-After が返された場合はその秒数より短くは待たない。
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(cap, base * 2 ** attempt))
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, cap))
+            logger.warning("Embedding API エラーのため %.1f 秒後に再試行します (%d/%d): %s",
+                           delay, attempt + 1, max_retries, e)
+            time.sleep(delay)
+
+
+# =========================================================
+# バッチ分割と並列取得
+# =========================================================
+
+def pack_batches(texts, max_items=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_TOKENS):
+    """入力順のまま、件数・トークン数の上限に収まるバッチ [(テキストのリスト, トークン数)] に分ける"""
+    batches = []
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+    return batches
+
+
+def embed_in_batches(texts, embed_batch, on_batch, max_items=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_TOKENS,
+                     concurrency=EMBED_CONCURRENCY, limiter=None):
+    """
+    texts の Embedding を並列に取得し、バッチが終わるたびに on_batch(テキスト, ベクトル) を呼ぶ。
+
+    embed_batch(list[str]) -> list[ベクトル] は 1 回の API 呼び出し。on_batch は呼び出し元の
+    スレッドで完了順に呼ばれるため、ここでキャッシュへ保存すれば途中で失敗しても
+    次回は未取得の分だけをやり直せる。失敗したバッチがあれば残りを取り消して例外を送出する。
+    """
+    limiter = limiter or default_limiter()
+    batches = pack_batches(texts, max_items=max_items, max_tokens=max_tokens)
+    if not batches:
+        return
+
+    def run(batch, tokens):
+        limiter.acquire(tokens)
+        vectors = call_with_retry(embed_batch, batch)
+        if len(vectors) != len(batch):
+            raise RuntimeError("Embedding APIの応答件数が入力件数と一致しません。")
+        return batch, vectors
+
+    print(f"📦 Embedding取得: {len(texts)}件を {len(batches)} バッチ・並列数 {concurrency} で取得します")
+    done_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        pending = {executor.submit(run, batch, tokens) for batch, tokens in batches}
+        try:
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    on_batch(*future.result())
+                    done_count += 1
+                    if done_count % 10 == 0 or done_count == len(batches):
+                        print(f"  … {done_count}/{len(batches)} バッチ完了")
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
@@ -0,0 +1,231 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックを使わない
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# === パス設定 ===
+GENERATIONS_DIR = "data/generations"
+# 現在の世代名を1行で書いたファイル（Windows でも使えるよう symlink ではなくファイルにする）
+CURRENT_PATH = "data/CURRENT"
+# 現在の世代を含めて残す世代数（ロールバック用に最低2世代）
+KEEP_GENERATIONS = max(2, int(os.getenv("KEEP_GENERATIONS", "3")))
+# これより古い作成途中のディレクトリは、異常終了したジョブの残骸として削除する
+STALE_TMP_SECONDS = 3600
+
+TMP_PREFIX = ".tmp-"
+# 公開・ロールバック・削除をプロセス間で直列化するロックファイル（GENERATIONS_DIR 内）
+LOCK_FILENAME = ".lock"
+# ロールバックした CURRENT に付ける印。印が付いている間は起動時の自動公開で上書きしない
+PINNED_MARK = "pinned"
+
+# 1世代に含めるファイル（コーパスの JSON とインデックスを必ず同じ世代から読む）
+GENERATION_FILES = {
+    "faq_path": "faq.json",
+    "knowledge_path": "knowledge.json",
+    "index_path": "index.faiss",
+    "vector_path": "vector_data.npy",
+    "manifest_path": "index_manifest.json",
+    "lexical_path": "lexical_index.json",
+    "docstore_path": "docstore.bin",
+}
+
+
+def generation_paths(name, root=GENERATIONS_DIR):
+    directory = os.path.join(root, name)
+    return {key: os.path.join(directory, filename) for key, filename in GENERATION_FILES.items()}
+
+
+def list_generations(root=GENERATIONS_DIR):
+    """公開済みの世代名（古い順）"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name for name in os.listdir(root)
+        if not name.startswith(".") and os.path.isdir(os.path.join(root, name))
+    )
+
+
+def _read_current(current_path):
+    # 1行目が世代名、2行目があればロールバックの印
+    try:
+        with open(current_path, "r", encoding="utf-8") as f:
+            lines = f.read().split()
+    except OSError:
+        return None, False
+    return (lines[0] if lines else None), PINNED_MARK in lines[1:]
+
+
+def current_generation(current_path=CURRENT_PATH, root=GENERATIONS_DIR):
+    """現在の世代名（未公開・指す先が無い場合は None）"""
+    name, _ = _read_current(current_path)
+    if name and os.path.isdir(os.path.join(root, name)):
+        return name
+    return None
+
+
+def is_pinned(current_path=CURRENT_PATH, root=GENERATIONS_DIR):
+    """CURRENT がロールバックで固定されているか（次に公開するまでそのまま使う）"""
+    return current_generation(current_path, root) is not None and _read_current(current_path)[1]
+
+
+# =========================================================
+# プロセス間ロック
+# =========================================================
+
+_held = threading.local()
+
+
+@contextmanager
+def publish_lock(root=GENERATIONS_DIR):
+    """
+    世代の公開・切り替え・削除を行う間、GENERATIONS_DIR/.lock の排他ロックを持つ。
+
+    複数のワーカーが同時に公開しないよう、待っていた側はロックを取ってから状態を確かめ直す。
+    同じスレッド内では入れ子にできる（publish_index から publish を呼ぶため）。
+    """
+    depth = getattr(_held, "depth", 0)
+    if depth or fcntl is None:
+        _held.depth = depth + 1
+        try:
+            yield
+        finally:
+            _held.depth = depth
+        return
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LOCK_FILENAME), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        _held.depth = 1
+        try:
+            yield
+        finally:
+            _held.depth = 0
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# =========================================================
+# 書き込み（fsync してから rename で切り替える）
+# =========================================================
+
+def _fsync_file(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    # ディレクトリの fsync は POSIX のみ（Windows では開けないため省略）
+    if os.name != "posix":
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def set_current(name, current_path=CURRENT_PATH, root=GENERATIONS_DIR, pinned=False):
+    """CURRENT を name に差し替える（読み手は切り替え前後どちらかの完全な世代を見る）"""
+    if not os.path.isdir(os.path.join(root, name)):
+        raise FileNotFoundError(f"世代がありません: {name}")
+    tmp_path = f"{current_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name + "\n" + (PINNED_MARK + "\n" if pinned else ""))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, current_path)
+    _fsync_dir(os.path.dirname(current_path))
+
+
+def _new_name(label, root):
+    # 名前の順が作成順になるよう、ミリ秒まで含める
+    base = datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3] + (f"-{label}" if label else "")
+    name, n = base, 1
+    while os.path.exists(os.path.join(root, name)) or os.path.exists(os.path.join(root, TMP_PREFIX + name)):
+        n += 1
+        name = f"{base}-{n}"
+    return name
+
+
+def publish(write, label="", root=GENERATIONS_DIR, current_path=CURRENT_PATH, keep=KEEP_GENERATIONS):
+    """
+    新しい世代を作って公開し、世代名を返す。
+
+    write(paths) に一時ディレクトリ内のパス（GENERATION_FILES のキー）を渡して全ファイルを
+    書かせ、fsync・ディレクトリの rename・CURRENT の差し替えの順に行う。途中で失敗した場合は
+    一時ディレクトリを消し、CURRENT は前の世代のまま変わらない。
+    公開した世代はロールバックの固定を解除する。全体を publish_lock の中で行う。
+    """
+    with publish_lock(root):
+        name = _new_name(label, root)
+        tmp_dir = os.path.join(root, TMP_PREFIX + name)
+        os.makedirs(tmp_dir)
+        try:
+            write(generation_paths(TMP_PREFIX + name, root))
+            for filename in os.listdir(tmp_dir):
+                _fsync_file(os.path.join(tmp_dir, filename))
+            _fsync_dir(tmp_dir)
+            os.rename(tmp_dir, os.path.join(root, name))
+            _fsync_dir(root)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        set_current(name, current_path, root)
+        prune(keep, root, current_path)
+    return name
+
+
+def rollback(to=None, root=GENERATIONS_DIR, current_path=CURRENT_PATH):
+    """
+    CURRENT を1つ前（または to）の世代に戻し、その世代名を返す。
+
+    戻した世代は固定し、data/ のコーパスと異なっていても起動時に新しい世代を公開しない
+    （固定は次に publish_index などで明示的に公開したときに外れる）。
+    """
+    with publish_lock(root):
+        if to is None:
+            names = list_generations(root)
+            current = current_generation(current_path, root)
+            older = [name for name in names if current is None or name < current]
+            if not older:
+                raise RuntimeError("戻せる世代がありません。")
+            to = older[-1]
+        set_current(to, current_path, root, pinned=True)
+    return to
+
+
+def prune(keep=KEEP_GENERATIONS, root=GENERATIONS_DIR, current_path=CURRENT_PATH):
+    """
+    新しい順に keep 世代を残して削除し、削除した世代名を返す（現在の世代は必ず残す）。
+
+    メモリマップ中の読み手がいても POSIX ではファイルの実体は閉じるまで残る。
+    削除できなかった世代（Windows で使用中など）は次回に回す。
+    """
+    keep = max(2, keep)
+    with publish_lock(root):
+        current = current_generation(current_path, root)
+        names = list_generations(root)
+        removed = []
+        for name in names[:-keep]:
+            if name == current:
+                continue
+            try:
+                shutil.rmtree(os.path.join(root, name))
+                removed.append(name)
+            except OSError as e:
+                logger.warning("⚠️ 世代 %s を削除できませんでした: %s", name, e)
+
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.startswith(TMP_PREFIX) and time.time() - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+    return removed
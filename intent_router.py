@@ -0,0 +1,149 @@
+import os
+import threading
+
+from embedding_cache import normalize_query
+from keyword_filter import extract_keyword_spans
+
+# === 設定 ===
+# FAQ の質問とのコサイン類似度がこれ以上で、次点の別回答 FAQ との差が十分なら FAQ の回答をそのまま返す
+ROUTE_FAQ_SCORE = float(os.getenv("ROUTE_FAQ_SCORE", "0.92"))
+ROUTE_FAQ_MARGIN = float(os.getenv("ROUTE_FAQ_MARGIN", "0.05"))
+# マトリクス回答は、FAQ の最上位スコアがこれ未満のときだけ使う（FAQ で答えるべき質問を奪わない）
+ROUTE_MATRIX_MAX_FAQ_SCORE = float(os.getenv("ROUTE_MATRIX_MAX_FAQ_SCORE", "0.60"))
+
+# マッチ種別ごとに、質問がその表の内容を尋ねていると判断できる語
+MATRIX_INTENT_WORDS = {
+    "product_to_films": ["フィルム", "包材"],
+    "product_film_to_colors": ["色", "カラー"],
+    "film_to_products": ["製品", "商品", "タイプ"],
+    "color_to_products": ["製品", "商品", "タイプ"],
+    "color_to_film_colors": ["フィルム", "包材"],
+    "color_to_films": ["フィルム", "包材"],
+}
+# これらを含む質問は価格・納期など表にない情報を求めているため LLM に回す
+MATRIX_EXCLUDE_WORDS = ["価格", "値段", "料金", "費用", "見積", "納期", "ロット", "違い", "おすすめ", "デザイン", "入稿"]
+
+MATRIX_TEMPLATES = {
+    "product_to_films": "「{product}」では、次のフィルムをお選びいただけます。\n{films}",
+    "product_film_to_colors": "「{product}」の「{film}」では、次の印刷色をお選びいただけます。\n{colors}",
+    "film_to_products": "「{film}」は、次の製品でご利用いただけます。\n{products}",
+    "color_to_products": "印刷色「{color}」は、次の製品でお選びいただけます。\n{products}",
+    "color_to_film_colors": "印刷色「{color}」に対応可能なフィルムは次のとおりです（製品問わず）。\n{film_colors}",
+    "color_to_films": "印刷色「{color}」に対応可能なフィルムは次のとおりです。\n{films}",
+}
+MATRIX_FOOTER = "\n\n詳しい仕様やお見積りについては、お問い合わせフォームよりお気軽にご相談ください。"
+
+
+def asked_colors(user_q):
+    """
+    質問で尋ねられている印刷色。「黒光沢フィルム」の「黒」のように、
+    製品名・フィルム名の一部として現れた色は含めない。
+    """
+    spans = extract_keyword_spans(user_q)
+    names = [(start, end) for category, _, start, end in spans if category != "color"]
+    return {
+        word for category, word, start, end in spans
+        if category == "color" and not any(s <= start and end <= e for s, e in names)
+    }
+
+
+def _covered_colors(film_match_data):
+    # 定型文に含まれる色（色の一覧、または色で引いた場合の検索語）
+    covered = set(film_match_data.get("colors") or [])
+    if film_match_data.get("color"):
+        covered.update(c.strip() for c in film_match_data["color"].split(","))
+    return covered
+
+
+class IntentRouter:
+    """
+    LLM を呼ぶ前の振り分け。
+
+    - FAQ の質問と正規化後に完全一致 → その回答（route: FAQ-Exact）
+    - FAQ との類似度が十分高く、次点と紛れない → その回答（route: FAQ-Local）
+    - 製品・フィルム・色マトリクスだけで答えられる質問 → 定型文（route: ProductFilm-Local）
+    どれにも当たらなければ None を返し、通常どおり gpt-4o で回答する。
+    """
+
+    def __init__(self, faq_score=ROUTE_FAQ_SCORE, faq_margin=ROUTE_FAQ_MARGIN,
+                 matrix_max_faq_score=ROUTE_MATRIX_MAX_FAQ_SCORE):
+        self.faq_score = faq_score
+        self.faq_margin = faq_margin
+        self.matrix_max_faq_score = matrix_max_faq_score
+        self._exact_hash = None
+        self._exact = {}
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def _exact_index(self, corpus):
+        # 完全一致用の表はコーパスが差し替わったときだけ作り直す（並び替えで offset が変わる場合も含む）
+        with self._lock:
+            if self._exact_hash != corpus.content_hash:
+                self._exact = {}
+                for offset, question in enumerate(corpus.faq_questions):
+                    self._exact.setdefault(normalize_query(question), offset)
+                self._exact_hash = corpus.content_hash
+            return self._exact
+
+    def _route_faq(self, user_q, snap, hits):
+        corpus = snap.corpus
+        offset = self._exact_index(corpus).get(normalize_query(user_q))
+        if offset is not None:
+            return "FAQ-Exact", corpus.faq_answers[offset]
+
+        faq_hits = [(doc, score) for doc, score in hits if doc["source"] == "faq"]
+        if not faq_hits or faq_hits[0][1] < self.faq_score:
+            return None
+        top_doc, top_score = faq_hits[0]
+        answer = corpus.faq_answers[top_doc["offset"]]
+        for doc, score in faq_hits[1:]:
+            if corpus.faq_answers[doc["offset"]] != answer and top_score - score < self.faq_margin:
+                return None
+        return "FAQ-Local", answer
+
+    def _route_matrix(self, user_q, hits, film_match_data):
+        if not isinstance(film_match_data, dict) or not film_match_data.get("matched"):
+            return None
+        template = MATRIX_TEMPLATES.get(film_match_data.get("type"))
+        if not template:
+            return None
+        if not any(word in user_q for word in MATRIX_INTENT_WORDS[film_match_data["type"]]):
+            return None
+        if any(word in user_q for word in MATRIX_EXCLUDE_WORDS):
+            return None
+        faq_scores = [score for doc, score in hits if doc["source"] == "faq"]
+        if faq_scores and faq_scores[0] >= self.matrix_max_faq_score:
+            return None
+        # 一覧が空の組み合わせ（フィルムの登録が無い製品など）は定型文にできないため LLM に回す
+        if any(isinstance(value, list) and not value for value in film_match_data.values()):
+            return None
+        # 尋ねられた色を定型文が扱っていない（「黒光沢フィルムで青色が使える製品は？」に
+        # 黒光沢フィルムの製品一覧を返すなど）場合は、誤った答えになるため LLM に回す
+        if not asked_colors(user_q) <= _covered_colors(film_match_data):
+            return None
+
+        values = {
+            key: "、".join(value) if isinstance(value, list) else value
+            for key, value in film_match_data.items()
+        }
+        return "ProductFilm-Local", template.format(**values) + MATRIX_FOOTER
+
+    def route(self, user_q, snap, hits, film_match_data):
+        """(route 名, 回答) を返す。LLM に回すべきときは None"""
+        routed = self._route_faq(user_q, snap, hits) or self._route_matrix(user_q, hits, film_match_data)
+        route_name = routed[0] if routed else "LLM"
+        with self._lock:
+            self.counts[route_name] = self.counts.get(route_name, 0) + 1
+        return routed
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        local = total - counts.get("LLM", 0)
+        return {
+            "routes": counts,
+            "local_rate": round(local / total, 4) if total else 0.0,
+            "faq_score": self.faq_score,
+            "faq_margin": self.faq_margin,
+        }
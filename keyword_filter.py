@@ -1,47 +1,189 @@
+import json
+import logging
+import os
 import re
+from collections import deque
 
-def extract_keywords(text):
-    # 正規化マッピング
-    normalize_map = {
-        "シルバ": "シルバー",
-        "金": "ゴールド",
-        "銀": "シルバー",
-        "白色": "白",
-        "黒色": "黒",
-        "赤色": "赤",
-        "青色": "青",
-        "茶色": "茶",
-        "金色": "ゴールド",
-        "銀色": "シルバー"
+logger = logging.getLogger(__name__)
+
+# 正規化マッピング（すべて統一表記に変換）
+NORMALIZE_MAP = {
+    "シルバ": "シルバー",
+    "金": "ゴールド",
+    "銀": "シルバー",
+    "白色": "白",
+    "黒色": "黒",
+    "赤色": "赤",
+    "青色": "青",
+    "茶色": "茶",
+    "金色": "ゴールド",
+    "銀色": "シルバー"
+}
+
+# キーワード定義
+COLOR_KEYWORDS = ["黒", "青", "赤", "茶", "白", "シルバー", "ゴールド"]
+PRODUCT_KEYWORDS = ["X型", "X増量タイプ", "VFR型", "VFR増量タイプ", "ディップスタイル", "個包装コーヒーバッグ"]
+FILM_KEYWORDS = [
+    "白光沢フィルム", "白マットフィルム", "黒光沢フィルム", "黒マットフィルム", "赤フィルム",
+    "クラフト包材", "紙リサイクルマーク付き包材", "ハイバリア特殊紙"
+]
+
+# 起動時のカレントディレクトリによらず、このファイルの隣の data/ から読む
+MATRIX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "product_film_color_matrix.json")
+
+
+def _strip_note(name):
+    # 「ディップスタイル(DipStyle)」→「ディップスタイル」のように括弧書きを除いた呼び名
+    return re.sub(r"[(（].*?[)）]$", "", name).strip()
+
+
+def load_matrix_vocabulary(json_path=MATRIX_PATH):
+    """製品・フィルム・色のマトリクスから語彙を取り出す（括弧書きを除いた呼び名も含む）"""
+    vocab = {"product": [], "film": [], "color": []}
+    if not os.path.exists(json_path):
+        return vocab
+    with open(json_path, "r", encoding="utf-8") as f:
+        matrix = json.load(f)
+    for product, films in matrix.items():
+        vocab["product"] += [product, _strip_note(product)]
+        for film, colors in films.items():
+            vocab["film"] += [film, _strip_note(film)]
+            vocab["color"] += colors
+    return vocab
+
+
+class KeywordAutomaton:
+    """
+    正規化とキーワード抽出を1パスで行う Aho-Corasick オートマトン。
+
+    語彙は構築時に一度だけコンパイルし、extract() はテキスト長に比例する時間で
+    重なりを含むすべての一致を返す（「白光沢フィルム」からはフィルムと色「白」の両方）。
+    """
+
+    def __init__(self, vocabulary, normalize_map=None):
+        self.categories = list(vocabulary)
+        # カテゴリごとの語順（extract_keywords の結果順を語彙定義順にそろえる）
+        self.order = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for category, words in vocabulary.items():
+            for word in words:
+                if not word or (category, word) in self.order:
+                    continue
+                self.order[(category, word)] = len(self.order)
+                self._add(word, (category, word))
+        self._build_fail_links()
+
+        # 正規化は最長一致優先の単一正規表現で1回だけ置換する
+        normalize_map = dict(normalize_map or {})
+        # 正規化後の表記自身は置換しない（「シルバー」が「シルバーー」にならないように）
+        for target in set(normalize_map.values()):
+            normalize_map.setdefault(target, target)
+        self._normalize_map = normalize_map
+        self._normalize_re = re.compile(
+            "|".join(re.escape(k) for k in sorted(normalize_map, key=len, reverse=True))
+        ) if normalize_map else None
+
+    def _add(self, word, output):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(output)
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def normalize(self, text):
+        """
+        正規化したテキストと、正規化後の各文字に対応する元テキスト上の (開始, 終了) を返す。
+        """
+        if not self._normalize_re:
+            return text, [(i, i + 1) for i in range(len(text))]
+        pieces = []
+        sources = []
+        last = 0
+        for m in self._normalize_re.finditer(text):
+            pieces.append(text[last:m.start()])
+            sources.extend((i, i + 1) for i in range(last, m.start()))
+            replacement = self._normalize_map[m.group(0)]
+            pieces.append(replacement)
+            sources.extend([(m.start(), m.end())] * len(replacement))
+            last = m.end()
+        pieces.append(text[last:])
+        sources.extend((i, i + 1) for i in range(last, len(text)))
+        return "".join(pieces), sources
+
+    def extract(self, text):
+        """
+        (カテゴリ, キーワード, 開始位置, 終了位置) のリストを返す。
+        位置は元の（正規化前の）テキスト上のもの。
+        """
+        normalized, sources = self.normalize(text)
+        matches = []
+        node = 0
+        for i, ch in enumerate(normalized):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for category, word in self._out[node]:
+                start = sources[i - len(word) + 1][0]
+                matches.append((category, word, start, sources[i][1]))
+        return matches
+
+
+def _default_vocabulary():
+    # マトリクス由来の語で、固定リストだけの頃は拾わなかった「水出しコーヒー」なども抽出する
+    # （変更前の出力との差分は scripts/matcher_regression.py で確認する）
+    matrix_vocab = load_matrix_vocabulary()
+    return {
+        "product": PRODUCT_KEYWORDS + matrix_vocab["product"],
+        "film": FILM_KEYWORDS + matrix_vocab["film"],
+        "color": COLOR_KEYWORDS + matrix_vocab["color"],
     }
 
-    # 正規化処理（すべて統一表記に変換）
-    for k, v in normalize_map.items():
-        text = text.replace(k, v)
 
-    # キーワード定義
-    color_keywords = ["黒", "青", "赤", "茶", "白", "シルバー", "ゴールド"]
-    product_keywords = ["X型", "X増量タイプ", "VFR型", "VFR増量タイプ", "ディップスタイル", "個包装コーヒーバッグ"]
-    film_keywords = [
-        "白光沢フィルム", "白マットフィルム", "黒光沢フィルム", "黒マットフィルム", "赤フィルム",
-        "クラフト包材", "紙リサイクルマーク付き包材", "ハイバリア特殊紙"
-    ]
+# インポート時に一度だけコンパイルする
+_automaton = KeywordAutomaton(_default_vocabulary(), NORMALIZE_MAP)
 
-    result = {"product": [], "film": [], "color": []}
 
-    # キーワード検出（完全一致ではなく正規表現で柔軟に）
-    for word in product_keywords:
-        if re.search(re.escape(word), text):
-            result["product"].append(word)
+def extract_keyword_spans(text):
+    return _automaton.extract(text)
+
 
-    for word in film_keywords:
-        if re.search(re.escape(word), text):
-            result["film"].append(word)
+def extract_keywords(text):
+    result = {"product": [], "film": [], "color": []}
 
-    for word in color_keywords:
-        if re.search(re.escape(word), text):
-            result["color"].append(word)
+    matches = _automaton.extract(text)
+    # 「ディップスタイル(DipStyle)」の1回の言及から括弧書きを除いた呼び名も見つかるため、
+    # 正式名の範囲内にある呼び名は正式名1つにまとめる（呼び名だけの言及はそのまま残す）
+    found = {
+        (category, word) for category, word, start, end in matches
+        if not any(
+            other_category == category and other != word and _strip_note(other) == word
+            and other_start <= start and end <= other_end
+            for other_category, other, other_start, other_end in matches
+        )
+    }
+    for category, word in sorted(found, key=_automaton.order.get):
+        result[category].append(word)
 
-    print("🟡 抽出結果:", result)  # デバッグログ
+    logger.debug("抽出結果: %s", result)
 
     return result
@@ -0,0 +1,126 @@
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+from embedding_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_PATH = "data/lexical_index.json"
+LEXICAL_VERSION = 2
+
+# 日本語は分かち書きせず、文字 n-gram を語として扱う
+NGRAM_SIZES = (2, 3)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SPLIT_RE = re.compile(r"[\s、。，．,.!?！？「」『』（）()【】\[\]・:：/／]+")
+# ひらがなだけの n-gram（助詞・「ですか」などの文末表現）は語として数えない
+_HIRAGANA_ONLY_RE = re.compile(r"^[\u3041-\u309fー]+$")
+
+
+def tokenize(text):
+    """正規化したテキストを区切り記号で分け、各区間の文字 n-gram を返す（短い区間はそのまま1語）"""
+    tokens = []
+    for chunk in _SPLIT_RE.split(normalize_text(text).lower()):
+        if not chunk:
+            continue
+        if len(chunk) < min(NGRAM_SIZES):
+            grams = [chunk]
+        else:
+            grams = [chunk[i:i + n] for n in NGRAM_SIZES for i in range(len(chunk) - n + 1)]
+        tokens.extend(gram for gram in grams if not _HIRAGANA_ONLY_RE.match(gram))
+    return tokens
+
+
+def lexical_text(corpus, doc):
+    """語彙検索の対象テキスト（FAQ は回答中の製品名なども拾えるよう質問と回答の両方）"""
+    if doc["source"] == "faq":
+        return f"{doc['text']}\n{corpus.faq_answers[doc['offset']]}"
+    return doc["text"]
+
+
+class LexicalIndex:
+    """
+    文字 n-gram の BM25 転置インデックス。
+
+    Embedding を使わずに手元だけで検索できるため、製品名などの完全一致に強く、
+    Embedding API が遅い・落ちている場合の代替経路にもなる。
+    """
+
+    def __init__(self, doc_ids, doc_lens, postings, content_hash):
+        self.doc_ids = doc_ids
+        self.doc_lens = doc_lens
+        self.postings = postings
+        # FAQ の回答も索引に入るため、回答を含むコーパス全体のハッシュ（Corpus.content_hash）で整合を確かめる
+        self.content_hash = content_hash
+        self.avgdl = (sum(doc_lens) / len(doc_lens)) if doc_lens else 0.0
+        n = len(doc_ids)
+        self.idf = {
+            term: math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for term, posting in postings.items()
+        }
+
+    @classmethod
+    def build(cls, corpus):
+        doc_ids = []
+        doc_lens = []
+        postings = {}
+        for pos, doc in enumerate(corpus.docs):
+            tokens = tokenize(lexical_text(corpus, doc))
+            doc_ids.append(doc["id"])
+            doc_lens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append([pos, tf])
+        return cls(doc_ids, doc_lens, postings, corpus.content_hash)
+
+    def search(self, query, k):
+        """(文書 id, BM25 スコア) をスコア順に最大 k 件返す"""
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf[term]
+            for pos, tf in posting:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens[pos] / self.avgdl)
+                scores[pos] = scores.get(pos, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.doc_ids[pos], score) for pos, score in ranked]
+
+    def to_dict(self):
+        return {
+            "version": LEXICAL_VERSION,
+            "content_hash": self.content_hash,
+            "ngram_sizes": list(NGRAM_SIZES),
+            "doc_ids": self.doc_ids,
+            "doc_lens": self.doc_lens,
+            "postings": self.postings,
+        }
+
+
+def save_lexical_index(lexical, path=LEXICAL_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(lexical.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_lexical_index(corpus, path=LEXICAL_PATH):
+    """
+    保存済みの語彙インデックスを読み込む。
+
+    無い・コーパスと一致しない場合はその場で作る（手元の計算だけなので数十ミリ秒で済む）。
+    """
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if (
+            data.get("version") == LEXICAL_VERSION
+            and data.get("content_hash") == corpus.content_hash
+            and tuple(data.get("ngram_sizes", [])) == NGRAM_SIZES
+        ):
+            return LexicalIndex(data["doc_ids"], data["doc_lens"], data["postings"], data["content_hash"])
+        logger.warning("⚠️ 語彙インデックスがコーパスと一致しないため、メモリ上で作り直します。")
+    return LexicalIndex.build(corpus)
@@ -0,0 +1,257 @@
+import contextlib
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+# === 設定 ===
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text / json
+# 呼び出しごとに INFO を出すライブラリ（LOG_LEVEL=DEBUG のときだけそのまま出す）
+QUIET_LOGGERS = ("httpx", "httpcore", "openai")
+
+# 秒単位のヒストグラムの区切り（埋め込み数十 ms 〜 LLM 数十秒まで）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# =========================================================
+# ログ
+# =========================================================
+
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1 JSON で出力する（extra= で渡した項目もそのままキーになる）"""
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """ルートロガーを設定する（gunicorn などが先に設定済みならハンドラーは追加しない）"""
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    # API 呼び出しごとの INFO ログ（HTTP Request: POST ...）は出さない
+    if root.level > logging.DEBUG:
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root.addHandler(handler)
+
+
+# =========================================================
+# メトリクス（Prometheus のテキスト形式で出力する）
+# =========================================================
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    プロセス内のメトリクス一覧。
+
+    gunicorn の複数ワーカーではワーカーごとの値になるため、
+    Prometheus 側でインスタンス（ワーカー）ごとに集計する前提。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """出力時に呼ぶ関数を登録する。{コンポーネント名: {項目: 数値 or {ラベル値: 数値}}} を返すこと"""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for collect in self._collectors:
+            try:
+                lines += _render_stats(collect())
+            except Exception:
+                logging.getLogger(__name__).exception("メトリクスの収集に失敗しました")
+        return "\n".join(lines) + "\n"
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _render_stats(stats):
+    # 各コンポーネントの stats() を chatbot_<コンポーネント>_<項目> のゲージとして出す
+    lines = []
+    for component, values in stats.items():
+        for key, value in values.items():
+            name = f"chatbot_{component}_{key}"
+            if _is_number(value):
+                lines += [f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+            elif isinstance(value, dict) and value and all(_is_number(v) for v in value.values()):
+                lines.append(f"# TYPE {name} gauge")
+                lines += [f"{name}{_format_labels(('key',), (label,))} {_format_value(v)}" for label, v in sorted(value.items())]
+    return lines
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("chatbot_stage_seconds", "チャット処理の段階別所要時間（秒）", ["stage"])
+REQUEST_SECONDS = REGISTRY.histogram(
+    "chatbot_request_seconds", "応答ヘッダー送信までの所要時間（秒、ストリーミングは最初の応答まで）", ["endpoint"]
+)
+REQUESTS_TOTAL = REGISTRY.counter("chatbot_requests_total", "リクエスト数", ["endpoint", "status"])
+TOKENS_TOTAL = REGISTRY.counter("chatbot_openai_tokens_total", "OpenAI API の usage によるトークン数", ["model", "kind"])
+
+
+# =========================================================
+# リクエスト内の段階別計測
+# =========================================================
+
+class RequestTrace:
+    """1リクエスト内の段階別所要時間（同じ段階が複数回あれば合計する）"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def stages_ms(self):
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()}
+
+    def server_timing(self):
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.stages_ms().items())
+
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def start_trace():
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def span(stage):
+    """段階の所要時間をヒストグラムと現在のリクエストの RequestTrace に記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+def observe_request(endpoint, status, seconds):
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+    REQUESTS_TOTAL.inc(endpoint=endpoint, status=status)
+
+
+def record_usage(model, usage):
+    """OpenAI レスポンスの usage（無ければ何もしない）をトークン数のカウンターに足す"""
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value:
+            TOKENS_TOTAL.inc(value, model=model, kind=kind.replace("_tokens", ""))
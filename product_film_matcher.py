@@ -1,13 +1,72 @@
 import json
+import logging
+import re
 from keyword_filter import extract_keywords
 
+logger = logging.getLogger(__name__)
+
 class ProductFilmMatcher:
     def __init__(self, json_path="data/product_film_color_matrix.json"):
         with open(json_path, "r", encoding="utf-8") as f:
             self.data = json.load(f)
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """
+        マトリクスを逆引きインデックスに変換する（構築時に一度だけ）。
+
+        film → 製品, 色 → フィルム, 色 → 製品, (製品, フィルム) → 色 の辞書と、
+        部分文字列 → フィルム／製品、別名（括弧書きを除いた呼び名）→ 製品の表も作る。
+        """
+        self.film_to_products = {}
+        self.color_to_films = {}
+        self.color_to_products = {}
+        self.product_film_colors = {}
+        for product, films in self.data.items():
+            for film, colors in films.items():
+                self.film_to_products.setdefault(film, []).append(product)
+                self.product_film_colors[(product, film)] = colors
+                for color in colors:
+                    film_list = self.color_to_films.setdefault(color, [])
+                    if film not in film_list:
+                        film_list.append(film)
+                    product_list = self.color_to_products.setdefault(color, [])
+                    if product not in product_list:
+                        product_list.append(product)
+
+        # 製品名の別名（「ディップスタイル(DipStyle)」→「ディップスタイル」）
+        self.product_aliases = {}
+        for product in self.data:
+            self.product_aliases.setdefault(product, product)
+            alias = re.sub(r"[(（].*?[)）]$", "", product).strip()
+            if alias and alias != product:
+                self.product_aliases.setdefault(alias, product)
+
+        # 部分文字列 → それを含む名前（マトリクス上の順）
+        self.product_substrings = self._substring_index(self.data)
+        self.film_substrings = self._substring_index(self.film_to_products)
+
+    @staticmethod
+    def _substring_index(names):
+        index = {}
+        for name in names:
+            substrings = {name[i:j] for i in range(len(name) + 1) for j in range(i, len(name) + 1)}
+            for sub in substrings:
+                index.setdefault(sub, []).append(name)
+        return {sub: tuple(matched) for sub, matched in index.items()}
+
+    def _product_in_name(self, product_name):
+        # 入力文字列に含まれる最初の製品（別名も可）
+        return next((product for alias, product in self.product_aliases.items() if alias in product_name), None)
+
+    def _products_containing(self, product_name):
+        return self.product_substrings.get(product_name, ())
+
+    def _films_containing(self, film_name):
+        return self.film_substrings.get(film_name, ())
 
     def get_films_for_product(self, product_name):
-        product = next((p for p in self.data if p in product_name), None)
+        product = self._product_in_name(product_name)
         if not product:
             return {"matched": False, "type": "product_to_films", "message": "該当する製品種が見つかりませんでした。"}
         films = list(self.data[product].keys())
@@ -19,24 +78,24 @@ class ProductFilmMatcher:
         }
 
     def get_colors_for_film_in_product(self, product_name, film_name):
-        for product, films in self.data.items():
-            if product_name in product:
-                for film, colors in films.items():
-                    if film_name in film:
-                        return {
-                            "matched": True,
-                            "type": "product_film_to_colors",
-                            "product": product,
-                            "film": film,
-                            "colors": colors
-                        }
+        candidates = set(self._films_containing(film_name))
+        for product in self._products_containing(product_name):
+            # 複数のフィルムが該当する場合は、その製品のマトリクス上の順で最初のもの
+            for film, colors in self.data[product].items():
+                if film in candidates:
+                    return {
+                        "matched": True,
+                        "type": "product_film_to_colors",
+                        "product": product,
+                        "film": film,
+                        "colors": colors
+                    }
         return {"matched": False, "type": "product_film_to_colors", "message": "該当する製品とフィルムの組み合わせが見つかりませんでした。"}
 
     def get_products_for_film(self, film_name):
-        matched_products = []
-        for product, films in self.data.items():
-            if any(film_name in film for film in films):
-                matched_products.append(product)
+        matched = {product for film in self._films_containing(film_name) for product in self.film_to_products[film]}
+        # 製品はマトリクス上の順で返す
+        matched_products = [product for product in self.data if product in matched]
         if matched_products:
             return {
                 "matched": True,
@@ -46,55 +105,51 @@ class ProductFilmMatcher:
             }
         return {"matched": False, "type": "film_to_products", "message": "該当するフィルムに対応する製品が見つかりませんでした。"}
 
+    def _lookup_by_colors(self, index, color_names):
+        matched = []
+        for color in color_names:
+            for item in index.get(color, []):
+                if item not in matched:
+                    matched.append(item)
+        return matched
+
     def get_films_for_color(self, color_names):
-        matched = set()
-        for product, films in self.data.items():
-            for film, colors in films.items():
-                if any(c in colors for c in color_names):
-                    matched.add(film)
+        matched = self._lookup_by_colors(self.color_to_films, color_names)
         if matched:
             return {
                 "matched": True,
                 "type": "color_to_films",
                 "color": ", ".join(color_names),
-                "films": list(matched)
+                "films": matched
             }
         return {"matched": False, "type": "color_to_films", "message": "該当する印刷色が見つかりませんでした。"}
 
     def get_products_for_color(self, color_names):
-        matched_products = set()
-        for product, films in self.data.items():
-            for colors in films.values():
-                if any(c in colors for c in color_names):
-                    matched_products.add(product)
+        matched_products = self._lookup_by_colors(self.color_to_products, color_names)
         if matched_products:
             return {
                 "matched": True,
                 "type": "color_to_products",
                 "color": ", ".join(color_names),
-                "products": list(matched_products)
+                "products": matched_products
             }
         return {"matched": False, "type": "color_to_products", "message": "該当する印刷色に対応する製品が見つかりませんでした。"}
 
     def get_film_colors_for_color(self, color_names):
-        matched_colors = set()
-        for product, films in self.data.items():
-            for film, colors in films.items():
-                if any(c in colors for c in color_names):
-                    matched_colors.add(film)
+        matched_colors = self._lookup_by_colors(self.color_to_films, color_names)
         if matched_colors:
             return {
                 "matched": True,
                 "type": "color_to_film_colors",
                 "color": ", ".join(color_names),
-                "film_colors": list(matched_colors)
+                "film_colors": matched_colors
             }
         return {"matched": False, "type": "color_to_film_colors", "message": "印刷色に対応するフィルム色が見つかりませんでした。"}
 
     def match(self, user_input, history=None):
         try:
             keywords = extract_keywords(user_input)
-            print("🔍 extract_keywords:", keywords)
+            logger.debug("extract_keywords: %s", keywords)
 
             if not isinstance(keywords, dict):
                 return {"matched": False, "type": "no_match", "message": "キーワード抽出でエラーが発生しました。"}
@@ -112,7 +167,7 @@ class ProductFilmMatcher:
                     for f in films:
                         info = self.get_colors_for_film_in_product(p, f)
                         if info["matched"] and any(c in info.get("colors", []) for c in colors):
-                            print(f"✅ match type: {info['type']}")
+                            logger.debug("match type: %s", info["type"])
                             return info
 
             if products and films:
@@ -120,21 +175,21 @@ class ProductFilmMatcher:
                     for f in films:
                         info = self.get_colors_for_film_in_product(p, f)
                         if info["matched"]:
-                            print(f"✅ match type: {info['type']}")
+                            logger.debug("match type: %s", info["type"])
                             return info
 
             if products:
                 for p in products:
                     result = self.get_films_for_product(p)
                     if result["matched"]:
-                        print(f"✅ match type: {result['type']}")
+                        logger.debug("match type: %s", result["type"])
                         return result
 
             if films:
                 for f in films:
                     result = self.get_products_for_film(f)
                     if result["matched"]:
-                        print(f"✅ match type: {result['type']}")
+                        logger.debug("match type: %s", result["type"])
                         return result
 
             if colors:
@@ -145,14 +200,14 @@ class ProductFilmMatcher:
                 ]:
                     result = getter(colors)
                     if result["matched"]:
-                        print(f"✅ match type: {result['type']}")
+                        logger.debug("match type: %s", result["type"])
                         return result
 
-            print("⚠️ No match found")
+            logger.debug("No match found")
             return {"matched": False, "type": "no_match", "message": "製品・フィルム・色のいずれも該当する情報が見つかりませんでした。"}
 
         except Exception as e:
-            print("❌ match error:", e)
+            logger.exception("match error")
             return {"matched": False, "type": "error", "message": f"マッチ処理中にエラーが発生しました：{str(e)}"}
 
     def format_match_info(self, info, fallback=False):
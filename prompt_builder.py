@@ -0,0 +1,170 @@
+import logging
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+from observability import REGISTRY
+
+try:
+    import tiktoken
+except ImportError:  # 未インストールなら文字種による概算で数える
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# === 設定（単位はトークン） ===
+PROMPT_MODEL = "gpt-4o"
+PROMPT_BUDGET_FAQ = int(os.getenv("PROMPT_BUDGET_FAQ", "900"))
+PROMPT_BUDGET_REFERENCE = int(os.getenv("PROMPT_BUDGET_REFERENCE", "1200"))
+PROMPT_MAX_FAQ = int(os.getenv("PROMPT_MAX_FAQ", "3"))
+# 製品フィルム・カラー情報以外の参考情報の件数上限
+PROMPT_MAX_REFERENCE = int(os.getenv("PROMPT_MAX_REFERENCE", "2"))
+# 文字 3-gram の包含率がこれ以上なら、すでに入れた文章の重複とみなす
+PROMPT_DEDUP_THRESHOLD = float(os.getenv("PROMPT_DEDUP_THRESHOLD", "0.8"))
+# 先頭の文章が予算を超える場合、残りがこれ以上あれば切り詰めて入れる
+MIN_TRUNCATED_TOKENS = 60
+
+PROMPT_TOKENS = REGISTRY.histogram(
+    "chatbot_prompt_tokens", "LLM に送るプロンプトのトークン数（system + user）", ["model"],
+    buckets=(500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000),
+)
+
+
+# =========================================================
+# トークン数
+# =========================================================
+
+_encoding = None
+_encoding_failed = False
+_CJK_RE = re.compile(r"[　-ヿ㐀-鿿豈-﫿＀-￯]")
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.encoding_for_model(PROMPT_MODEL)
+        except Exception as e:
+            # 符号表のダウンロードに失敗した場合など
+            _encoding_failed = True
+            logger.warning("tiktoken を使えないため、トークン数は概算で数えます: %s", e)
+    return _encoding
+
+
+def count_tokens(text):
+    """トークン数（tiktoken が無ければ、和文は1文字1トークン・それ以外は4文字1トークンで概算）"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+
+# system_prompt.txt のように毎回同じ長い文章を数え直さない
+count_tokens_cached = lru_cache(maxsize=16)(count_tokens)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """max_tokens に収まるよう末尾を切り詰める（切った場合は「…」を付ける）"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[:max(0, max_tokens - 1)]) + "…"
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) + 1 <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+
+# =========================================================
+# 文脈の詰め込み
+# =========================================================
+
+class Passage:
+    """プロンプトに入れる文章。body は重複判定に使う本文（FAQ なら回答）"""
+
+    def __init__(self, text, body=None):
+        self.text = text
+        self.body = body if body is not None else text
+
+
+def _shingles(text):
+    chars = "".join(unicodedata.normalize("NFKC", text).split())
+    return {chars[i:i + 3] for i in range(len(chars) - 2)} or {chars}
+
+
+def _is_duplicate(shingles, selected):
+    for other in selected:
+        overlap = len(shingles & other)
+        if overlap and overlap / min(len(shingles), len(other)) >= PROMPT_DEDUP_THRESHOLD:
+            return True
+    return False
+
+
+def pack_passages(passages, budget, max_items=None, selected=None, separator="\n"):
+    """
+    渡された順（優先度の高い順）に、予算と件数上限の範囲で文章を選ぶ。
+
+    すでに選んだ文章（selected の 3-gram 集合）とほぼ同じ内容のものは飛ばす。
+    予算を超える文章は飛ばして次を試し、1件目が入らない場合だけ切り詰めて入れる。
+    """
+    selected = [] if selected is None else selected
+    chosen = []
+    used = 0
+    separator_tokens = count_tokens(separator)
+    for passage in passages:
+        if max_items is not None and len(chosen) >= max_items:
+            break
+        shingles = _shingles(passage.body)
+        if _is_duplicate(shingles, selected):
+            continue
+        gap = separator_tokens if chosen else 0
+        cost = count_tokens(passage.text) + gap
+        text = passage.text
+        if used + cost > budget:
+            remaining = budget - used - gap
+            if chosen or remaining < MIN_TRUNCATED_TOKENS:
+                continue
+            text = truncate_to_tokens(passage.text, remaining)
+            cost = count_tokens(text) + gap
+        chosen.append(text)
+        selected.append(shingles)
+        used += cost
+    return chosen
+
+
+def assemble_context(faq_passages, reference_passages, pinned_references=(),
+                     faq_budget=PROMPT_BUDGET_FAQ, reference_budget=PROMPT_BUDGET_REFERENCE,
+                     max_faq=PROMPT_MAX_FAQ, max_references=PROMPT_MAX_REFERENCE):
+    """
+    FAQ と参考情報をそれぞれの予算内に詰め、(FAQ の文章リスト, 参考情報の文章リスト) を返す。
+
+    pinned_references（製品フィルム・カラー情報）は参考情報の先頭に必ず入れ、その分を
+    参考情報の予算から差し引く。FAQ と参考情報をまたいだ重複も取り除く。
+    """
+    selected = []
+    faq_texts = pack_passages(faq_passages, faq_budget, max_faq, selected, separator="\n\n")
+
+    ref_texts = []
+    remaining = reference_budget
+    for text in pinned_references:
+        text = truncate_to_tokens(text, max(MIN_TRUNCATED_TOKENS, remaining))
+        ref_texts.append(text)
+        selected.append(_shingles(text))
+        remaining -= count_tokens(text) + 1
+    ref_texts += pack_passages(reference_passages, max(0, remaining), max_references, selected)
+    return faq_texts, ref_texts
+
+
+def observe_prompt(model, messages):
+    """送信するメッセージのトークン数を記録して返す"""
+    tokens = sum(count_tokens_cached(m["content"]) if m["role"] == "system" else count_tokens(m["content"])
+                 for m in messages)
+    PROMPT_TOKENS.observe(tokens, model=model)
+    return tokens
@@ -3,7 +3,6 @@ from flask_cors import CORS
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import openai
-import faiss
 import numpy as np
 import os
 import json
@@ -14,6 +13,8 @@ from dotenv import load_dotenv
 from product_film_matcher import ProductFilmMatcher
 from keyword_filter import extract_keywords
 from query_expander import expand_query
+import retrieval
+from prompt_builder import Passage, assemble_context
 
 # === 初期設定 ===
 load_dotenv()
@@ -41,19 +42,19 @@ def add_to_session_history(session_id, role, content):
     if len(history) > 10:
         history[:] = history[-10:]
 
-# === データ読み込み ===
-with open("data/faq.json", "r", encoding="utf-8") as f:
-    faq_items = json.load(f)
-faq_questions = [item["question"] for item in faq_items]
-faq_answers = [item["answer"] for item in faq_items]
+# === データ読み込み（コーパス定義は retrieval.py に集約）===
+EMBED_MODEL = retrieval.EMBED_MODEL
 
-with open("data/knowledge.json", "r", encoding="utf-8") as f:
-    knowledge_dict = json.load(f)
-knowledge_contents = [
-    f"{category}：{text}"
-    for category, texts in knowledge_dict.items()
-    for text in texts
-]
+def get_embeddings_batch(texts):
+    response = openai.embeddings.create(model=EMBED_MODEL, input=texts)
+    return [np.array(item.embedding, dtype="float32") for item in response.data]
+
+# マニフェストを検証して読み込み（不一致なら再構築）
+snapshot = retrieval.load_snapshot(model=EMBED_MODEL, embed_batch=get_embeddings_batch)
+corpus = snapshot.corpus
+faq_questions = corpus.faq_questions
+faq_answers = corpus.faq_answers
+knowledge_contents = corpus.knowledge_contents
 
 metadata_note = ""
 metadata_path = "data/metadata.json"
@@ -62,30 +63,11 @@ if os.path.exists(metadata_path):
         metadata = json.load(f)
         metadata_note = f"【ファイル情報】{metadata.get('title', '')}（種類：{metadata.get('type', '')}、優先度：{metadata.get('priority', '')}）"
 
-# === コーパス定義（順序維持が重要）===
-search_corpus = faq_questions + knowledge_contents + [metadata_note]
-source_flags = ["faq"] * len(faq_questions) + ["knowledge"] * len(knowledge_contents) + ["metadata"]
-
-# === EmbeddingとFAISSインデックス ===
-EMBED_MODEL = "text-embedding-3-small"
-VECTOR_PATH = "data/vector_data.npy"
-INDEX_PATH = "data/index.faiss"
-
+# === Embedding ===
 def get_embedding(text):
     response = openai.embeddings.create(model=EMBED_MODEL, input=text)
     return np.array(response.data[0].embedding, dtype="float32")
 
-# キャッシュロード（存在しない場合は作成）
-if os.path.exists(VECTOR_PATH) and os.path.exists(INDEX_PATH):
-    vector_data = np.load(VECTOR_PATH)
-    index = faiss.read_index(INDEX_PATH)
-else:
-    vector_data = np.array([get_embedding(text) for text in search_corpus], dtype="float32")
-    index = faiss.IndexFlatL2(vector_data.shape[1])
-    index.add(vector_data)
-    np.save(VECTOR_PATH, vector_data)
-    faiss.write_index(index, INDEX_PATH)
-
 # === Google Sheets設定 ===
 SPREADSHEET_ID = "1asbjzo-G9I6SmztBG18iWuiTKetOJK20JwAyPF11fA4"
 UNANSWERED_SHEET = "faq_suggestions"
@@ -122,27 +104,29 @@ def chat():
     expanded_q = expand_query(user_q, session_history)
     q_vector = get_embedding(expanded_q)
 
-    D, I = index.search(np.array([q_vector]), k=7)
+    hits = snapshot.search(q_vector, query=expanded_q)
     faq_context = []
     reference_context = []
 
-    for idx in I[0]:
-        src = source_flags[idx]
-        if src == "faq":
-            q = faq_questions[idx]
-            a = faq_answers[idx]
-            faq_context.append(f"Q: {q}\nA: {a}")
-        elif src == "knowledge":
-            ref_idx = idx - len(faq_questions)
-            reference_context.append(f"【参考知識】{knowledge_contents[ref_idx]}")
-        elif src == "metadata":
-            reference_context.append(metadata_note)
+    for doc, score in hits:
+        if doc["source"] == "faq":
+            q = faq_questions[doc["offset"]]
+            a = faq_answers[doc["offset"]]
+            faq_context.append(Passage(f"Q: {q}\nA: {a}", body=a))
+        elif doc["source"] == "knowledge":
+            content = knowledge_contents[doc["offset"]]
+            reference_context.append(Passage(f"【参考知識】{content}", body=content))
+
+    if metadata_note:
+        reference_context.append(Passage(metadata_note))
 
     if not faq_context:
         answer = "申し訳ございません。ただいまこちらで確認中です。詳細が分かり次第、改めてご案内いたします。"
     else:
-        faq_part = "\n\n".join(faq_context[:3])
-        ref_part = "\n".join(reference_context[:2]) if reference_context else ""
+        # スコアの高い順にトークン予算内へ詰め、重複する FAQ・参考知識は除く
+        faq_texts, ref_texts = assemble_context(faq_context, reference_context)
+        faq_part = "\n\n".join(faq_texts)
+        ref_part = "\n".join(ref_texts)
         prompt = f"""以下は当社のFAQおよび参考情報です。これらを参考に、ユーザーの質問に製造元の立場でご回答ください。
 
 【FAQ】
@@ -0,0 +1,760 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+from datetime import datetime
+
+import faiss
+import numpy as np
+
+import generations
+from doc_store import DOCSTORE_PATH, open_doc_store, write_doc_store
+from embedding_cache import cached_embed
+from embedding_pipeline import EMBED_BATCH_SIZE
+from lexical_index import LEXICAL_PATH, LexicalIndex, load_lexical_index, save_lexical_index
+
+logger = logging.getLogger(__name__)
+
+# === パス設定 ===
+# data/ 直下は更新スクリプトが書き出す入力。公開済みの世代（data/CURRENT）が
+# あれば、読み手はコーパス・インデックスともにその世代のファイルを使う
+FAQ_PATH = "data/faq.json"
+KNOWLEDGE_PATH = "data/knowledge.json"
+VECTOR_PATH = "data/vector_data.npy"
+INDEX_PATH = "data/index.faiss"
+MANIFEST_PATH = "data/index_manifest.json"
+
+EMBED_MODEL = "text-embedding-3-small"
+MANIFEST_VERSION = 3
+
+# === 検索設定 ===
+# 内積インデックスに L2 正規化済みベクトルを入れるため、スコアはコサイン類似度
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "7"))
+MIN_SCORES = {
+    "faq": float(os.getenv("MIN_SCORE_FAQ", "0.40")),
+    "knowledge": float(os.getenv("MIN_SCORE_KNOWLEDGE", "0.35")),
+}
+# 最上位スコアからこの差以内のヒットだけを残す（適応的な k）
+SCORE_MARGIN = float(os.getenv("SEARCH_SCORE_MARGIN", "0.15"))
+
+# === ハイブリッド検索（BM25 文字 n-gram + ベクトル） ===
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+LEXICAL_TOP_K = int(os.getenv("LEXICAL_TOP_K", "5"))
+# BM25 の最上位スコアに対する比率がこれ未満の語彙ヒットは捨てる
+LEXICAL_RELATIVE_MIN = float(os.getenv("LEXICAL_RELATIVE_MIN", "0.5"))
+# 語彙検索だけで答える場合（Embedding API 障害時）の BM25 スコア下限
+LEXICAL_MIN_SCORE = float(os.getenv("LEXICAL_MIN_SCORE", "10.0"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# === インデックスの種類（再構築時に選び、マニフェストに記録する） ===
+# flat: 全件走査（厳密） / hnsw: グラフ探索 / ivfpq: 転置リスト + 直積量子化 / sq8: 8bit スカラー量子化
+INDEX_TYPES = ("flat", "hnsw", "ivfpq", "sq8")
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))  # 0 なら件数から決める
+PQ_M = int(os.getenv("PQ_M", "0"))  # サブベクトル数（次元数の約数）。0 なら次元数 / 16
+PQ_NBITS = int(os.getenv("PQ_NBITS", "8"))
+# k-means の学習に 1 セントロイドあたり必要な件数（faiss の推奨値）。
+# ivfpq は IVF のリスト数・PQ の符号数（2^PQ_NBITS）のどちらかに対して件数が足りなければ sq8 で作る
+IVF_MIN_POINTS_PER_CENTROID = 39
+# 検索時の探索範囲（大きいほど正確で遅い）。読み込み時に設定する
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+# ivfpq の既定値は、flat の上位 k 件に対する recall@k 0.9 以上を目標に
+# retrieval_benchmark.py --index-types flat,ivfpq --scale 10000〜100000 で選んだもの
+# （PQ の符号だけでは 0.5 前後で頭打ちのため、候補を k × IVF_REFINE_K_FACTOR 件取り SQ8 で並べ直す）
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+IVF_REFINE_K_FACTOR = int(os.getenv("IVF_REFINE_K_FACTOR", "32"))
+
+# === Embedding の次元数・保存形式（再構築時に選び、マニフェストに記録する） ===
+# text-embedding-3 系は先頭の成分ほど情報を持つため、先頭 N 次元に切り詰めて再正規化しても
+# API の dimensions 指定と同じベクトルになる。0 ならモデル本来の次元数（small は 1536）
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0"))
+# float32 / float16（半精度）/ int8（8bit スカラー量子化）。flat・hnsw のベクトルの持ち方
+VECTOR_STORAGES = ("float32", "float16", "int8")
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "float32")
+
+
+class IndexMismatchError(RuntimeError):
+    """インデックスと現在のコーパスが一致しない場合の例外"""
+
+
+# =========================================================
+# コーパス
+# =========================================================
+
+def load_knowledge_entries(knowledge_data):
+    """
+    knowledge.json を (カテゴリ, 本文) のリストに変換する。
+
+    {カテゴリ: [本文, ...]} 形式と [{"title", "content"}, ...] 形式の両方に対応。
+    """
+    if isinstance(knowledge_data, dict):
+        return [(category, text) for category, texts in knowledge_data.items() for text in texts]
+    if isinstance(knowledge_data, list):
+        return [(item["title"], item["content"]) for item in knowledge_data]
+    raise ValueError("knowledge.json の形式が不正です。")
+
+
+def _text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def stable_doc_id(source, key):
+    """出典と行キー（FAQ は質問、knowledge はカテゴリ＋カテゴリ内の順番）から 63bit の固定 id を作る"""
+    digest = hashlib.sha256(f"{source}\n{key}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+
+class Corpus:
+    """
+    検索対象のコーパス（FAQ の質問 + knowledge の「カテゴリ：本文」）。
+
+    各文書はシートの行に由来する固定 id を持ち、FAISS（IndexIDMap2）は
+    この id で検索結果を返す。doc_by_id で source / offset を引ける。
+    """
+
+    def __init__(self, faq_items, knowledge_entries):
+        self.faq_items = faq_items
+        self.knowledge_entries = knowledge_entries
+        self.faq_questions = [item["question"] for item in faq_items]
+        self.faq_answers = [item["answer"] for item in faq_items]
+        self.knowledge_contents = [f"{category}：{text}" for category, text in knowledge_entries]
+
+        self.docs = []
+        for offset, question in enumerate(self.faq_questions):
+            self.docs.append({"source": "faq", "offset": offset, "key": question, "text": question})
+        category_counts = {}
+        for offset, (category, _) in enumerate(knowledge_entries):
+            n = category_counts.get(category, 0)
+            category_counts[category] = n + 1
+            self.docs.append({
+                "source": "knowledge",
+                "offset": offset,
+                "key": f"{category}\n{n}",
+                "text": self.knowledge_contents[offset],
+            })
+
+        self.doc_by_id = {}
+        for doc in self.docs:
+            doc_id = stable_doc_id(doc["source"], doc["key"])
+            # 同じ質問が重複している場合も id が衝突しないようにずらす
+            while doc_id in self.doc_by_id:
+                doc_id = (doc_id + 1) & 0x7FFFFFFFFFFFFFFF
+            doc["id"] = doc_id
+            doc["hash"] = _text_hash(doc["text"])
+            self.doc_by_id[doc_id] = doc
+
+        self.texts = [doc["text"] for doc in self.docs]
+        # 行の並び替えだけでは再構築が不要になるよう、id 順でハッシュを取る
+        self.hash = _text_hash("\n".join(
+            f"{doc_id}:{self.doc_by_id[doc_id]['hash']}" for doc_id in sorted(self.doc_by_id)
+        ))
+        # hash は Embedding の対象（FAQ の質問・knowledge の本文）だけのため、回答・カテゴリを含む
+        # 全内容のハッシュも持つ（世代の公開や、回答も持つ文書ストア・語彙インデックスの整合確認に使う）
+        self.content_hash = _text_hash(json.dumps(
+            [faq_items, [list(entry) for entry in knowledge_entries]], ensure_ascii=False, sort_keys=True
+        ))
+
+    def __len__(self):
+        return len(self.docs)
+
+
+def load_corpus(faq_path=FAQ_PATH, knowledge_path=KNOWLEDGE_PATH):
+    with open(faq_path, "r", encoding="utf-8") as f:
+        faq_items = json.load(f)
+    with open(knowledge_path, "r", encoding="utf-8") as f:
+        knowledge_entries = load_knowledge_entries(json.load(f))
+    return Corpus(faq_items, knowledge_entries)
+
+
+def save_corpus(corpus, faq_path, knowledge_path):
+    """コーパスを faq.json と knowledge.json（[{"title", "content"}] 形式）に書き出す"""
+    _write_json(faq_path, corpus.faq_items)
+    _write_json(knowledge_path, [{"title": category, "content": text} for category, text in corpus.knowledge_entries])
+
+
+# =========================================================
+# マニフェスト
+# =========================================================
+
+def build_manifest(corpus, index, model, spec=None):
+    return {
+        "version": MANIFEST_VERSION,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "model": model,
+        "dimension": int(index.d),
+        "index_type": type(index).__name__,
+        "index": spec or index_spec(int(index.ntotal), int(index.d), "flat"),
+        "embedding": embedding_config(),
+        "metric": "inner_product",
+        "count": int(index.ntotal),
+        "corpus_hash": corpus.hash,
+        "content_hash": corpus.content_hash,
+        "docs": [
+            {"id": doc["id"], "source": doc["source"], "offset": doc["offset"], "hash": doc["hash"]}
+            for doc in corpus.docs
+        ],
+    }
+
+
+def read_manifest(manifest_path=MANIFEST_PATH):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_manifest(manifest, corpus, index, model):
+    """不一致の理由を文字列のリストで返す（空なら整合している）"""
+    if manifest is None:
+        return ["マニフェストがありません"]
+    problems = []
+    if manifest.get("version") != MANIFEST_VERSION:
+        problems.append(f"マニフェストのバージョンが異なります ({manifest.get('version')} != {MANIFEST_VERSION})")
+    if manifest.get("model") != model:
+        problems.append(f"Embeddingモデルが異なります ({manifest.get('model')} != {model})")
+    if manifest.get("corpus_hash") != corpus.hash:
+        problems.append("コーパスのハッシュが一致しません")
+    # content_hash の無い古いマニフェストは、次の再構築で記録されるまで回答の差分を確かめない
+    if "content_hash" in manifest and manifest["content_hash"] != corpus.content_hash:
+        problems.append("コーパスの内容（回答・カテゴリ）が一致しません")
+    if manifest.get("count") != len(corpus) or index.ntotal != len(corpus):
+        problems.append(
+            f"件数が一致しません (manifest={manifest.get('count')}, index={index.ntotal}, corpus={len(corpus)})"
+        )
+    if manifest.get("dimension") != index.d:
+        problems.append(f"次元数が一致しません (manifest={manifest.get('dimension')}, index={index.d})")
+    return problems
+
+
+def _manifest_embedding(manifest):
+    return manifest.get("embedding") or {"dimensions": None, "storage": "float32"}
+
+
+# =========================================================
+# インデックスの構築・更新・読み込み
+# =========================================================
+
+def embedding_config():
+    """マニフェストに記録する次元数・保存形式（記録の無い古いマニフェストは本来の次元数・float32）"""
+    return {"dimensions": EMBED_DIMENSIONS or None, "storage": VECTOR_STORAGE}
+
+
+def reduce_dimensions(vectors, dimensions=None):
+    """先頭 dimensions 次元に切り詰めて L2 正規化する（0 / None なら正規化のみ）"""
+    vectors = normalize_vectors(vectors)
+    dimensions = EMBED_DIMENSIONS if dimensions is None else dimensions
+    if not dimensions or dimensions == vectors.shape[1]:
+        return vectors
+    if dimensions > vectors.shape[1]:
+        raise ValueError(f"EMBED_DIMENSIONS（{dimensions}）が Embedding の次元数（{vectors.shape[1]}）を超えています。")
+    return normalize_vectors(vectors[:, :dimensions])
+
+
+def _codec(storage):
+    codecs = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+    if storage not in codecs:
+        raise ValueError(f"未対応の VECTOR_STORAGE です: {storage}（{', '.join(VECTOR_STORAGES)}）")
+    return codecs[storage]
+
+
+def encode_vectors(vectors, storage=None):
+    """vector_data.npy に保存する形式に変換する（int8 は [-1, 1] を 127 倍して丸める）"""
+    storage = storage or VECTOR_STORAGE
+    _codec(storage)
+    if storage == "float16":
+        return vectors.astype("float16")
+    if storage == "int8":
+        return np.clip(np.rint(vectors * 127), -127, 127).astype("int8")
+    return vectors.astype("float32")
+
+
+def index_spec(count, dimension, index_type=None, storage=None):
+    """件数・次元数から faiss.index_factory の指定とマニフェストに記録するパラメータを決める"""
+    index_type = index_type or INDEX_TYPE
+    storage = storage or VECTOR_STORAGE
+    if index_type == "flat":
+        return {"type": "flat", "factory": _codec(storage), "storage": storage}
+    if index_type == "hnsw":
+        return {"type": "hnsw", "factory": f"HNSW{HNSW_M},{_codec(storage)}", "storage": storage,
+                "m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION}
+    if index_type == "sq8":
+        return {"type": "sq8", "factory": "SQ8"}
+    if index_type == "ivfpq":
+        nlist = IVF_NLIST or max(1, min(int(4 * math.sqrt(count)), count // IVF_MIN_POINTS_PER_CENTROID))
+        m = PQ_M or max(1, dimension // 16)
+        if dimension % m:
+            raise ValueError(f"PQ_M（{m}）が次元数（{dimension}）の約数ではありません。")
+        min_count = IVF_MIN_POINTS_PER_CENTROID * max(nlist, 2 ** PQ_NBITS)
+        if count < min_count:
+            # 学習データが足りない量子化は精度が大きく落ちるため、学習の要らない sq8 にする
+            return dict(index_spec(count, dimension, "sq8"), requested="ivfpq", min_count=min_count)
+        # np: ハミング距離での絞り込みは使わないため、時間のかかる polysemous 学習を省く
+        # Refine(SQ8): PQ で絞った候補を 8bit 量子化したベクトルで並べ直す
+        factory = f"IVF{nlist},PQ{m}x{PQ_NBITS}np,Refine(SQ8)"
+        return {"type": "ivfpq", "factory": factory, "nlist": nlist, "pq_m": m, "pq_nbits": PQ_NBITS}
+    raise ValueError(f"未対応の INDEX_TYPE です: {index_type}（{', '.join(INDEX_TYPES)}）")
+
+
+def configure_search(index, ef_search=None, nprobe=None, k_factor=None):
+    """HNSW の efSearch・IVF の nprobe・並べ直しの候補倍率を設定する（他の種類では何もしない）"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexRefine):
+        inner.k_factor = k_factor or IVF_REFINE_K_FACTOR
+        inner = faiss.downcast_index(inner.base_index)
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = ef_search or HNSW_EF_SEARCH
+    if hasattr(inner, "nprobe"):
+        inner.nprobe = nprobe or IVF_NPROBE
+    return index
+
+
+def create_index(vectors, ids, spec):
+    """正規化済みベクトルで（必要なら）学習し、ids を付けて追加したインデックスを作る"""
+    inner = faiss.index_factory(int(vectors.shape[1]), spec["factory"], faiss.METRIC_INNER_PRODUCT)
+    if spec["type"] == "hnsw":
+        faiss.downcast_index(inner).hnsw.efConstruction = spec["ef_construction"]
+    if not inner.is_trained:
+        inner.train(vectors)
+    index = configure_search(faiss.IndexIDMap2(inner))
+    index.add_with_ids(vectors, np.asarray(ids, dtype="int64"))
+    return index
+
+
+def normalize_vectors(vectors):
+    """コサイン類似度で検索できるよう、各行を L2 正規化した float32 行列を返す"""
+    vectors = np.array(vectors, dtype="float32", ndmin=2)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def read_index(index_path=INDEX_PATH, mmap=False):
+    """
+    インデックスを読み込む。
+
+    mmap=True の場合はベクトル本体をメモリマップで参照する（読み取り専用）。
+    ページキャッシュが gunicorn の全ワーカーで共有されるため、
+    ワーカーごとにベクトル行列のコピーを持たずに済む。
+    IO_FLAG_MMAP_IFC に未対応の古い faiss や、対応しない種類では通常の読み込みになる。
+    HNSW・IVF の探索範囲（HNSW_EF_SEARCH・IVF_NPROBE・IVF_REFINE_K_FACTOR）もここで設定する。
+    """
+    if mmap and hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        try:
+            return configure_search(faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY))
+        except RuntimeError as e:
+            logger.warning("⚠️ インデックスをメモリマップで開けませんでした（通常読み込みに切り替えます）: %s", e)
+    return configure_search(faiss.read_index(index_path))
+
+
+def _replace_file(path, write):
+    # メモリマップ中の読み手を壊さないよう、別ファイルに書いてから置き換える
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_npy(path, data):
+    with open(path, "wb") as f:
+        np.save(f, data)
+
+
+def _write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def _save(corpus, index, model, index_path, vector_path, manifest_path, lexical_path, docstore_path,
+          spec=None, vector_data=None):
+    # 量子化するインデックスからは元のベクトルを復元できないため、作成時のベクトルを渡す
+    if vector_data is None:
+        vector_data = np.vstack([index.reconstruct(doc["id"]) for doc in corpus.docs]).astype("float32")
+    vector_data = encode_vectors(vector_data)
+    _replace_file(vector_path, lambda path: _write_npy(path, vector_data))
+    _replace_file(index_path, lambda path: faiss.write_index(index, path))
+    lexical = LexicalIndex.build(corpus)
+    _replace_file(lexical_path, lambda path: save_lexical_index(lexical, path))
+    _replace_file(docstore_path, lambda path: write_doc_store(corpus, path))
+    _replace_file(manifest_path, lambda path: _write_json(path, build_manifest(corpus, index, model, spec)))
+
+
+def build_index(corpus, embed_batch, model=EMBED_MODEL, cache=None, batch_size=EMBED_BATCH_SIZE,
+                index_path=INDEX_PATH, vector_path=VECTOR_PATH, manifest_path=MANIFEST_PATH,
+                lexical_path=LEXICAL_PATH, docstore_path=DOCSTORE_PATH):
+    """コーパス全体からインデックスを作り、ベクトル・インデックス・マニフェスト・語彙インデックスを保存する。"""
+    if not len(corpus):
+        raise ValueError("コーパスが空のためインデックスを作成できません。")
+
+    # キャッシュには本来の次元数のまま入っているため、次元数を変えても API は呼ばない
+    vector_data = reduce_dimensions(cached_embed(corpus.texts, embed_batch, model, cache=cache, batch_size=batch_size))
+    spec = index_spec(len(corpus), int(vector_data.shape[1]))
+    index = create_index(vector_data, [doc["id"] for doc in corpus.docs], spec)
+
+    _save(corpus, index, model, index_path, vector_path, manifest_path, lexical_path, docstore_path,
+          spec=spec, vector_data=vector_data)
+    return index
+
+
+def update_index(corpus, embed_batch, model=EMBED_MODEL, cache=None, batch_size=EMBED_BATCH_SIZE,
+                 index_path=INDEX_PATH, vector_path=VECTOR_PATH, manifest_path=MANIFEST_PATH,
+                 lexical_path=LEXICAL_PATH, docstore_path=DOCSTORE_PATH):
+    """
+    前回のマニフェストとの差分（追加・削除・変更）だけをインデックスに反映する。
+
+    前回のインデックスが無い・モデルや形式・次元数・保存形式が異なる場合、また flat 以外
+    （削除に対応しない hnsw や、学習済みの量子化が古くなる ivfpq・sq8、int8 保存）では
+    build_index で作り直す。
+    Embedding はキャッシュから取り出すため、作り直しでも API の呼び出しは変更分だけになる。
+    """
+    manifest = read_manifest(manifest_path)
+    index = faiss.read_index(index_path) if os.path.exists(index_path) else None
+
+    reusable = (
+        manifest is not None
+        and index is not None
+        and manifest.get("version") == MANIFEST_VERSION
+        and manifest.get("model") == model
+        and isinstance(index, faiss.IndexIDMap2)
+        and index.ntotal == manifest.get("count")
+        and index.d == manifest.get("dimension")
+        and _manifest_embedding(manifest) == embedding_config()
+    )
+    incremental = (
+        INDEX_TYPE == "flat"
+        and VECTOR_STORAGE != "int8"
+        and manifest is not None
+        and manifest.get("index", {}).get("type", "flat") == "flat"
+    )
+    if not reusable or not incremental:
+        reason = "差分更新できない" if not reusable else f"差分更新に対応しないインデックス（{INDEX_TYPE}・{VECTOR_STORAGE}）の"
+        logger.info("🔄 %sため、インデックスを全件で作成します。", reason)
+        return build_index(
+            corpus, embed_batch, model=model, cache=cache, batch_size=batch_size,
+            index_path=index_path, vector_path=vector_path, manifest_path=manifest_path,
+            lexical_path=lexical_path, docstore_path=docstore_path,
+        )
+
+    previous = {doc["id"]: doc["hash"] for doc in manifest["docs"]}
+    removed = [doc_id for doc_id, h in previous.items()
+               if doc_id not in corpus.doc_by_id or corpus.doc_by_id[doc_id]["hash"] != h]
+    added = [doc for doc in corpus.docs if previous.get(doc["id"]) != doc["hash"]]
+
+    logger.info(
+        "🔄 インデックス差分: 追加/変更 %d件, 削除/変更 %d件 (変更なし %d件)",
+        len(added), len(removed), len(corpus) - len(added),
+    )
+
+    vectors = None
+    if added:
+        vectors = reduce_dimensions(
+            cached_embed([doc["text"] for doc in added], embed_batch, model, cache=cache, batch_size=batch_size)
+        )
+        if vectors.shape[1] != index.d:
+            # 同じモデル名でも Embedding の次元数が変わった場合は、差分を反映する前に全件で作り直す
+            logger.info("🔄 次元数が一致しない (index=%d, embedding=%d) ため、インデックスを全件で作成します。",
+                        index.d, vectors.shape[1])
+            return build_index(
+                corpus, embed_batch, model=model, cache=cache, batch_size=batch_size,
+                index_path=index_path, vector_path=vector_path, manifest_path=manifest_path,
+                lexical_path=lexical_path, docstore_path=docstore_path,
+            )
+
+    if removed:
+        index.remove_ids(np.array(removed, dtype="int64"))
+    if vectors is not None:
+        index.add_with_ids(vectors, np.array([doc["id"] for doc in added], dtype="int64"))
+
+    _save(corpus, index, model, index_path, vector_path, manifest_path, lexical_path, docstore_path)
+    return index
+
+
+def load_index(corpus, model=EMBED_MODEL, embed_batch=None, cache=None, mmap=False,
+               index_path=INDEX_PATH, vector_path=VECTOR_PATH, manifest_path=MANIFEST_PATH,
+               lexical_path=LEXICAL_PATH, docstore_path=DOCSTORE_PATH):
+    """
+    マニフェストを検証してインデックスを読み込む。
+
+    コーパスと一致しない場合、embed_batch が渡されていれば差分更新し、
+    渡されていなければ IndexMismatchError を送出する。
+    """
+    problems = ["インデックスファイルがありません"]
+    if os.path.exists(index_path):
+        index = read_index(index_path, mmap=mmap)
+        problems = check_manifest(read_manifest(manifest_path), corpus, index, model)
+        if not problems:
+            return index
+
+    if embed_batch is None:
+        raise IndexMismatchError("インデックスがコーパスと一致しません: " + " / ".join(problems))
+
+    logger.warning("⚠️ インデックスを更新します: %s", " / ".join(problems))
+    return update_index(
+        corpus, embed_batch, model=model, cache=cache,
+        index_path=index_path, vector_path=vector_path, manifest_path=manifest_path,
+        lexical_path=lexical_path, docstore_path=docstore_path,
+    )
+
+
+# =========================================================
+# 世代の公開
+# =========================================================
+
+def default_paths():
+    return {
+        "faq_path": FAQ_PATH,
+        "knowledge_path": KNOWLEDGE_PATH,
+        "index_path": INDEX_PATH,
+        "vector_path": VECTOR_PATH,
+        "manifest_path": MANIFEST_PATH,
+        "lexical_path": LEXICAL_PATH,
+        "docstore_path": DOCSTORE_PATH,
+    }
+
+
+def resolve_paths():
+    """読み手が使うファイルのパス（現在の世代。世代が無ければ data/ 直下の従来のファイル）"""
+    name = generations.current_generation()
+    return generations.generation_paths(name) if name else default_paths()
+
+
+def publish_index(corpus, embed_batch, model=EMBED_MODEL, cache=None, batch_size=EMBED_BATCH_SIZE, full=False):
+    """
+    コーパスとインデックスを新しい世代として書き出し、data/CURRENT を切り替える。
+
+    現在の世代（または従来のファイル）のインデックスを一時ディレクトリに複写して差分更新する。
+    full=True なら全件で作り直す。公開した世代名とインデックスを返す。
+    コーパス・設定が現在の世代と同じなら公開せず、現在の世代名とそのインデックスを返す
+    （CURRENT を書き換えないため、ワークフローのコミットや各ワーカーの再読み込みも起きない）。
+    比較から公開までを generations.publish_lock の中で行い、同時に起動した他のプロセスが
+    公開し終えていればそれを使う。
+    """
+    with generations.publish_lock():
+        previous = resolve_paths()
+        current = generations.current_generation()
+        if not full and current and not _needs_publish(corpus, previous, model):
+            logger.info("ℹ️ コーパス・設定に変更が無いため、現在の世代 %s をそのまま使います", current)
+            return current, read_index(previous["index_path"])
+        return _publish_new(corpus, embed_batch, model, cache, batch_size, full, previous)
+
+
+def _publish_new(corpus, embed_batch, model, cache, batch_size, full, previous):
+    built = {}
+
+    def write(paths):
+        save_corpus(corpus, paths["faq_path"], paths["knowledge_path"])
+        if not full:
+            for key in ("index_path", "manifest_path"):
+                if os.path.exists(previous[key]):
+                    shutil.copyfile(previous[key], paths[key])
+        rebuild = build_index if full else update_index
+        built["index"] = rebuild(
+            corpus, embed_batch, model=model, cache=cache, batch_size=batch_size,
+            index_path=paths["index_path"], vector_path=paths["vector_path"],
+            manifest_path=paths["manifest_path"], lexical_path=paths["lexical_path"],
+            docstore_path=paths["docstore_path"],
+        )
+
+    name = generations.publish(write, label=corpus.content_hash[:8])
+    logger.info("📦 インデックスの世代 %s を公開しました（%d件）", name, built["index"].ntotal)
+    return name, built["index"]
+
+
+def _manifest_index_type(manifest):
+    # 件数不足で sq8 にした ivfpq は、指定された種類（requested）で比べる
+    spec = manifest.get("index", {})
+    return spec.get("requested", spec.get("type", "flat"))
+
+
+def _needs_publish(corpus, paths, model):
+    manifest = read_manifest(paths["manifest_path"])
+    return (
+        manifest is None
+        or not os.path.exists(paths["index_path"])
+        or manifest.get("version") != MANIFEST_VERSION
+        or manifest.get("model") != model
+        or manifest.get("corpus_hash") != corpus.hash
+        or manifest.get("content_hash") != corpus.content_hash
+        or _manifest_embedding(manifest) != embedding_config()
+        or _manifest_index_type(manifest) != INDEX_TYPE
+    )
+
+
+# =========================================================
+# 検索スナップショット（ホットリロード用）
+# =========================================================
+
+def file_fingerprint(paths):
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprint.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+class RetrievalSnapshot:
+    """
+    ある時点のコーパスとインデックスの組。
+
+    読み込み後は変更しないため、リクエストは開始時に参照を1つ取っておけば
+    途中で新しいスナップショットに切り替わっても一貫した id 対応で処理できる。
+    """
+
+    def __init__(self, corpus, index, manifest, fingerprint, lexical=None, generation=None):
+        self.corpus = corpus
+        self.generation = generation
+        self.index = index
+        self.lexical = lexical
+        self.manifest = manifest or {}
+        self.fingerprint = fingerprint
+        self.loaded_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def search(self, q_vector, query=None, k=None, min_scores=None, margin=None):
+        """
+        質問ベクトル（と質問文）で検索し、(文書, コサイン類似度) を返す。
+
+        ベクトル検索では出典ごとの下限スコア未満と、最上位から margin 以上離れたヒットを捨てる。
+        query を渡すと BM25 の語彙検索と RRF で統合した順に並べる。語彙検索だけで拾った文書の
+        スコアは 0.0。q_vector が None の場合（Embedding API の障害時）は語彙検索だけで返す。
+        """
+        k = k or SEARCH_TOP_K
+        if q_vector is None:
+            if query is None or self.lexical is None:
+                return []
+            return self._fuse([], self._lexical_search(query, fallback=True), k)
+
+        hits = self._vector_search(q_vector, k, min_scores, margin)
+        # ベクトル検索で何も残らない質問は無関係とみなし、語彙検索の偶然の一致で補わない
+        if not hits or query is None or self.lexical is None or not HYBRID_SEARCH:
+            return hits
+        return self._fuse(hits, self._lexical_search(query, fallback=False), k)
+
+    def _vector_search(self, q_vector, k, min_scores, margin):
+        min_scores = MIN_SCORES if min_scores is None else min_scores
+        margin = SCORE_MARGIN if margin is None else margin
+
+        q = normalize_vectors(q_vector)
+        # 次元数を減らしたインデックスでは、質問ベクトルも同じ次元数に切り詰める
+        if q.shape[1] > self.index.d:
+            q = reduce_dimensions(q, self.index.d)
+        elif q.shape[1] < self.index.d:
+            raise IndexMismatchError(f"質問ベクトルの次元数が不足しています (index={self.index.d}, query={q.shape[1]})")
+        D, I = self.index.search(q, min(k, self.index.ntotal))
+        hits = []
+        for score, idx in zip(D[0], I[0]):
+            doc = self.corpus.doc_by_id.get(int(idx))
+            if doc is None or score < min_scores.get(doc["source"], 0.0):
+                continue
+            hits.append((doc, float(score)))
+        if hits:
+            best = hits[0][1]
+            hits = [(doc, score) for doc, score in hits if best - score <= margin]
+        return hits
+
+    def _lexical_search(self, query, fallback):
+        ranked = self.lexical.search(query, LEXICAL_TOP_K)
+        if not ranked:
+            return []
+        floor = ranked[0][1] * LEXICAL_RELATIVE_MIN
+        if fallback:
+            floor = max(floor, LEXICAL_MIN_SCORE)
+        return [self.corpus.doc_by_id[doc_id] for doc_id, score in ranked
+                if score >= floor and doc_id in self.corpus.doc_by_id]
+
+    def _fuse(self, vector_hits, lexical_docs, k):
+        """Reciprocal Rank Fusion: 各検索での順位 r について 1 / (RRF_K + r) を足し合わせる"""
+        fused = {}
+        cosine = {}
+        for rank, (doc, score) in enumerate(vector_hits, start=1):
+            fused[doc["id"]] = fused.get(doc["id"], 0.0) + 1.0 / (RRF_K + rank)
+            cosine[doc["id"]] = score
+        for rank, doc in enumerate(lexical_docs, start=1):
+            fused[doc["id"]] = fused.get(doc["id"], 0.0) + 1.0 / (RRF_K + rank)
+        ranked = sorted(fused, key=lambda doc_id: (fused[doc_id], cosine.get(doc_id, 0.0)), reverse=True)[:k]
+        return [(self.corpus.doc_by_id[doc_id], cosine.get(doc_id, 0.0)) for doc_id in ranked]
+
+    def info(self):
+        return {
+            "generation": self.generation,
+            "loaded_at": self.loaded_at,
+            "manifest_created_at": self.manifest.get("created_at"),
+            "corpus_hash": self.corpus.hash,
+            "count": int(self.index.ntotal),
+            "dimension": int(self.index.d),
+            "storage": self.manifest.get("embedding", {}).get("storage", "float32"),
+        }
+
+
+def snapshot_paths(paths=None):
+    """ホットリロードの変更検知に使うファイル（世代の切り替えは CURRENT の更新で検知する）"""
+    paths = paths or resolve_paths()
+    keys = ("faq_path", "knowledge_path", "index_path", "manifest_path", "lexical_path", "docstore_path")
+    return [generations.CURRENT_PATH] + [paths[key] for key in keys]
+
+
+def load_snapshot(model=EMBED_MODEL, embed_batch=None, cache=None, mmap=False, paths=None):
+    """
+    スナップショットを読み込む。paths を省略すると現在の世代を読む。
+
+    embed_batch を渡した場合は data/ 直下の faq.json・knowledge.json と現在の世代を比べ、
+    一致しなければ新しい世代を公開してから読む（公開済みの世代は書き換えない）。
+    ロールバックで固定された世代（generations.rollback）は比べずにそのまま読む。
+    paths を明示した場合は従来どおり、そのファイルをその場で更新する。
+    """
+    generation = None
+    if paths is None:
+        if embed_batch is not None and generations.is_pinned():
+            # ロールバックで固定された世代は、data/ のコーパスと異なっていてもそのまま使う
+            logger.warning("⏸️ 世代 %s はロールバックで固定されているため、自動では公開しません",
+                           generations.current_generation())
+        elif embed_batch is not None:
+            source = load_corpus()
+            if _needs_publish(source, resolve_paths(), model):
+                logger.warning("⚠️ 現在のインデックスが data/ のコーパスと一致しないため、新しい世代を作成します。")
+                publish_index(source, embed_batch, model=model, cache=cache)
+            embed_batch = None
+        generation = generations.current_generation()
+        paths = resolve_paths()
+
+    fingerprint = file_fingerprint(snapshot_paths(paths))
+    corpus = source = None
+    if embed_batch is None:
+        if generation is not None:
+            # 公開済みの世代は書き換えないため、同じ世代のマニフェストと一致すれば JSON を読まずに
+            # 文書ストアをメモリマップで参照する
+            content_hash = (read_manifest(paths["manifest_path"]) or {}).get("content_hash")
+        else:
+            # data/ 直下のファイルは JSON だけ書き換えられている場合があるため、JSON の内容と比べる
+            source = load_corpus(paths["faq_path"], paths["knowledge_path"])
+            content_hash = source.content_hash
+        corpus = open_doc_store(paths["docstore_path"], content_hash)
+    if corpus is None:
+        corpus = source or load_corpus(paths["faq_path"], paths["knowledge_path"])
+    index = load_index(
+        corpus, model=model, embed_batch=embed_batch, cache=cache, mmap=mmap,
+        index_path=paths["index_path"], vector_path=paths["vector_path"],
+        manifest_path=paths["manifest_path"], lexical_path=paths["lexical_path"],
+        docstore_path=paths["docstore_path"],
+    )
+    # 再構築した場合はファイルが更新されているため取り直す
+    if embed_batch is not None:
+        fingerprint = file_fingerprint(snapshot_paths(paths))
+    lexical = load_lexical_index(corpus, paths["lexical_path"])
+    return RetrievalSnapshot(corpus, index, read_manifest(paths["manifest_path"]), fingerprint, lexical, generation)
+
+
+def build_snapshot(corpus, vectors, manifest=None, spec=None, dimensions=0):
+    """
+    ファイルを介さず、コーパスとベクトル行列（コーパスの文書順）からメモリ上のスナップショットを作る。
+
+    spec（index_spec の戻り値）を省略すると flat インデックスにする。
+    dimensions を渡すと先頭の次元に切り詰める（質問ベクトルは検索時に同じ次元に揃える）。
+    """
+    vectors = reduce_dimensions(vectors, dimensions)
+    spec = spec or index_spec(len(corpus), int(vectors.shape[1]), "flat")
+    index = create_index(vectors, [doc["id"] for doc in corpus.docs], spec)
+    return RetrievalSnapshot(corpus, index, manifest, None, LexicalIndex.build(corpus))
@@ -1,13 +1,21 @@
 import json
+import logging
 import os
-import time
+import sys
 
-import faiss
 import gspread
 import numpy as np
 from dotenv import load_dotenv
 from google.oauth2.service_account import Credentials
-from openai import OpenAI, OpenAIError, RateLimitError
+from openai import OpenAI, RateLimitError
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import retrieval  # noqa: E402
+
+# retrieval などのライブラリは進捗をロガーに出すため、そのまま表示する
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 
 # =========================================================
@@ -28,7 +36,8 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY is not set.")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# 再試行は embedding_pipeline 側でまとめて行う
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
 
 # =========================================================
@@ -108,16 +117,16 @@ print(f"✅ {knowledge_path} を保存しました。")
 
 
 # =========================================================
-# Embedding用テキスト生成
+# Embedding用コーパス生成
 # =========================================================
 
-texts: list[str] = [
-    f"{title}：{content[0]}"
-    for title, content in knowledge.items()
-]
+# FAQ + knowledge を retrieval.py の共通定義で組み立てる
+# （knowledge だけでインデックスを作ると app.py の id 対応がずれるため）
+corpus = retrieval.load_corpus(
+    knowledge_path=knowledge_path,
+)
 
-EMBED_MODEL = "text-embedding-3-small"
-BATCH_SIZE = 100
+EMBED_MODEL = retrieval.EMBED_MODEL
 
 
 # =========================================================
@@ -126,160 +135,60 @@ BATCH_SIZE = 100
 
 def get_embeddings_batch(
     text_batch: list[str],
-    retries: int = 3,
-    delay: int = 3,
 ) -> list[np.ndarray]:
     """
     OpenAI Embeddings APIからベクトルを取得する。
 
-    一時的なOpenAI APIエラーは再試行する。
-    RateLimit / quotaエラーは再試行せず終了する。
+    一時的なエラーの再試行・レート制限・並列化は
+    retrieval.update_index（embedding_pipeline）側で行う。
     """
 
-    for attempt in range(1, retries + 1):
-        try:
-            response = client.embeddings.create(
-                model=EMBED_MODEL,
-                input=text_batch,
-            )
-
-            vectors: list[np.ndarray] = [
-                np.asarray(
-                    item.embedding,
-                    dtype=np.float32,
-                )
-                for item in response.data
-            ]
-
-            return vectors
-
-        except RateLimitError as e:
-            print("")
-            print("❌ OpenAI API の利用上限または残高不足です。")
-            print(f"詳細: {e}")
-            print("")
-            print(
-                "OpenAI Platform の Billing を確認してください。"
-            )
-
-            # クレジット切れの場合、
-            # リトライしても解消しないため即終了
-            raise
-
-        except OpenAIError as e:
-            print(
-                f"⚠️ OpenAI API error "
-                f"(attempt {attempt}/{retries}): {e}"
-            )
-
-            if attempt >= retries:
-                raise RuntimeError(
-                    "OpenAI APIへの接続に複数回失敗しました。"
-                ) from e
-
-            print(
-                f"🔄 {delay}秒後に再試行します..."
-            )
-
-            time.sleep(delay)
-
-        except Exception as e:
-            print(
-                f"❌ 予期しないエラーが発生しました: {e}"
-            )
-            raise
-
-    # 型チェック対策
-    raise RuntimeError(
-        "Embedding取得処理が予期せず終了しました。"
+    response = client.embeddings.create(
+        model=EMBED_MODEL,
+        input=text_batch,
     )
 
+    return [
+        np.asarray(
+            item.embedding,
+            dtype=np.float32,
+        )
+        for item in response.data
+    ]
+
 
 # =========================================================
-# ベクトル生成
+# ベクトル・FAISSインデックス・マニフェスト生成
 # =========================================================
 
 print("🔄 ベクトルを再生成しています...")
 
-all_vectors: list[np.ndarray] = []
-
-for i in range(
-    0,
-    len(texts),
-    BATCH_SIZE,
-):
-    batch = texts[
-        i:i + BATCH_SIZE
-    ]
-
-    vectors = get_embeddings_batch(batch)
-
-    all_vectors.extend(vectors)
-
-    processed = min(
-        i + len(batch),
-        len(texts),
+# 現在の世代との差分（追加・削除・変更）だけを反映した新しい世代を作り、
+# 新しい行の Embedding もキャッシュに無いものだけを API で取得する
+# 取得済みのバッチは Embedding キャッシュに保存されるため、
+# 途中で失敗しても再実行すれば残りの分だけを取得する
+try:
+    generation, index = retrieval.publish_index(
+        corpus,
+        get_embeddings_batch,
+        model=EMBED_MODEL,
     )
 
+except RateLimitError as e:
+    print("")
+    print("❌ OpenAI API の利用上限または残高不足です。")
+    print(f"詳細: {e}")
+    print("")
     print(
-        f"✅ Processed {processed}/{len(texts)}"
-    )
-
-
-# =========================================================
-# ベクトルチェック
-# =========================================================
-
-if not all_vectors:
-    raise RuntimeError(
-        "Embeddingデータが生成されませんでした。"
-    )
-
-
-# =========================================================
-# NumPy配列へ変換
-# =========================================================
-
-vector_data = np.asarray(
-    all_vectors,
-    dtype=np.float32,
-)
-
-if vector_data.ndim != 2:
-    raise RuntimeError(
-        f"vector_data の形式が不正です。"
-        f" shape={vector_data.shape}"
+        "OpenAI Platform の Billing を確認してください。"
     )
 
+    # クレジット切れの場合、
+    # リトライしても解消しないため即終了
+    raise
 
-# =========================================================
-# FAISSインデックス生成
-# =========================================================
-
-dimension = int(vector_data.shape[1])
-
-index = faiss.IndexFlatL2(dimension)
-
-# faiss の型定義とPylanceの相性により
-# 誤検出される場合があるため type: ignore を指定
-index.add(vector_data)  # type: ignore
-
-
-# =========================================================
-# ベクトルデータ保存
-# =========================================================
-
-vector_path = "data/vector_data.npy"
-index_path = "data/index.faiss"
-
-np.save(
-    vector_path,
-    vector_data,
-)
-
-faiss.write_index(
-    index,
-    index_path,
+print(
+    f"✅ Processed {index.ntotal}/{len(corpus)}"
 )
 
 
@@ -288,9 +197,12 @@ faiss.write_index(
 # =========================================================
 
 print("")
-print(f"✅ ベクトルデータを保存しました: {vector_path}")
-print(f"✅ FAISSインデックスを保存しました: {index_path}")
+paths = retrieval.resolve_paths()
+print(f"✅ インデックスの世代を公開しました: {generation}")
+print(f"✅ ベクトルデータを保存しました: {paths['vector_path']}")
+print(f"✅ FAISSインデックスを保存しました: {paths['index_path']}")
+print(f"✅ マニフェストを保存しました: {paths['manifest_path']}")
 print("")
 print(
     "🎉 knowledge.json とベクトルデータの更新が完了しました。"
-)
\ No newline at end of file
+)
@@ -0,0 +1,67 @@
+"""
+インデックスの世代（data/generations/<世代名>/）の一覧表示・ロールバック・削除。
+
+  python scripts/index_generations.py list
+  python scripts/index_generations.py rollback            # 1つ前の世代に戻す
+  python scripts/index_generations.py rollback --to 20260101-030000-000-ab12cd34
+  python scripts/index_generations.py prune --keep 3
+
+切り替えは data/CURRENT を書き換えるだけのため、稼働中のアプリは INDEX_WATCH_INTERVAL 以内
+（すぐに反映する場合は /admin/reload）に新しい世代を読み込む。
+ロールバックした世代は固定され、再起動時に data/ のコーパスから自動で公開し直すことはない
+（固定は次に rebuild_index.py などで公開したときに外れる）。
+"""
+import argparse
+import logging
+import os
+import sys
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generations  # noqa: E402
+import retrieval  # noqa: E402
+
+# retrieval などのライブラリは進捗をロガーに出すため、そのまま表示する
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def show_generations():
+    current = generations.current_generation()
+    pinned = generations.is_pinned()
+    names = generations.list_generations()
+    if not names:
+        print("ℹ️ 公開済みの世代はありません（data/ 直下のファイルを使用中）")
+        return
+    for name in names:
+        manifest = retrieval.read_manifest(generations.generation_paths(name)["manifest_path"]) or {}
+        mark = "▶" if name == current else " "
+        print(f"{mark} {name}  作成 {manifest.get('created_at', '-')}  件数 {manifest.get('count', '-')}"
+              f"  モデル {manifest.get('model', '-')}" + ("  📌 固定" if name == current and pinned else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="インデックスの世代の管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="世代の一覧（▶ が現在の世代）")
+    rollback = sub.add_parser("rollback", help="現在の世代を切り替える")
+    rollback.add_argument("--to", help="切り替え先の世代名（省略時は1つ前）")
+    prune = sub.add_parser("prune", help="古い世代を削除する")
+    prune.add_argument("--keep", type=int, default=generations.KEEP_GENERATIONS)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        show_generations()
+    elif args.command == "rollback":
+        try:
+            name = generations.rollback(to=args.to)
+        except (RuntimeError, FileNotFoundError) as e:
+            sys.exit(f"❌ {e}")
+        print(f"⏪ 現在の世代を {name} に切り替えました（次に公開するまで固定されます）")
+    elif args.command == "prune":
+        removed = generations.prune(keep=args.keep)
+        print(f"🧹 {len(removed)} 世代を削除しました: {', '.join(removed) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
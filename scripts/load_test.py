@@ -0,0 +1,271 @@
+"""
+/chat・/chat/stream・/feedback の負荷試験。
+
+目標 RPS で一定間隔にリクエストを送り（応答を待たずに次を送るオープンループ）、
+スループット・エンドポイント別レイテンシ・段階別レイテンシ（Server-Timing ヘッダー）・
+エラー率を集計する。レイテンシは予定送信時刻から測るため、サーバーが詰まって送信が
+遅れた分も含まれる。
+
+  # OpenAI・Sheets の代わりにモックを使う場合（scripts/mock_services.py の説明を参照）
+  python scripts/mock_services.py --port 8900 &
+  OPENAI_BASE_URL=http://127.0.0.1:8900/v1 SHEETS_API_ENDPOINT=http://127.0.0.1:8900/ \\
+      EMBED_CACHE_PATH=/tmp/loadtest_embedding_cache.sqlite3 gunicorn app:app -w 4 -b 127.0.0.1:5000 &
+  python scripts/load_test.py --url http://127.0.0.1:5000 --rps 20 --duration 60 --mock-url http://127.0.0.1:8900
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+LABELS_PATH = "data/benchmark/queries.csv"
+FAQ_PATH = "data/faq.json"
+EXTRA_QUESTIONS = [
+    "VFR型で使えるフィルムは？",
+    "X型の白光沢フィルムで使える印刷色は？",
+    "黒の印刷に対応している製品は？",
+    "こんにちは",
+]
+PERCENTILES = [50, 90, 95, 99]
+
+
+def load_questions():
+    questions = list(EXTRA_QUESTIONS)
+    if os.path.exists(LABELS_PATH):
+        with open(LABELS_PATH, "r", encoding="utf-8", newline="") as f:
+            questions += [row["query"] for row in csv.DictReader(f) if row.get("query")]
+    if os.path.exists(FAQ_PATH):
+        with open(FAQ_PATH, "r", encoding="utf-8") as f:
+            questions += [item["question"] for item in json.load(f)]
+    return questions
+
+
+def parse_server_timing(header):
+    """「name;dur=12.3, name2;dur=4」形式を {name: ミリ秒} にする"""
+    stages = {}
+    for part in (header or "").split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        for param in params:
+            if param.startswith("dur="):
+                try:
+                    stages[name] = float(param[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+class SessionPool:
+    """一定数の会話を並行させ、turns 回やり取りした会話は新しいセッションに入れ替える"""
+
+    def __init__(self, size, turns):
+        self.turns = turns
+        self._sessions = [[f"loadtest-{i}", 0] for i in range(size)]
+        self._next_id = size
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            session = random.choice(self._sessions)
+            if session[1] >= self.turns:
+                session[0] = f"loadtest-{self._next_id}"
+                session[1] = 0
+                self._next_id += 1
+            session[1] += 1
+            return session[0]
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.questions = load_questions()
+        self.sessions = SessionPool(args.sessions, args.turns)
+        self.results = []
+        self._lock = threading.Lock()
+
+    def _post(self, path, payload, stream=False):
+        request = urllib.request.Request(
+            self.args.url.rstrip("/") + path,
+            data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        sent = time.perf_counter()
+        ttfb = None
+        try:
+            with urllib.request.urlopen(request, timeout=self.args.timeout) as response:
+                status = response.status
+                timing = response.headers.get("Server-Timing")
+                if stream:
+                    body = {}
+                    event = None
+                    for raw in response:
+                        line = raw.decode("utf-8").strip()
+                        if line.startswith("event:"):
+                            event = line[6:].strip()
+                            if event == "delta" and ttfb is None:
+                                ttfb = (time.perf_counter() - sent) * 1000
+                        elif line.startswith("data:") and event in ("done", "error"):
+                            body = json.loads(line[5:])
+                            if event == "error":
+                                status = 500
+                else:
+                    body = json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            status, timing, body = e.code, e.headers.get("Server-Timing"), {}
+        except Exception as e:
+            status, timing, body = "error", None, {"error": str(e)}
+        return status, timing, body, sent, ttfb
+
+    def _record(self, endpoint, scheduled, status, timing, sent, ttfb):
+        done = time.perf_counter()
+        with self._lock:
+            self.results.append({
+                "endpoint": endpoint,
+                "status": status,
+                "latency_ms": (done - scheduled) * 1000,
+                "queue_ms": (sent - scheduled) * 1000,
+                "ttfb_ms": ttfb,
+                "stages": parse_server_timing(timing),
+            })
+
+    def one_request(self, scheduled):
+        session_id = self.sessions.take()
+        question = random.choice(self.questions)
+        stream = random.random() < self.args.stream_ratio
+        endpoint = "/chat/stream" if stream else "/chat"
+        status, timing, body, sent, ttfb = self._post(endpoint, {"question": question, "session_id": session_id}, stream)
+        self._record(endpoint, scheduled, status, timing, sent, ttfb)
+
+        if status == 200 and body.get("response") and random.random() < self.args.feedback_ratio:
+            scheduled = time.perf_counter()
+            status, timing, _, sent, _ = self._post("/feedback", {
+                "question": question,
+                "answer": body["response"],
+                "feedback": random.choice(["good", "bad"]),
+                "reason": "",
+            })
+            self._record("/feedback", scheduled, status, timing, sent, None)
+
+    def run(self):
+        total = int(self.args.rps * self.args.duration)
+        interval = 1.0 / self.args.rps
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            for i in range(total):
+                scheduled = start + i * interval
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.one_request, scheduled)
+        return time.perf_counter() - start
+
+
+def fetch_mock_stats(mock_url):
+    try:
+        with urllib.request.urlopen(mock_url.rstrip("/") + "/_stats", timeout=5) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except Exception as e:
+        print("⚠️ モックの統計を取得できませんでした:", e)
+        return None
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    summary = {f"p{p}": round(float(np.percentile(values, p)), 1) for p in PERCENTILES}
+    summary["max"] = round(float(max(values)), 1)
+    return summary
+
+
+def summarize(results, elapsed, mock_before, mock_after):
+    report = {"elapsed_s": round(elapsed, 2), "requests": len(results), "endpoints": {}, "stages": {}}
+    ok = [r for r in results if r["status"] == 200]
+    report["throughput_rps"] = round(len(ok) / elapsed, 2) if elapsed else 0.0
+
+    for endpoint in sorted({r["endpoint"] for r in results}):
+        rows = [r for r in results if r["endpoint"] == endpoint]
+        statuses = {}
+        for r in rows:
+            statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+        ok_rows = [r for r in rows if r["status"] == 200]
+        report["endpoints"][endpoint] = {
+            "requests": len(rows),
+            "error_rate": round(1 - len(ok_rows) / len(rows), 4),
+            "statuses": statuses,
+            "latency_ms": percentiles([r["latency_ms"] for r in ok_rows]),
+            "queue_ms": percentiles([r["queue_ms"] for r in ok_rows]),
+            "ttfb_ms": percentiles([r["ttfb_ms"] for r in ok_rows if r["ttfb_ms"] is not None]),
+        }
+
+    stage_names = sorted({name for r in ok for name in r["stages"]})
+    for name in stage_names:
+        report["stages"][name] = percentiles([r["stages"][name] for r in ok if name in r["stages"]])
+
+    if mock_before and mock_after:
+        report["mock_calls"] = {
+            service: {key: mock_after[service][key] - mock_before.get(service, {}).get(key, 0) for key in stats}
+            for service, stats in mock_after.items()
+        }
+    return report
+
+
+def print_report(report):
+    print(f"\n📊 {report['requests']} リクエスト / {report['elapsed_s']} 秒 / 成功スループット {report['throughput_rps']} rps")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"\n  {endpoint}  件数={stats['requests']}  エラー率={stats['error_rate']:.2%}  ステータス={stats['statuses']}")
+        for key in ("latency_ms", "queue_ms", "ttfb_ms"):
+            if stats[key]:
+                print(f"    {key:<11} " + "  ".join(f"{k}={v}" for k, v in stats[key].items()))
+    if report["stages"]:
+        print("\n  段階別（Server-Timing, ms）")
+        for name, stats in report["stages"].items():
+            print(f"    {name:<16} " + "  ".join(f"{k}={v}" for k, v in stats.items()))
+    if report.get("mock_calls"):
+        print("\n  モックへの呼び出し")
+        for service, stats in report["mock_calls"].items():
+            print(f"    {service:<11} " + "  ".join(f"{k}={v}" for k, v in stats.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャット API の負荷試験")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--rps", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=30.0, help="送信を続ける秒数")
+    parser.add_argument("--concurrency", type=int, default=128, help="同時に待ち合わせるリクエストの上限")
+    parser.add_argument("--sessions", type=int, default=50, help="並行する会話の数")
+    parser.add_argument("--turns", type=int, default=5, help="1会話あたりの質問数")
+    parser.add_argument("--stream-ratio", type=float, default=0.0, help="/chat/stream に送る割合")
+    parser.add_argument("--feedback-ratio", type=float, default=0.1, help="回答後に /feedback を送る割合")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--mock-url", help="mock_services.py の URL（呼び出し回数を集計に含める）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="集計結果を JSON で保存する")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    test = LoadTest(args)
+    if not test.questions:
+        sys.exit("❌ 質問データがありません")
+
+    print(f"🚀 {args.url} に {args.rps} rps で {args.duration} 秒送信します（会話 {args.sessions} 件）")
+    mock_before = fetch_mock_stats(args.mock_url) if args.mock_url else None
+    elapsed = test.run()
+    mock_after = fetch_mock_stats(args.mock_url) if args.mock_url else None
+
+    report = summarize(test.results, elapsed, mock_before, mock_after)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+キーワード抽出・マトリクス回答の回帰チェック。
+
+変更前の実装で記録した出力（data/benchmark/keyword_baseline.json）と現在の
+extract_keywords を比べ、記録に無い差分があれば終了コード 1（CI でゲートする）。
+ProductFilmMatcher の各メソッドも同様に data/benchmark/matcher_baseline.json と比べる
+（一覧の並び順も回答文にそのまま出るため、順序まで一致を求める）。
+製品ごとのフィルムの並びを入れ替えたマトリクスでも、マトリクス上の順で返すことを確かめる。
+あわせて、マトリクスの各製品について「<製品>に使えるフィルムは？」の振り分けを確かめる
+（フィルムが登録された製品は定型文で答え、空の製品は LLM に回す）。
+色を尋ねる質問など、定型文では誤った答えになる質問（MATRIX_ROUTE_CASES）も確かめる。
+
+  python scripts/matcher_regression.py
+
+  # 差分を確認したうえで、現在の出力を意図した差分（expected）として記録する
+  python scripts/matcher_regression.py --accept
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_router import IntentRouter  # noqa: E402
+from keyword_filter import MATRIX_PATH, _strip_note, extract_keywords  # noqa: E402
+from product_film_matcher import ProductFilmMatcher  # noqa: E402
+
+KEYWORD_BASELINE_PATH = "data/benchmark/keyword_baseline.json"
+MATCHER_BASELINE_PATH = "data/benchmark/matcher_baseline.json"
+
+# (質問, 定型文で答えるべきか)
+MATRIX_ROUTE_CASES = [
+    # 定型文の一覧が尋ねられた色を扱っていない → LLM
+    ("黒光沢フィルムで青色が使える製品は？", False),
+    ("クラフト包材で白色を使える製品はありますか？", False),
+    ("X型で黒色が使えるフィルムは？", False),
+    ("X型の赤フィルムで青色は使える色ですか？", False),
+    # フィルム名の一部の色（「黒光沢」の「黒」）は尋ねられた色に数えない
+    ("黒光沢フィルムが使える製品は？", True),
+    ("VFR型の白光沢フィルムで使える色は？", True),
+    ("青色が使える製品は？", True),
+]
+
+
+def _load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def check_keywords(baseline):
+    """(記録どおりの件数, 記録に無い差分 [(テキスト, 期待, 現在)]) を返す"""
+    passed, failures = 0, []
+    for row in baseline["texts"]:
+        expected = row.get("expected", row["baseline"])
+        current = extract_keywords(row["text"])
+        if current == expected:
+            passed += 1
+        else:
+            failures.append((row["text"], expected, current))
+    return passed, failures
+
+
+def accept_keywords(baseline):
+    """現在の出力を expected として記録する（変更前と同じなら expected を消す）"""
+    for row in baseline["texts"]:
+        current = extract_keywords(row["text"])
+        if current == row["baseline"]:
+            row.pop("expected", None)
+        else:
+            row["expected"] = current
+    return sum("expected" in row for row in baseline["texts"])
+
+
+def check_matcher_calls(baseline, matrix_path=MATRIX_PATH):
+    """(記録どおりの件数, 記録に無い差分 [(呼び出し, 期待, 現在)]) を返す"""
+    matcher = ProductFilmMatcher(matrix_path)
+    passed, failures = 0, []
+    for row in baseline["calls"]:
+        expected = row.get("expected", row["baseline"])
+        current = getattr(matcher, row["method"])(*row["args"])
+        if current == expected:
+            passed += 1
+        else:
+            failures.append((f"{row['method']}{tuple(row['args'])}", expected, current))
+    return passed, failures
+
+
+def accept_matcher_calls(baseline, matrix_path=MATRIX_PATH):
+    matcher = ProductFilmMatcher(matrix_path)
+    for row in baseline["calls"]:
+        current = getattr(matcher, row["method"])(*row["args"])
+        if current == row["baseline"]:
+            row.pop("expected", None)
+        else:
+            row["expected"] = current
+    return sum("expected" in row for row in baseline["calls"])
+
+
+def check_matrix_order(matrix_path=MATRIX_PATH):
+    """製品ごとにフィルムの並びを逆にしたマトリクスで、返す順序がマトリクス上の順かを確かめる"""
+    matrix = _load(matrix_path)
+    reordered = {
+        product: dict(reversed(list(films.items())))
+        for product, films in reversed(list(matrix.items()))
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "matrix.json")
+        _save(path, reordered)
+        matcher = ProductFilmMatcher(path)
+
+    words = sorted({word for films in reordered.values() for film in films for word in (film, film[:1], film[-2:])})
+    checked, failures = 0, []
+    for product, films in reordered.items():
+        for word in words:
+            first = next((film for film in films if word in film), None)
+            result = matcher.get_colors_for_film_in_product(product, word)
+            checked += 1
+            if (result.get("film") if result["matched"] else None) != first:
+                failures.append((f"get_colors_for_film_in_product{(product, word)}", first, result.get("film")))
+    for word in words:
+        expected = [product for product, films in reordered.items() if any(word in film for film in films)]
+        result = matcher.get_products_for_film(word)
+        checked += 1
+        if result.get("products", []) != expected:
+            failures.append((f"get_products_for_film{(word,)}", expected, result.get("products")))
+    return checked, failures
+
+
+def check_matrix_routes(matrix_path=MATRIX_PATH):
+    """(確認した件数, 誤った振り分け [(質問, 期待, 実際の回答)]) を返す"""
+    matrix = _load(matrix_path)
+    matcher = ProductFilmMatcher(matrix_path)
+    router = IntentRouter()
+    cases = [(f"{_strip_note(product)}に使えるフィルムは？", bool(films)) for product, films in matrix.items()]
+    cases += MATRIX_ROUTE_CASES
+    failures = []
+    for question, local in cases:
+        routed = router._route_matrix(question, [], matcher.match(question))
+        answer = routed[1] if routed else None
+        if local != bool(answer):
+            failures.append((question, "定型文" if local else "LLM", answer))
+    return len(cases), failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="キーワード抽出・マトリクス回答の回帰チェック")
+    parser.add_argument("--keywords", default=KEYWORD_BASELINE_PATH)
+    parser.add_argument("--matcher", default=MATCHER_BASELINE_PATH)
+    parser.add_argument("--matrix", default=MATRIX_PATH)
+    parser.add_argument("--accept", action="store_true", help="現在の出力を意図した差分として記録する")
+    args = parser.parse_args()
+
+    baseline = _load(args.keywords)
+    matcher_baseline = _load(args.matcher)
+    if args.accept:
+        changed = accept_keywords(baseline)
+        _save(args.keywords, baseline)
+        print(f"✅ 変更前と異なる {changed} 件を意図した差分として記録しました: {args.keywords}")
+        changed = accept_matcher_calls(matcher_baseline, args.matrix)
+        _save(args.matcher, matcher_baseline)
+        print(f"✅ 変更前と異なる {changed} 件を意図した差分として記録しました: {args.matcher}")
+        return
+
+    passed, failures = check_keywords(baseline)
+    intended = sum("expected" in row for row in baseline["texts"])
+    print(f"📊 キーワード抽出: {passed}/{len(baseline['texts'])} 件が記録どおり（うち意図した差分 {intended} 件）")
+    if failures:
+        print("❌ 記録に無い差分があります:")
+        for text, expected, current in failures:
+            print(f"  - {text[:40]}\n      期待: {expected}\n      現在: {current}")
+
+    calls = matcher_baseline["calls"]
+    matcher_passed, matcher_failures = check_matcher_calls(matcher_baseline, args.matrix)
+    intended = sum("expected" in row for row in calls)
+    print(f"📊 マトリクス検索: {matcher_passed}/{len(calls)} 件が記録どおり（うち意図した差分 {intended} 件）")
+    if matcher_failures:
+        print("❌ 記録に無い差分があります:")
+        for call, expected, current in matcher_failures:
+            print(f"  - {call}\n      期待: {expected}\n      現在: {current}")
+
+    order_checked, order_failures = check_matrix_order(args.matrix)
+    print(f"📊 並び順: {order_checked - len(order_failures)}/{order_checked} 件がマトリクス上の順")
+    if order_failures:
+        print("❌ マトリクス上の順と異なります:")
+        for call, expected, current in order_failures[:20]:
+            print(f"  - {call}\n      期待: {expected}\n      現在: {current}")
+    matcher_failures += order_failures
+
+    checked, route_failures = check_matrix_routes(args.matrix)
+    print(f"📊 マトリクス回答: {checked - len(route_failures)}/{checked} 件で期待どおり")
+    if route_failures:
+        print("❌ 振り分けが期待と異なります:")
+        for question, expected, answer in route_failures:
+            print(f"  - {question} 期待: {expected} / 実際: {answer!r}")
+
+    if failures or matcher_failures or route_failures:
+        sys.exit(1)
+    print("✅ 記録に無い差分はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+負荷試験用の OpenAI / Google Sheets のローカル代替サーバー。
+
+Embeddings・Chat Completions（stream 含む）・values().append に応答し、
+サービスごとに応答遅延とエラー（429 / 500）を注入できる。
+
+  python scripts/mock_services.py --port 8900 --chat-latency-ms 800 --chat-error-rate 0.01
+
+app.py 側は次の環境変数でこのサーバーに向ける（実データを汚さないよう作業用の
+コピー（git worktree など）で起動し、埋め込みキャッシュも別ファイルにする）:
+
+  OPENAI_BASE_URL=http://127.0.0.1:8900/v1
+  SHEETS_API_ENDPOINT=http://127.0.0.1:8900/
+  EMBED_CACHE_PATH=/tmp/loadtest_embedding_cache.sqlite3
+
+Embedding は文字 n-gram の特徴ハッシュによる決定的な疑似ベクトルのため、
+INDEX_AUTO_REBUILD=1 ならインデックスもこのサーバーの Embedding で作り直される。
+GET /_stats でサービスごとの呼び出し回数・注入したエラー数を返す。
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import unicodedata
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBED_DIM = 1536
+HASH_NGRAM_SIZES = (1, 2, 3)
+MOCK_ANSWER = "お問い合わせありがとうございます。こちらは負荷試験用のモック回答です。詳しくはお問い合わせフォームよりご連絡ください。"
+SHEETS_APPEND_RE = re.compile(r"^/v4/spreadsheets/([^/]+)/values/(.+):append$")
+
+
+@lru_cache(maxsize=200000)
+def _hash_feature(gram, dim):
+    h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+    return h % dim, (1.0 if h >> 63 else -1.0)
+
+
+def hashed_embedding(text, dim=EMBED_DIM):
+    vector = [0.0] * dim
+    chars = "".join(unicodedata.normalize("NFKC", text).lower().split())
+    for n in HASH_NGRAM_SIZES:
+        for i in range(len(chars) - n + 1):
+            index, sign = _hash_feature(chars[i:i + n], dim)
+            vector[index] += sign
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+class ServiceProfile:
+    """サービスごとの遅延・エラー注入設定と呼び出し回数"""
+
+    def __init__(self, latency_ms, jitter, error_rate, error_status):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        if self.latency_ms > 0:
+            spread = self.latency_ms * self.jitter
+            time.sleep(max(0.0, random.uniform(self.latency_ms - spread, self.latency_ms + spread)) / 1000)
+
+    def should_fail(self, items=1):
+        with self._lock:
+            self.requests += 1
+            self.items += items
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "items": self.items, "errors": self.errors}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profiles = {}
+    stream_chunks = 8
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- 共通 ---
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body) if body else {}
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, profile):
+        status = profile.error_status
+        headers = {"Retry-After": "1"} if status == 429 else None
+        self._send_json(status, {"error": {"message": f"injected {status}", "type": "mock_error"}}, headers)
+
+    # --- ルーティング ---
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            self._send_json(200, {name: profile.stats() for name, profile in self.profiles.items()})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        data = self._read_json()
+        if path == "/v1/embeddings":
+            self._embeddings(data)
+        elif path == "/v1/chat/completions":
+            self._chat(data)
+        elif SHEETS_APPEND_RE.match(path):
+            self._sheets_append(path, data)
+        else:
+            self._send_json(404, {"error": {"message": f"not found: {path}"}})
+
+    # --- OpenAI ---
+
+    def _embeddings(self, data):
+        texts = data.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        profile = self.profiles["embeddings"]
+        profile.delay()
+        if profile.should_fail(len(texts)):
+            return self._send_error(profile)
+        tokens = sum(len(text) for text in texts)
+        self._send_json(200, {
+            "object": "list",
+            "model": data.get("model"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": hashed_embedding(text, data.get("dimensions") or EMBED_DIM)}
+                for i, text in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def _chat(self, data):
+        profile = self.profiles["chat"]
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in data.get("messages", []))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(MOCK_ANSWER),
+            "total_tokens": prompt_tokens + len(MOCK_ANSWER),
+        }
+        common = {"id": f"chatcmpl-mock-{random.getrandbits(32):08x}", "created": int(time.time()), "model": data.get("model")}
+
+        if not data.get("stream"):
+            profile.delay()
+            if profile.should_fail():
+                return self._send_error(profile)
+            return self._send_json(200, {
+                **common,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": MOCK_ANSWER}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        # stream: 遅延の半分を最初のトークンまで、残りをチャンク間に割り振る
+        first_delay = profile.latency_ms / 2
+        time.sleep(first_delay / 1000)
+        if profile.should_fail():
+            return self._send_error(profile)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        size = -(-len(MOCK_ANSWER) // self.stream_chunks)
+        pieces = [MOCK_ANSWER[i:i + size] for i in range(0, len(MOCK_ANSWER), size)]
+        for i, piece in enumerate(pieces):
+            chunk = {**common, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if i < len(pieces) - 1:
+                time.sleep(first_delay / max(1, len(pieces) - 1) / 1000)
+        last = {**common, "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        self.wfile.write(f"data: {json.dumps(last, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+        self.close_connection = True
+
+    # --- Google Sheets ---
+
+    def _sheets_append(self, path, data):
+        spreadsheet_id, range_ = SHEETS_APPEND_RE.match(path).groups()
+        rows = data.get("values") or []
+        profile = self.profiles["sheets"]
+        profile.delay()
+        if profile.should_fail(len(rows)):
+            return self._send_error(profile)
+        self._send_json(200, {
+            "spreadsheetId": spreadsheet_id,
+            "tableRange": range_,
+            "updates": {"spreadsheetId": spreadsheet_id, "updatedRange": range_, "updatedRows": len(rows)},
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI / Google Sheets のローカル代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--jitter", type=float, default=0.2, help="遅延のばらつき（遅延に対する比率）")
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    for name, latency in (("embed", 80), ("chat", 1200), ("sheets", 300)):
+        parser.add_argument(f"--{name}-latency-ms", type=float, default=latency)
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+        parser.add_argument(f"--{name}-error-status", type=int, default=500, choices=[429, 500, 503])
+    args = parser.parse_args()
+
+    MockHandler.stream_chunks = args.stream_chunks
+    MockHandler.profiles = {
+        service: ServiceProfile(
+            getattr(args, f"{name}_latency_ms"), args.jitter,
+            getattr(args, f"{name}_error_rate"), getattr(args, f"{name}_error_status"),
+        )
+        for service, name in (("embeddings", "embed"), ("chat", "chat"), ("sheets", "sheets"))
+    }
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f"🧪 モックサーバーを起動しました: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+"""
+検索品質・速度のオフラインベンチマーク。
+
+ラベル付きの質問（data/benchmark/queries.csv）で検索構成ごとに
+recall@k・MRR・検索レイテンシ（p50/p95）・インデックスのメモリ量を測る。
+
+  # API を使わない決定的なハッシュ Embedding で測る（既定）
+  python scripts/retrieval_benchmark.py
+
+  # 埋め込みキャッシュ（data/embedding_cache.sqlite3）の本番 Embedding で測る
+  python scripts/retrieval_benchmark.py --embedder cached
+
+  # 基準値と比べ、悪化していれば終了コード 1（CI でインデックス変更をゲートする）
+  python scripts/retrieval_benchmark.py --baseline data/benchmark/baseline.json
+
+  # faq_suggestions / feedback_log シートを CSV で書き出したものから質問を取り込む
+  python scripts/retrieval_benchmark.py --seed-from faq_suggestions.csv
+
+  # 近似最近傍インデックス（INDEX_TYPE）の精度と速度を flat と比べる（10 万件に水増し）
+  python scripts/retrieval_benchmark.py --index-types flat,hnsw,ivfpq,sq8 --scale 100000 --ef-search 16,64,128 --nprobe 1,8,32
+
+  # ivfpq の既定値（IVF_NPROBE・IVF_REFINE_K_FACTOR）を選んだときの測り方（recall@k 0.9 以上が目標）
+  python scripts/retrieval_benchmark.py --index-types flat,ivfpq --scale 100000 --nprobe 8,16 --k-factor 16,32
+
+  # 次元数・保存形式（EMBED_DIMENSIONS・VECTOR_STORAGE）ごとに測り、本来の次元数から
+  # recall@k・MRR が下がらない最小の組み合わせを示す
+  python scripts/retrieval_benchmark.py --embedder cached --dimensions 256,512,768,1024,1536 --storages float32,float16,int8
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from functools import lru_cache
+
+import faiss
+import numpy as np
+
+# リポジトリ直下の共通モジュールを読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import retrieval  # noqa: E402
+from embedding_cache import EmbeddingCache, cached_embed, normalize_query, normalize_text, text_key  # noqa: E402
+
+LABELS_PATH = "data/benchmark/queries.csv"
+HASH_DIM = 512
+HASH_NGRAM_SIZES = (1, 2, 3)
+DEFAULT_KS = [1, 3, 5, 7]
+CONFIGS = ["vector", "lexical", "hybrid"]
+# 閾値で切らずに順位そのものを比べるための設定（コサイン類似度は -1 以上）
+NO_THRESHOLDS = {"min_scores": {"faq": -1.0, "knowledge": -1.0}, "margin": 2.0}
+# 件数を水増しする際、実文書のベクトルに加えるノイズの大きさ（ノルム）
+SCALE_NOISE = 0.5
+
+
+# =========================================================
+# Embedding
+# =========================================================
+
+@lru_cache(maxsize=None)
+def _hash_feature(gram):
+    h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+    return h % HASH_DIM, (1.0 if h >> 63 else -1.0)
+
+
+def hashed_embed(texts):
+    """文字 n-gram の特徴ハッシュによる決定的な疑似 Embedding（API・乱数を使わない）"""
+    vectors = np.zeros((len(texts), HASH_DIM), dtype="float32")
+    for row, text in enumerate(texts):
+        chars = "".join(normalize_text(text).lower().split())
+        for n in HASH_NGRAM_SIZES:
+            for i in range(len(chars) - n + 1):
+                index, sign = _hash_feature(chars[i:i + n])
+                vectors[row, index] += sign
+    return vectors
+
+
+def cached_vectors(texts, model, query=False, fetch=False):
+    """
+    埋め込みキャッシュから取り出す。質問は QueryEmbeddingCache の共有キャッシュも参照する。
+
+    fetch=True の場合、キャッシュに無いものだけ OpenAI API で取得して保存する。
+    """
+    cache = EmbeddingCache()
+    found = {}
+    if query:
+        keys = {text: normalize_query(text) for text in texts}
+        shared = cache.get_many(f"{model}#query", list(keys.values()))
+        found = {text: shared[text_key(key)] for text, key in keys.items() if text_key(key) in shared}
+    rest = [text for text in texts if text not in found]
+    stored = cache.get_many(model, rest)
+    found.update({text: stored[text_key(text)] for text in rest if text_key(text) in stored})
+
+    missing = [text for text in texts if text not in found]
+    if missing:
+        if not fetch:
+            raise SystemExit(
+                f"❌ 埋め込みキャッシュに無いテキストが {len(missing)} 件あります"
+                "（--fetch-missing で取得するか、--embedder hashed を使ってください）"
+            )
+        from openai import OpenAI
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+        def embed_batch(batch):
+            response = client.embeddings.create(model=model, input=batch)
+            return [item.embedding for item in response.data]
+
+        vectors = cached_embed(missing, embed_batch, model, cache=cache)
+        found.update(zip(missing, vectors))
+    return np.vstack([found[text] for text in texts]).astype("float32")
+
+
+# =========================================================
+# ラベル
+# =========================================================
+
+def doc_matches(doc, spec):
+    """期待文書の指定（faq:質問文 / knowledge:カテゴリ）に文書が該当するか"""
+    source, _, value = spec.partition(":")
+    if doc["source"] != source:
+        return False
+    if source == "faq":
+        return doc["key"] == value
+    return doc["key"].split("\n")[0] == value
+
+
+def load_labels(path, corpus):
+    labels = []
+    unlabeled = 0
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            query = (row.get("query") or "").strip()
+            specs = [spec.strip() for spec in (row.get("expected") or "").split("|") if spec.strip()]
+            if not query:
+                continue
+            if not specs:
+                unlabeled += 1
+                continue
+            expected = {doc["id"] for doc in corpus.docs if any(doc_matches(doc, spec) for spec in specs)}
+            if not expected:
+                print(f"⚠️ 期待文書がコーパスに見つかりません（スキップ）: {query} → {'|'.join(specs)}")
+                continue
+            labels.append({"query": query, "expected": expected})
+    if unlabeled:
+        print(f"ℹ️ expected が未記入の質問 {unlabeled} 件は評価対象外です")
+    return labels
+
+
+def seed_labels(export_paths, labels_path):
+    """シートの CSV 書き出しから質問列を取り込み、expected を空欄にしてラベルファイルへ追記する"""
+    existing = set()
+    if os.path.exists(labels_path):
+        with open(labels_path, "r", encoding="utf-8", newline="") as f:
+            existing = {(row.get("query") or "").strip() for row in csv.DictReader(f)}
+
+    new_queries = []
+    for path in export_paths:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.reader(f))
+        if not rows:
+            continue
+        header = [cell.strip().lower() for cell in rows[0]]
+        column = next((i for i, name in enumerate(header) if name in ("question", "質問")), None)
+        if column is None:
+            # faq_suggestions / feedback_log はいずれも B 列が質問（見出し行なし）
+            column = 1
+        else:
+            rows = rows[1:]
+        for row in rows:
+            query = row[column].strip() if len(row) > column else ""
+            if query and query not in existing:
+                existing.add(query)
+                new_queries.append(query)
+
+    os.makedirs(os.path.dirname(labels_path), exist_ok=True)
+    write_header = not os.path.exists(labels_path)
+    with open(labels_path, "a", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(["query", "expected"])
+        for query in new_queries:
+            writer.writerow([query, ""])
+    print(f"✅ {len(new_queries)} 件の質問を {labels_path} に追加しました（expected 列を記入してください）")
+
+
+# =========================================================
+# 計測
+# =========================================================
+
+def search(snap, config, q_vector, query, k, thresholds):
+    if config == "vector":
+        return snap.search(q_vector, k=k, **thresholds)
+    if config == "lexical":
+        return snap.search(None, query=query, k=k)
+    return snap.search(q_vector, query=query, k=k, **thresholds)
+
+
+def memory_bytes(snap, config):
+    sizes = {}
+    if config in ("vector", "hybrid"):
+        sizes["index_bytes"] = int(faiss.serialize_index(snap.index).nbytes)
+    if config in ("lexical", "hybrid"):
+        sizes["lexical_bytes"] = len(json.dumps(snap.lexical.to_dict(), ensure_ascii=False).encode("utf-8"))
+    return sizes
+
+
+def evaluate(snap, config, labels, q_vectors, ks, repeat, thresholds):
+    k = max(ks)
+    recall = {n: 0 for n in ks}
+    reciprocal_ranks = []
+    latencies = []
+    for label, q_vector in zip(labels, q_vectors):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            hits = search(snap, config, q_vector, label["query"], k, thresholds)
+            latencies.append((time.perf_counter() - start) * 1000)
+        ranks = [rank for rank, (doc, _) in enumerate(hits, start=1) if doc["id"] in label["expected"]]
+        first = ranks[0] if ranks else None
+        for n in ks:
+            if first is not None and first <= n:
+                recall[n] += 1
+        reciprocal_ranks.append(1.0 / first if first else 0.0)
+
+    total = len(labels)
+    result = {f"recall@{n}": round(recall[n] / total, 4) for n in ks}
+    result["mrr"] = round(sum(reciprocal_ranks) / total, 4)
+    result["p50_ms"] = round(float(np.percentile(latencies, 50)), 3)
+    result["p95_ms"] = round(float(np.percentile(latencies, 95)), 3)
+    result.update(memory_bytes(snap, config))
+    return result
+
+
+def scaled_vectors(doc_vectors, scale, seed):
+    """実文書のベクトルにノイズを加えた疑似文書で scale 件に水増しする（正規化済み）"""
+    vectors = retrieval.normalize_vectors(doc_vectors)
+    if scale <= len(vectors):
+        return vectors
+    rng = np.random.default_rng(seed)
+    base = vectors[rng.integers(0, len(vectors), scale - len(vectors))]
+    noise = rng.standard_normal(base.shape).astype("float32") * (SCALE_NOISE / np.sqrt(vectors.shape[1]))
+    return np.vstack([vectors, retrieval.normalize_vectors(base + noise)])
+
+
+def knob_settings(spec, ef_search, nprobe, k_factor):
+    """[(表示名, configure_search の引数)] を返す"""
+    if spec["type"] == "hnsw":
+        return [(f"efSearch={value}", {"ef_search": value}) for value in ef_search]
+    if spec["type"] == "ivfpq":
+        return [(f"nprobe={n} k_factor={f}", {"nprobe": n, "k_factor": f}) for n in nprobe for f in k_factor]
+    return [("", {})]
+
+
+def ann_report(vectors, q_vectors, index_types, k, repeat, ef_search, nprobe, k_factor):
+    """
+    インデックスの種類・探索範囲ごとに、flat の上位 k 件に対する recall@k、
+    1 クエリの検索レイテンシ、構築時間、シリアライズ後のサイズを測る。
+    """
+    ids = np.arange(len(vectors), dtype="int64")
+    queries = retrieval.normalize_vectors(q_vectors)
+    exact = retrieval.create_index(vectors, ids, retrieval.index_spec(len(vectors), vectors.shape[1], "flat"))
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        spec = retrieval.index_spec(len(vectors), int(vectors.shape[1]), index_type)
+        start = time.perf_counter()
+        index = retrieval.create_index(vectors, ids, spec)
+        build_s = time.perf_counter() - start
+        size = int(faiss.serialize_index(index).nbytes)
+        for knob, settings in knob_settings(spec, ef_search, nprobe, k_factor):
+            retrieval.configure_search(index, **settings)
+            latencies = []
+            for _ in range(repeat):
+                for q in queries:
+                    start = time.perf_counter()
+                    index.search(q[None, :], k)
+                    latencies.append((time.perf_counter() - start) * 1000)
+            _, found = index.search(queries, k)
+            overlap = [len(set(a) & set(b)) / k for a, b in zip(truth.tolist(), found.tolist())]
+            rows.append({
+                "index": spec["factory"] if "requested" not in spec
+                else f"{spec['factory']}（{spec['requested']} は {spec['min_count']}件未満のため）",
+                "knob": knob,
+                f"recall@{k}_vs_flat": round(float(np.mean(overlap)), 4),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 4),
+                "build_s": round(build_s, 2),
+                "index_bytes": size,
+            })
+    return rows
+
+
+def dimension_report(corpus, doc_vectors, labels, q_vectors, configs, ks, repeat, thresholds,
+                     dimensions, storages, reference, tolerance):
+    """
+    次元数・保存形式ごとに flat インデックスを作って評価し、(行のリスト, 推奨の行) を返す。
+
+    質問ベクトルは本来の次元数のまま渡し、検索時に切り詰める本番と同じ経路で測る。
+    推奨は、品質指標が本来の次元数・float32 の結果（reference）から tolerance 以内で
+    インデックスが最も小さい組み合わせ。
+    """
+    rows = []
+    for dimensions in dimensions:
+        for storage in storages:
+            spec = retrieval.index_spec(len(corpus), dimensions, "flat", storage=storage)
+            snap = retrieval.build_snapshot(corpus, doc_vectors, spec=spec, dimensions=dimensions)
+            row = {"dimensions": dimensions, "storage": storage, "ok": True}
+            for config in configs:
+                result = evaluate(snap, config, labels, q_vectors, ks, repeat, thresholds)
+                quality = {name: value for name, value in result.items() if name.startswith("recall@") or name == "mrr"}
+                row.update({f"{config}_{name}": value for name, value in quality.items()})
+                row[f"{config}_p50_ms"] = result["p50_ms"]
+                row["ok"] = row["ok"] and all(value >= reference[config][name] - tolerance
+                                              for name, value in quality.items())
+            row["index_bytes"] = int(faiss.serialize_index(snap.index).nbytes)
+            rows.append(row)
+    passing = [row for row in rows if row["ok"]]
+    best = min(passing, key=lambda row: (row["index_bytes"], row["dimensions"])) if passing else None
+    return rows, best
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """品質指標（recall@k・MRR）が基準値から tolerance を超えて下がった項目を返す"""
+    regressions = []
+    for config, metrics in baseline.get("results", {}).items():
+        current = results.get(config)
+        if current is None:
+            continue
+        for name, value in metrics.items():
+            if not (name.startswith("recall@") or name == "mrr") or name not in current:
+                continue
+            if current[name] < value - tolerance:
+                regressions.append(f"{config} {name}: {value} → {current[name]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検索品質・速度のオフラインベンチマーク")
+    parser.add_argument("--labels", default=LABELS_PATH)
+    parser.add_argument("--embedder", choices=["hashed", "cached"], default="hashed")
+    parser.add_argument("--fetch-missing", action="store_true", help="cached でキャッシュに無いものを API で取得する")
+    parser.add_argument("--configs", default=",".join(CONFIGS))
+    parser.add_argument("--k", default=",".join(str(k) for k in DEFAULT_KS))
+    parser.add_argument("--repeat", type=int, default=5, help="レイテンシ計測の繰り返し回数")
+    parser.add_argument("--production-thresholds", action="store_true",
+                        help="本番の下限スコア・margin で切った結果を評価する（cached 向け）")
+    parser.add_argument("--output", help="結果を JSON で保存する")
+    parser.add_argument("--baseline", help="この基準値より悪化していれば終了コード 1")
+    parser.add_argument("--tolerance", type=float, default=0.01)
+    parser.add_argument("--write-baseline", help="今回の結果を基準値として保存する")
+    parser.add_argument("--seed-from", nargs="+", help="シートの CSV 書き出しから質問を取り込んで終了する")
+    parser.add_argument("--index-types", help=f"flat と比べるインデックスの種類（{','.join(retrieval.INDEX_TYPES)}）")
+    parser.add_argument("--scale", type=int, default=0, help="インデックス比較で疑似文書を加えてこの件数にする")
+    parser.add_argument("--ef-search", default=str(retrieval.HNSW_EF_SEARCH), help="HNSW の efSearch（カンマ区切り）")
+    parser.add_argument("--nprobe", default=str(retrieval.IVF_NPROBE), help="IVF の nprobe（カンマ区切り）")
+    parser.add_argument("--k-factor", default=str(retrieval.IVF_REFINE_K_FACTOR),
+                        help="ivfpq で SQ8 で並べ直す候補の倍率（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dimensions", help="比べる次元数（カンマ区切り。本来の次元数以下）")
+    parser.add_argument("--storages", default="float32",
+                        help=f"--dimensions で比べる保存形式（{','.join(retrieval.VECTOR_STORAGES)}）")
+    args = parser.parse_args()
+
+    if args.seed_from:
+        seed_labels(args.seed_from, args.labels)
+        return
+
+    ks = sorted({int(k) for k in args.k.split(",")})
+    configs = [c.strip() for c in args.configs.split(",") if c.strip()]
+    unknown = [c for c in configs if c not in CONFIGS]
+    if unknown:
+        raise SystemExit(f"❌ 未対応の構成です: {', '.join(unknown)}")
+
+    corpus = retrieval.load_corpus()
+    labels = load_labels(args.labels, corpus)
+    if not labels:
+        raise SystemExit("❌ 評価できるラベルがありません")
+    queries = [label["query"] for label in labels]
+
+    if args.embedder == "hashed":
+        doc_vectors = hashed_embed(corpus.texts)
+        q_vectors = hashed_embed(queries)
+    else:
+        doc_vectors = cached_vectors(corpus.texts, retrieval.EMBED_MODEL, fetch=args.fetch_missing)
+        q_vectors = cached_vectors(queries, retrieval.EMBED_MODEL, query=True, fetch=args.fetch_missing)
+
+    snap = retrieval.build_snapshot(corpus, doc_vectors)
+    thresholds = {} if args.production_thresholds else NO_THRESHOLDS
+
+    print(f"📊 コーパス {len(corpus)}件 / ラベル {len(labels)}件 / embedder={args.embedder}")
+    results = {}
+    for config in configs:
+        results[config] = evaluate(snap, config, labels, q_vectors, ks, args.repeat, thresholds)
+        metrics = "  ".join(f"{name}={value}" for name, value in results[config].items())
+        print(f"  {config:<8} {metrics}")
+
+    report = {
+        "embedder": args.embedder,
+        "corpus_hash": corpus.hash,
+        "labels": len(labels),
+        "results": results,
+    }
+
+    if args.index_types:
+        index_types = [t.strip() for t in args.index_types.split(",") if t.strip()]
+        vectors = scaled_vectors(doc_vectors, args.scale, args.seed)
+        print(f"\n📐 インデックス比較（{len(vectors)}件 / {vectors.shape[1]}次元、正解は flat の上位 {max(ks)} 件）")
+        report["ann"] = ann_report(
+            vectors, q_vectors, index_types, max(ks), args.repeat,
+            [int(v) for v in args.ef_search.split(",")], [int(v) for v in args.nprobe.split(",")],
+            [int(v) for v in args.k_factor.split(",")],
+        )
+        for row in report["ann"]:
+            print("  " + "  ".join(f"{name}={value}" for name, value in row.items() if value != ""))
+    if args.dimensions:
+        dimensions = sorted({int(d) for d in args.dimensions.split(",")})
+        storages = [s.strip() for s in args.storages.split(",") if s.strip()]
+        if dimensions[-1] > doc_vectors.shape[1]:
+            raise SystemExit(f"❌ --dimensions は本来の次元数（{doc_vectors.shape[1]}）以下にしてください")
+        vector_configs = [c for c in configs if c != "lexical"]
+        if not vector_configs:
+            raise SystemExit("❌ --dimensions には vector か hybrid の構成が必要です")
+        print(f"\n📏 次元数・保存形式の比較（本来の次元数 {doc_vectors.shape[1]}・float32 から {args.tolerance} 以内を合格）")
+        rows, best = dimension_report(
+            corpus, doc_vectors, labels, q_vectors, vector_configs, ks, args.repeat, thresholds,
+            dimensions, storages, results, args.tolerance,
+        )
+        report["dimensions"] = rows
+        for row in rows:
+            mark = "✅" if row["ok"] else "❌"
+            print(f"  {mark} " + "  ".join(f"{name}={value}" for name, value in row.items() if name != "ok"))
+        if best:
+            report["recommended"] = {"EMBED_DIMENSIONS": best["dimensions"], "VECTOR_STORAGE": best["storage"]}
+            print(f"👉 EMBED_DIMENSIONS={best['dimensions']} VECTOR_STORAGE={best['storage']}"
+                  f"（インデックス {best['index_bytes']} バイト）")
+        else:
+            print("⚠️ 品質を保てる組み合わせがありません（本来の次元数のまま使ってください）")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.write_baseline:
+        with open(args.write_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 基準値を保存しました: {args.write_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("embedder") != args.embedder:
+            raise SystemExit(f"❌ 基準値の embedder（{baseline.get('embedder')}）と異なります")
+        if baseline.get("corpus_hash") != corpus.hash:
+            print("⚠️ 基準値の作成後にコーパスが変わっています（差は FAQ・knowledge の更新によるものかもしれません）")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("❌ 基準値より悪化しました:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("✅ 基準値からの悪化はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# === 設定 ===
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory / sqlite
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "data/sessions.sqlite3")
+SESSION_CAPACITY = int(os.getenv("SESSION_CAPACITY", "100000"))
+SESSION_SHARDS = int(os.getenv("SESSION_SHARDS", "16"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+HISTORY_TTL = 1800
+MAX_HISTORY = 10
+
+
+class _Sweeper:
+    """期限切れセッションを定期的に掃除するスレッド（fork 後は子プロセスで起動し直す）"""
+
+    def __init__(self, sweep, interval):
+        self.sweep = sweep
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="session-sweeper", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Session sweep error")
+
+
+class MemorySessionStore:
+    """
+    プロセス内のセッション履歴ストア。
+
+    セッション id のハッシュでシャードに分け、シャードごとのロックで排他する。
+    各シャードは最終アクセス順の OrderedDict で、容量超過時は最も古いものから捨て、
+    TTL 切れはバックグラウンドの掃除スレッドが先頭から取り除く。
+    """
+
+    def __init__(self, capacity=SESSION_CAPACITY, ttl=HISTORY_TTL, shards=SESSION_SHARDS,
+                 max_history=MAX_HISTORY, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.max_history = max_history
+        self.shard_capacity = max(1, -(-capacity // shards))
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self.evicted = 0
+        self.expired = 0
+        self._sweeper = _Sweeper(self.sweep, sweep_interval)
+
+    def _shard(self, session_id):
+        i = zlib.crc32(session_id.encode("utf-8")) % len(self._shards)
+        return self._shards[i], self._locks[i]
+
+    def _touch(self, shard, session_id, now):
+        # ロック内で呼ぶこと。期限切れなら新しい履歴で置き換える
+        session = shard.get(session_id)
+        if not session or now - session["last_active"] > self.ttl:
+            if session:
+                self.expired += 1
+            session = {"last_active": now, "history": []}
+            shard[session_id] = session
+            while len(shard) > self.shard_capacity:
+                shard.popitem(last=False)
+                self.evicted += 1
+        else:
+            session["last_active"] = now
+        shard.move_to_end(session_id)
+        return session
+
+    def get_history(self, session_id):
+        # JSON の数値などで渡された id も文字列として扱う（SQLite 版と同じ）
+        session_id = str(session_id)
+        self._sweeper.ensure_started()
+        shard, lock = self._shard(session_id)
+        with lock:
+            return list(self._touch(shard, session_id, time.time())["history"])
+
+    def append(self, session_id, role, content):
+        session_id = str(session_id)
+        self._sweeper.ensure_started()
+        shard, lock = self._shard(session_id)
+        with lock:
+            history = self._touch(shard, session_id, time.time())["history"]
+            history.append({"role": role, "content": content})
+            if len(history) > self.max_history:
+                history[:] = history[-self.max_history:]
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                # 最終アクセス順に並んでいるため、先頭から期限切れを取り除けばよい
+                while shard:
+                    session_id, session = next(iter(shard.items()))
+                    if session["last_active"] > cutoff:
+                        break
+                    shard.popitem(last=False)
+                    self.expired += 1
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "sessions": sum(len(shard) for shard in self._shards),
+            "capacity": self.shard_capacity * len(self._shards),
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+class SQLiteSessionStore:
+    """
+    SQLite ファイルに履歴を保存するストア。
+
+    同じファイルを参照する gunicorn / uvicorn の全ワーカーで会話履歴を共有できる。
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, capacity=SESSION_CAPACITY, ttl=HISTORY_TTL,
+                 max_history=MAX_HISTORY, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_history = max_history
+        self._lock = threading.Lock()
+        self._conn_pid = None
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._connect()
+        self._sweeper = _Sweeper(self.sweep, sweep_interval)
+
+    def _connect(self):
+        # fork 後の子プロセスでは親の接続を使わず開き直す
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn_pid = os.getpid()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                last_active REAL NOT NULL,
+                history TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active)")
+
+    def _execute(self, fn):
+        self._sweeper.ensure_started()
+        with self._lock:
+            if self._conn_pid != os.getpid():
+                self._connect()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _load(self, conn, session_id, now):
+        row = conn.execute(
+            "SELECT last_active, history FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if not row or now - row[0] > self.ttl:
+            return []
+        return json.loads(row[1])
+
+    def _store(self, conn, session_id, history, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, last_active, history) VALUES (?, ?, ?)",
+            (session_id, now, json.dumps(history, ensure_ascii=False)),
+        )
+
+    def get_history(self, session_id):
+        session_id = str(session_id)
+
+        def fn(conn):
+            now = time.time()
+            history = self._load(conn, session_id, now)
+            self._store(conn, session_id, history, now)
+            return history
+        return self._execute(fn)
+
+    def append(self, session_id, role, content):
+        session_id = str(session_id)
+
+        def fn(conn):
+            now = time.time()
+            history = self._load(conn, session_id, now)
+            history.append({"role": role, "content": content})
+            self._store(conn, session_id, history[-self.max_history:], now)
+        self._execute(fn)
+
+    def sweep(self):
+        def fn(conn):
+            conn.execute("DELETE FROM sessions WHERE last_active < ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM sessions WHERE session_id IN ("
+                " SELECT session_id FROM sessions ORDER BY last_active DESC LIMIT -1 OFFSET ?)",
+                (self.capacity,),
+            )
+        self._execute(fn)
+
+    def stats(self):
+        def fn(conn):
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return {"backend": "sqlite", "sessions": self._execute(fn), "capacity": self.capacity}
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend == "memory":
+        return MemorySessionStore()
+    raise ValueError(f"未対応の SESSION_BACKEND です: {backend}")
@@ -0,0 +1,253 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from observability import span
+
+logger = logging.getLogger(__name__)
+
+# === 設定 ===
+SHEET_LOG_BATCH_SIZE = int(os.getenv("SHEET_LOG_BATCH_SIZE", "50"))
+SHEET_LOG_FLUSH_INTERVAL = float(os.getenv("SHEET_LOG_FLUSH_INTERVAL", "5"))
+SHEET_LOG_SPOOL_PATH = os.getenv("SHEET_LOG_SPOOL_PATH", "data/sheet_log_spool.jsonl")
+# キューの上限。書き込みが詰まって溢れた行はメモリに溜めずスプールへ直接書く
+SHEET_LOG_MAX_QUEUE = int(os.getenv("SHEET_LOG_MAX_QUEUE", "10000"))
+# 取り出し中（spool.<pid>）のまま残ったファイルは、持ち主のプロセスが終了しているか
+# これより古ければ異常終了の残骸として再送する
+STALE_CLAIM_SECONDS = 3600
+
+
+class SheetLogWriter:
+    """
+    Google Sheets への追記をリクエスト処理から切り離すバックグラウンド書き込み器。
+
+    append() はキューに積むだけで即座に戻る。書き込みスレッドがシート（range）ごとに
+    行をまとめ、件数か経過時間のしきい値で1回の values().append にまとめて送る。
+    送信に失敗した行・キューから溢れた行はローカルの JSONL スプールに退避し、次回以降に再送する。
+    """
+
+    def __init__(self, sheet_service, spreadsheet_id, batch_size=SHEET_LOG_BATCH_SIZE,
+                 flush_interval=SHEET_LOG_FLUSH_INTERVAL, spool_path=SHEET_LOG_SPOOL_PATH,
+                 max_queue=SHEET_LOG_MAX_QUEUE):
+        self.sheet_service = sheet_service
+        self.spreadsheet_id = spreadsheet_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spool_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.sent_rows = 0
+        self.sent_batches = 0
+        self.spooled_rows = 0
+        self.overflow_rows = 0
+        self.errors = 0
+        atexit.register(self.close)
+
+    # --- 公開 API ---
+
+    def append(self, range_, row):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((range_, row))
+        except queue.Full:
+            self.overflow_rows += 1
+            try:
+                self._spool(range_, [row])
+            except OSError:
+                logger.exception("Sheets logging error（キューが満杯で、スプールにも書けませんでした）")
+
+    def close(self, timeout=10):
+        """停止要求を出し、キューに残った行を送り切る（送れなければスプールへ）"""
+        if self._thread is None or self._thread_pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "sent_rows": self.sent_rows,
+            "sent_batches": self.sent_batches,
+            "spooled_rows": self.spooled_rows,
+            "overflow_rows": self.overflow_rows,
+            "errors": self.errors,
+        }
+
+    # --- 内部処理 ---
+
+    def _ensure_thread(self):
+        # スレッドは fork 後に引き継がれないため、プロセスごとに起動する
+        if self._thread_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread_pid != os.getpid():
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, name="sheet-log-writer", daemon=True)
+                self._thread.start()
+                self._thread_pid = os.getpid()
+
+    def _run(self):
+        pending = {}
+        deadline = time.monotonic() + self.flush_interval
+        try:
+            self._recover_claimed()
+        except Exception:
+            self.errors += 1
+            logger.exception("Sheets spool recovery error")
+        while True:
+            stopping = self._stop.is_set()
+            # 1回の失敗（スプールの書き込みエラー・壊れた行など）でスレッドを止めない
+            try:
+                timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    range_, row = self._queue.get(timeout=timeout)
+                    pending.setdefault(range_, []).append(row)
+                except queue.Empty:
+                    pass
+
+                stopping = self._stop.is_set()
+                if stopping:
+                    # 停止時はキューを空にしてから最後の送信を行う
+                    while True:
+                        try:
+                            range_, row = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        pending.setdefault(range_, []).append(row)
+
+                pending_count = sum(len(rows) for rows in pending.values())
+                if pending_count >= self.batch_size or time.monotonic() >= deadline or stopping:
+                    deadline = time.monotonic() + self.flush_interval
+                    if pending and self._flush(pending):
+                        self._replay_spool()
+            except Exception:
+                self.errors += 1
+                logger.exception("Sheets logging error（書き込みスレッドは継続します）")
+                deadline = time.monotonic() + self.flush_interval
+
+            if stopping:
+                return
+
+    def _send(self, range_, rows):
+        with span("sheets"):
+            self.sheet_service.values().append(
+                spreadsheetId=self.spreadsheet_id,
+                range=range_,
+                valueInputOption="RAW",
+                body={"values": rows}
+            ).execute()
+        self.sent_rows += len(rows)
+        self.sent_batches += 1
+
+    def _flush(self, pending):
+        """
+        送信できなかった行はスプールに退避する。全件送れたら True。
+        送信・退避が済んだシートは pending から外す（例外で中断しても残りは次回に送る）。
+        """
+        ok = True
+        for range_ in list(pending):
+            rows = pending[range_]
+            try:
+                self._send(range_, rows)
+            except Exception as e:
+                logger.error("Sheets logging error（%d件をスプールに退避します）: %s", len(rows), e)
+                self._spool(range_, rows)
+                ok = False
+            del pending[range_]
+        return ok
+
+    def _spool(self, range_, rows):
+        dirname = os.path.dirname(self.spool_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with self._spool_lock:
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps({"range": range_, "row": row}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.spooled_rows += len(rows)
+
+    def _replay_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        # 他のワーカーと二重送信しないよう、リネームで取り出してから送る
+        claimed = f"{self.spool_path}.{os.getpid()}"
+        try:
+            os.replace(self.spool_path, claimed)
+        except OSError:
+            return
+        self._replay_claimed(claimed)
+
+    def _replay_claimed(self, claimed):
+        """
+        取り出したスプールを再送し、送れなかった行はスプールに戻してから削除する。
+        途中で異常終了した場合はファイルが残り、次回の起動時に _recover_claimed が拾う。
+        """
+        pending = {}
+        with open(claimed, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    pending.setdefault(item["range"], []).append(item["row"])
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Sheets spool の壊れた行を読み飛ばします: %r", line[:200])
+
+        for range_, rows in pending.items():
+            for i in range(0, len(rows), self.batch_size):
+                chunk = rows[i:i + self.batch_size]
+                try:
+                    self._send(range_, chunk)
+                except Exception as e:
+                    logger.error("Sheets spool replay error: %s", e)
+                    self._spool(range_, chunk)
+        os.remove(claimed)
+
+    def _recover_claimed(self):
+        """異常終了したプロセスの取り出し中ファイル（spool.<pid>）を引き取って再送する"""
+        directory = os.path.dirname(self.spool_path) or "."
+        prefix = os.path.basename(self.spool_path) + "."
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            owner = name[len(prefix):].split("-")[0]
+            if not name.startswith(prefix) or not owner.isdigit():
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stale = time.time() - os.path.getmtime(path) > STALE_CLAIM_SECONDS
+            except OSError:
+                continue
+            if int(owner) == os.getpid() or (_pid_alive(int(owner)) and not stale):
+                continue
+            # 他のワーカーと同時に引き取らないよう、自分の pid を付けた名前に移してから送る
+            claimed = f"{self.spool_path}.{os.getpid()}-{name[len(prefix):]}"
+            try:
+                os.replace(path, claimed)
+            except OSError:
+                continue
+            logger.info("Sheets spool の残骸 %s を再送します", name)
+            self._replay_claimed(claimed)
+
+
+def _pid_alive(pid):
+    # Windows の os.kill はシグナル 0 でもプロセスを終了させるため、生死は確かめず古さだけで判断する
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -1,10 +1,14 @@
+import logging
 import os
 import json
 import numpy as np
-import faiss
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import openai
+import retrieval
+
+# retrieval などのライブラリは進捗をロガーに出すため、そのまま表示する
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 # === ローカル実行時のみ .env を読み込む ===
 if os.getenv("GITHUB_ACTIONS") != "true":
@@ -13,6 +17,8 @@ if os.getenv("GITHUB_ACTIONS") != "true":
 
 # === OpenAI APIキー設定 ===
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# 再試行は embedding_pipeline 側でまとめて行う
+openai.max_retries = 0
 if not openai.api_key:
     raise ValueError("OPENAI_API_KEY is not set or empty.")
 
@@ -47,45 +53,17 @@ with open("data/faq.json", "w", encoding="utf-8") as f:
 
 print("✅ data/faq.json を保存しました。")
 
-# === knowledge.json を読み込み ===
-with open("data/knowledge.json", "r", encoding="utf-8") as f:
-    knowledge_dict = json.load(f)
-knowledge_contents = [
-    f"{category}：{text}"
-    for category, texts in knowledge_dict.items()
-    for text in texts
-]
-
-# === metadata（任意）===
-metadata_note = ""
-metadata_path = "data/metadata.json"
-if os.path.exists(metadata_path):
-    with open(metadata_path, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
-        metadata_note = f"【ファイル情報】{metadata.get('title', '')}（種類：{metadata.get('type', '')}、優先度：{metadata.get('priority', '')}）"
-
-# === ベクトルを再生成（バッチ処理対応）===
-EMBED_MODEL = "text-embedding-3-small"
-search_corpus = [item["question"] for item in faq_list] + knowledge_contents + [metadata_note]
-
-def get_embeddings_in_batches(texts, batch_size=100):
-    vectors = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i+batch_size]
-        response = openai.embeddings.create(model=EMBED_MODEL, input=batch)
-        batch_vectors = [np.array(data.embedding, dtype="float32") for data in response.data]
-        vectors.extend(batch_vectors)
-    return np.array(vectors, dtype="float32")
-
-print("🔄 ベクトルをバッチで再生成しています...")
-vector_data = get_embeddings_in_batches(search_corpus)
+# === ベクトルを再生成（FAQ + knowledge。コーパス定義は retrieval.py と共通）===
+EMBED_MODEL = retrieval.EMBED_MODEL
+corpus = retrieval.load_corpus()
 
-dimension = vector_data.shape[1]
-index = faiss.IndexFlatL2(dimension)
-index.add(vector_data)
+def get_embeddings_batch(texts):
+    response = openai.embeddings.create(model=EMBED_MODEL, input=texts)
+    return [np.array(data.embedding, dtype="float32") for data in response.data]
 
-# === 保存 ===
-np.save("data/vector_data.npy", vector_data)
-faiss.write_index(index, "data/index.faiss")
+# 現在の世代との差分（追加・削除・変更）だけを反映した新しい世代を作り、
+# 完成してから data/CURRENT を切り替える（稼働中のアプリは旧世代を読み続けられる）
+print("🔄 ベクトルをバッチで更新しています...")
+generation, index = retrieval.publish_index(corpus, get_embeddings_batch, model=EMBED_MODEL)
 
-print("✅ ベクトルデータとFAISSインデックスを保存しました。")
+print(f"✅ ベクトルデータとFAISSインデックスを世代 {generation} として保存しました。")